@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# facedancer-host-benchmark.py
+#
+# Measures bulk IN throughput through the libusb host backend, reading one
+# transfer at a time and with several transfers outstanding, and checks that
+# streamed data arrives in order. By default, reads from a local stand-in device
+# that simulates each transfer's latency, so the benchmark can be run anywhere.
+# The stand-in isn't a libusb device, so its reads are run by the backend's
+# per-endpoint thread, and overlap only with our processing; real devices use
+# libusb's asynchronous API, which also overlaps the transfers themselves.
+
+import time
+import array
+import argparse
+import threading
+
+from facedancer.backends.LibUSBHostApp import LibUSBHostApp
+
+
+class StandInDevice:
+    """
+    Stands in for a pyusb device with a bulk IN endpoint that can always send
+    data, but takes a fixed time to start each transfer-- like a real device
+    behind a host controller. Transfers can start concurrently, but share the
+    bus, so only one moves data at a time. Each transfer's data starts with a
+    32-bit sequence number, so the order it's received in can be checked.
+    """
+
+    speed = 3
+
+    def __init__(self, latency, bytes_per_second):
+        """
+        latency: The time each transfer takes before any data moves, in seconds.
+        bytes_per_second: The rate at which the data then moves.
+        """
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.pattern = bytes(range(256)) * 64
+        self.bus = threading.Lock()
+        self.sequence = 0
+
+
+    def read(self, endpoint_address, size_or_buffer, timeout=None):
+        if isinstance(size_or_buffer, int):
+            size_or_buffer = bytearray(size_or_buffer)
+
+        length = len(size_or_buffer)
+        sequence = self._transfer(length)
+
+        view = memoryview(size_or_buffer).cast('B')
+        for position in range(0, length, len(self.pattern)):
+            chunk = min(len(self.pattern), length - position)
+            view[position:position + chunk] = self.pattern[:chunk]
+
+        view[:4] = sequence.to_bytes(4, 'little')
+        return length
+
+
+    def write(self, endpoint_address, data, timeout=None):
+        self._transfer(len(data))
+        return len(data)
+
+
+    def _transfer(self, length):
+        """ Simulates a transfer's timing, and returns its sequence number. """
+        time.sleep(self.latency)
+
+        with self.bus:
+            time.sleep(length / self.bytes_per_second)
+
+            sequence = self.sequence
+            self.sequence += 1
+
+        return sequence
+
+
+
+def measure(description, read):
+    """ Runs the given read function, which returns the amount of data read, and prints the throughput. """
+    started = time.perf_counter()
+    received = read()
+    elapsed = time.perf_counter() - started
+
+    print("{:<32} {:>10.1f} KiB/s  ({} bytes in {:.3f} s)".format(
+        description, received / elapsed / 1024, received, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FaceDancer host-mode bulk IN throughput benchmark")
+    parser.add_argument('--size', dest='size', metavar='<bytes>', type=int, default=1 << 20,
+                        help="Total amount of data to read in each run (default: 1 MiB)")
+    parser.add_argument('--transfer-size', dest='transfer_size', metavar='<bytes>', type=int, default=16384,
+                        help="Amount of data to request with each transfer (default: 16384)")
+    parser.add_argument('--depths', dest='depths', metavar='<depths>', default='1,2,4,8',
+                        help="Comma-separated numbers of reads to keep outstanding (default: 1,2,4,8)")
+    parser.add_argument('--latency', dest='latency', metavar='<ms>', type=float, default=1.0,
+                        help="Per-transfer latency of the stand-in device (default: 1 ms)")
+    parser.add_argument('--rate', dest='rate', metavar='<MiB/s>', type=float, default=40.0,
+                        help="Data rate of the stand-in device (default: 40 MiB/s)")
+    parser.add_argument('--device', dest='device', metavar='<vid:pid>',
+                        help="Benchmark a real device via libusb, rather than the stand-in")
+    parser.add_argument('--endpoint', dest='endpoint', metavar='<n>', type=int, default=1,
+                        help="The bulk IN endpoint number to read from (default: 1)")
+    args = parser.parse_args()
+
+    depths = [int(depth) for depth in args.depths.split(',')]
+    transfers = max(1, args.size // args.transfer_size)
+
+    if args.device:
+        vendor_id, product_id = (int(part, 16) for part in args.device.split(':'))
+        u = LibUSBHostApp(idVendor=vendor_id, idProduct=product_id)
+    else:
+        device = StandInDevice(args.latency / 1000, args.rate * 1024 * 1024)
+        u = LibUSBHostApp(device=device)
+
+    def read_synchronously():
+        buffer = array.array('B', bytes(args.transfer_size))
+        return sum(len(u.bulk_read(args.endpoint, args.transfer_size, buffer)) for _ in range(transfers))
+
+    def read_streaming(depth):
+        received = 0
+        expected = None
+
+        for data in u.stream_read(args.endpoint, args.transfer_size, transfers, depth):
+            received += len(data)
+
+            # The stand-in numbers its transfers; make sure none were reordered.
+            if not args.device:
+                sequence = int.from_bytes(data[:4], 'little')
+                if expected is not None and sequence != expected:
+                    raise RuntimeError("stream_read at depth {} received transfer {} when expecting {}".format(
+                        depth, sequence, expected))
+                expected = sequence + 1
+
+        return received
+
+    try:
+        measure("bulk_read, one at a time", read_synchronously)
+
+        for depth in depths:
+            measure("stream_read, depth {}".format(depth), lambda: read_streaming(depth))
+    finally:
+        u.close()
+
+if __name__ == "__main__":
+    main()
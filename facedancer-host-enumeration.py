@@ -4,9 +4,15 @@
 
 from facedancer import FacedancerUSBHostApp
 
-# Enumerate and configure the attached device.
+# Enumerate and configure the attached device, giving up if none connects within ten seconds.
 u = FacedancerUSBHostApp(verbose=3)
-u.initialize_device(assign_address=1, apply_configuration=1)
+u.initialize_device(assign_address=1, apply_configuration=1, timeout=10)
+
+# Print how long each step of enumeration took.
+print("Enumeration steps: ")
+for step, duration in u.enumeration_timings:
+    print("\t{}: {:.1f} ms".format(step, duration * 1000))
+print("\ttotal: {:.1f} ms".format(sum(duration for _, duration in u.enumeration_timings) * 1000))
 
 # At this point, we can perform whatever communications we need to to use the target device.
 # Usually, this is accomplsihed using the send_on_endpoint and read_from_endpoint functions
@@ -28,6 +34,8 @@ print("Attached device: {}".format(u.get_device_descriptor()))
 configuration = u.get_configuration_descriptor()
 print("Using first configuration: {}".format(configuration))
 
+print("Descriptor reads answered from cache: {}".format(u.descriptor_cache_hits))
+
 for interface in configuration.interfaces:
     print("\t - {}".format(interface))
 
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#
+# facedancer-host-fuzzer.py
+#
+# Fuzzes the control endpoint of a device attached to a Facedancer's host port.
+
+import argparse
+
+from facedancer import FacedancerUSBHostApp
+from facedancer.USBHostFuzzer import USBHostFuzzer
+
+def main():
+    parser = argparse.ArgumentParser(description="FaceDancer host-mode control request fuzzer")
+    parser.add_argument('--seed', dest='seed', metavar='<seed>', type=int,
+                        help="Seed for the request grammar; random if not provided")
+    parser.add_argument('--count', dest='count', metavar='<n>', type=int,
+                        help="Stop after <n> requests")
+    parser.add_argument('--duration', dest='duration', metavar='<seconds>', type=float,
+                        help="Stop after <seconds>")
+    parser.add_argument('--start', dest='start', metavar='<case>', type=int, default=0,
+                        help="Start from the given case number, e.g. to resume or reproduce a run")
+    parser.add_argument('--spaces', dest='spaces', metavar='<spaces>', default='standard,class,vendor',
+                        help="Comma-separated request spaces to fuzz (default: standard,class,vendor)")
+    parser.add_argument('--corpus', dest='corpus', metavar='<directory>',
+                        help="Save interesting requests and crashes to <directory>")
+    args = parser.parse_args()
+
+    # Enumerate and configure the attached device.
+    u = FacedancerUSBHostApp(verbose=1)
+    u.initialize_device(assign_address=1, apply_configuration=1, timeout=10)
+
+    fuzzer = USBHostFuzzer(u, args.seed, args.spaces.split(','), corpus_directory=args.corpus, verbose=1)
+    print("Fuzzing with seed {}.".format(fuzzer.seed))
+
+    try:
+        next_case = fuzzer.fuzz(args.count, args.duration, args.start, report_interval=5)
+    # SIGINT raises KeyboardInterrupt
+    except KeyboardInterrupt:
+        next_case = args.start + fuzzer.cases_run
+    finally:
+        fuzzer.close()
+
+    print(fuzzer.summary())
+    print("To resume, use --seed {} --start {}.".format(fuzzer.seed, next_case))
+
+if __name__ == "__main__":
+    main()
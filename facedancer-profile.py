@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+#
+# facedancer-profile.py
+#
+# Emulates a device from a saved device profile. Profiles can be captured
+# from any emulated device with USBDeviceProfile.from_device(device).save(filename).
+
+import sys
+
+from facedancer import FacedancerUSBApp
+from facedancer.USBDeviceProfile import USBDeviceProfile
+
+if len(sys.argv) != 2:
+    print("Usage: facedancer-profile.py <profile>")
+    sys.exit(1)
+
+u = FacedancerUSBApp(verbose=1)
+d = USBDeviceProfile.load(sys.argv[1]).compile(u, verbose=3)
+
+d.connect()
+
+try:
+    d.run()
+# SIGINT raises KeyboardInterrupt
+except KeyboardInterrupt:
+    d.disconnect()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+#
+# facedancer-replay.py
+#
+# Emulates a device by replaying a session recorded from it, e.g. with
+# facedancer-usbproxy.py --record. The original device isn't needed.
+
+import sys
+
+from facedancer import FacedancerUSBApp
+from facedancer.USBSession import USBReplayDevice
+
+if len(sys.argv) != 2:
+    print("Usage: facedancer-replay.py <session>")
+    sys.exit(1)
+
+u = FacedancerUSBApp(verbose=1)
+d = USBReplayDevice(u, sys.argv[1], verbose=3)
+
+d.connect()
+
+try:
+    d.run()
+# SIGINT raises KeyboardInterrupt
+except KeyboardInterrupt:
+    d.disconnect()
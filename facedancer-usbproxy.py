@@ -7,8 +7,15 @@ from facedancer.USBConfiguration import USBConfiguration
 from facedancer.USBInterface import USBInterface
 from facedancer.USBEndpoint import USBEndpoint
 from facedancer.USBProxy import USBProxyDevice, USBProxyFilter
+from facedancer.USBProxyStatistics import USBProxyStatistics
 from facedancer.filters.standard import USBProxySetupFilters
 from facedancer.filters.logging import USBProxyPrettyPrintFilter
+from facedancer.filters.capture import USBProxyCaptureFilter
+from facedancer.filters.recording import USBProxyRecordingFilter
+from facedancer.filters.rules import USBProxyRuleFilter
+from facedancer.filters.tap import USBProxyTapFilter
+from facedancer.filters.shaping import USBProxyShapingFilter
+from facedancer.filters.fuzzing import USBProxyFuzzingFilter
 import argparse
 
 def vid_pid(x):
@@ -25,18 +32,78 @@ def main():
     parser.add_argument('-p', dest='productid', metavar='<ProductID>',
                         type=vid_pid, help="Product ID of device",
                         required=True)
+    parser.add_argument('--cache-descriptors', dest='cache_descriptors', action='store_true',
+                        help="Answer repeated GET_DESCRIPTOR requests without asking the device")
+    parser.add_argument('--pcap', dest='pcap', metavar='<filename>',
+                        help="Capture the proxied traffic to a pcapng file")
+    parser.add_argument('--record', dest='record', metavar='<filename>',
+                        help="Record a session that facedancer-replay.py can replay")
+    parser.add_argument('--rules', dest='rules', metavar='<filename>',
+                        help="Modify the proxied traffic according to a JSON file of rules")
+    parser.add_argument('--shaping', dest='shaping', metavar='<filename>',
+                        help="Delay, rate-limit or drop the proxied traffic according to a JSON file of rules")
+    parser.add_argument('--fuzz', dest='fuzz_seed', metavar='<seed>', type=int,
+                        help="Mutate the data the device returns, using the given seed")
+    parser.add_argument('--fuzz-log', dest='fuzz_log', metavar='<filename>',
+                        help="Log each packet the fuzzer mutates, so crashes can be reproduced")
+    parser.add_argument('--in-buffer-depth', dest='in_buffer_depth', metavar='<packets>', type=int, default=0,
+                        help="Read up to <packets> ahead on each IN endpoint, rather than waiting for the host")
+    parser.add_argument('--in-transfer-size', dest='in_transfer_size', metavar='<bytes>', type=int,
+                        help="Read bulk IN data from the device in transfers of up to <bytes>; data is "
+                             "lost if the device pauses mid-transfer for longer than --in-transfer-timeout")
+    parser.add_argument('--in-transfer-timeout', dest='in_transfer_timeout', metavar='<ms>', type=int, default=1000,
+                        help="Timeout for each --in-transfer-size read (default: 1000 ms)")
+    parser.add_argument('--stats', dest='stats_interval', metavar='<seconds>', type=float,
+                        help="Print latency and throughput statistics every <seconds>")
+    parser.add_argument('--stats-file', dest='stats_file', metavar='<filename>',
+                        help="Export latency and throughput statistics to a JSON file")
     args = parser.parse_args()
     quirks = []
 
     # Create a new USBProxy device.
     u = FacedancerUSBApp(verbose=1)
-    d = USBProxyDevice(u, idVendor=args.vendorid, idProduct=args.productid, verbose=2, quirks=quirks)
 
-    # Add our standard filters.
+    statistics = None
+    if args.stats_interval or args.stats_file:
+        statistics = USBProxyStatistics(args.stats_interval, args.stats_file)
+
+    d = USBProxyDevice(u, idVendor=args.vendorid, idProduct=args.productid, verbose=2, quirks=quirks,
+                       cache_descriptors=args.cache_descriptors, statistics=statistics,
+                       in_buffer_depth=args.in_buffer_depth, in_transfer_size=args.in_transfer_size, in_transfer_timeout=args.in_transfer_timeout)
+
+    # Add our standard filters. Logging runs as a tap, so printing
+    # never holds up the proxied traffic.
     # TODO: Make the PrettyPrintFilter switchable?
-    d.add_filter(USBProxyPrettyPrintFilter(verbose=5))
+    logging_tap = USBProxyTapFilter(USBProxyPrettyPrintFilter(verbose=5))
+    d.add_filter(logging_tap)
+
+    # Apply any rules before the standard filters, so rewritten descriptors
+    # are used to configure the Facedancer.
+    if args.rules:
+        d.add_filter(USBProxyRuleFilter.load(args.rules))
+
     d.add_filter(USBProxySetupFilters(d, verbose=2))
 
+    # The fuzzer goes after the standard filters, so the Facedancer is configured
+    # from the device's real descriptors; and before capture and recording, so
+    # they see what the host actually received.
+    if args.fuzz_seed is not None:
+        fuzzer = USBProxyFuzzingFilter(d, args.fuzz_seed, log_filename=args.fuzz_log,
+                                       report_interval=args.stats_interval or 10)
+        d.add_filter(fuzzer)
+
+    if args.pcap:
+        capture = USBProxyCaptureFilter(d, args.pcap)
+        d.add_filter(capture)
+
+    if args.record:
+        recording = USBProxyRecordingFilter(args.record)
+        d.add_filter(recording)
+
+    # Shaping goes last, as the traffic it holds back skips any later filters.
+    if args.shaping:
+        d.add_filter(USBProxyShapingFilter.load(d, args.shaping))
+
     # TODO: Figure these out from the command line!
     d.connect()
 
@@ -45,6 +112,14 @@ def main():
     # SIGINT raises KeyboardInterrupt
     except KeyboardInterrupt:
         d.disconnect()
+        logging_tap.close()
+
+        if args.fuzz_seed is not None:
+            fuzzer.close()
+        if args.pcap:
+            capture.close()
+        if args.record:
+            recording.close()
 
 if __name__ == "__main__":
     main()
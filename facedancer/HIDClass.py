@@ -32,9 +32,9 @@ class HIDClass(USBDescribable, USBClass):
     @classmethod
     def from_binary_descriptor(cls, data):
         """
-        Creates an endpoint object from a description of that endpoint.
+        Creates a HID class object from its class-specific descriptor.
         """
-        return cls(data)
+        return cls(bytes(data))
 
 
     def get_descriptor(self):
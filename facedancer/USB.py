@@ -60,6 +60,24 @@ class USBDescribable(object):
     # Override me!
     DESCRIPTOR_TYPE_NUMBER = None
 
+    # Maps descriptor type numbers to the classes that parse them. Populated
+    # automatically as subclasses declaring a DESCRIPTOR_TYPE_NUMBER are defined;
+    # the first class to claim a given number handles it.
+    descriptor_types = {}
+
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Registers each new subclass that declares its own DESCRIPTOR_TYPE_NUMBER
+        as the parser for that descriptor type.
+        """
+        super().__init_subclass__(**kwargs)
+
+        type_number = cls.__dict__.get('DESCRIPTOR_TYPE_NUMBER')
+        if type_number is not None:
+            USBDescribable.descriptor_types.setdefault(type_number, cls)
+
+
     @classmethod
     def handles_binary_descriptor(cls, data):
         """
@@ -77,11 +95,12 @@ class USBDescribable(object):
         descriptor data.
         """
 
-        for subclass in cls.__subclasses__():
-            # If this subclass handles our binary descriptor, use it to parse the given descriptor.
-            if subclass.handles_binary_descriptor(data):
-                return subclass.from_binary_descriptor(data)
+        # Look up the class registered for this descriptor type, and use it to
+        # parse the given descriptor.
+        subclass = USBDescribable.descriptor_types.get(data[1])
 
-        return None
+        if subclass is None:
+            return None
 
+        return subclass.from_binary_descriptor(data)
 
@@ -27,6 +27,9 @@ class USBConfiguration(USBDescribable):
             self.configuration_string_index = configuration_string_or_index
             self.configuration_string       = None
 
+        # Raw subordinate descriptors that haven't been parsed yet; see the
+        # interfaces property below.
+        self._subordinate_descriptors   = None
         self.interfaces                 = interfaces if interfaces else []
 
         self.attributes = attributes
@@ -35,7 +38,28 @@ class USBConfiguration(USBDescribable):
 
         self.device = None
 
-        for i in self.interfaces:
+
+    @property
+    def interfaces(self):
+        """
+        The interfaces contained in this configuration. For configurations created
+        from binary descriptors, the subordinate descriptors are only parsed the
+        first time this is accessed.
+        """
+        if self._subordinate_descriptors is not None:
+            data = self._subordinate_descriptors
+            self._subordinate_descriptors = None
+            self.interfaces = self._parse_subordinate_descriptors(data)
+
+        return self._interfaces
+
+
+    @interfaces.setter
+    def interfaces(self, interfaces):
+        self._subordinate_descriptors = None
+        self._interfaces = interfaces
+
+        for i in interfaces:
             i.set_configuration(self)
 
 
@@ -52,11 +76,14 @@ class USBConfiguration(USBDescribable):
 
         # Unpack the main colleciton of data into the descriptor itself.
         descriptor_type, total_length, num_interfaces, index, string_index, \
-            attributes, max_power = struct.unpack('<xBHBBBBB', data[0:length])
+            attributes, max_power = struct.unpack_from('<xBHBBBBB', data)
+
+        configuration = cls(index, string_index, None, attributes, max_power, total_length)
 
-        # Extract the subordinate descriptors, and parse them.
-        interfaces = cls._parse_subordinate_descriptors(data[length:total_length])
-        return cls(index, string_index, interfaces, attributes, max_power, total_length)
+        # Take a single copy of the subordinate descriptors, so later modifications
+        # to the caller's buffer can't affect us; we'll parse them on first use.
+        configuration._subordinate_descriptors = bytes(data[length:total_length])
+        return configuration
 
 
     @classmethod
@@ -70,23 +97,39 @@ class USBConfiguration(USBDescribable):
         # TODO: handle recieving interfaces out of order?
         interfaces = []
 
+        # Walk the descriptors by offset: we read lengths and types directly from
+        # the raw bytes, and hand each parser a zero-copy view of its descriptor.
+        data = bytes(data)
+        view = memoryview(data)
+        descriptor_types = USBDescribable.descriptor_types
+        offset = 0
+        end = len(data) - 1
+
         # Continue parsing until we run out of descriptors.
-        while data:
+        while offset < end:
 
             # Determine the length and type of the next descriptor.
-            length          = data[0]
-            descriptor = USBDescribable.from_binary_descriptor(data[:length])
+            length = data[offset]
+
+            # A zero length would never advance; treat it as the end of the descriptors.
+            if not length:
+                break
+
+            descriptor_class = descriptor_types.get(data[offset + 1])
+
+            if descriptor_class is not None:
+                descriptor = descriptor_class.from_binary_descriptor(view[offset:offset + length])
 
-            # If we have an interface descriptor, add it to our list of interfaces.
-            if isinstance(descriptor, USBInterface):
-                interfaces.append(descriptor)
-            elif isinstance(descriptor, USBEndpoint):
-                interfaces[-1].add_endpoint(descriptor)
-            elif isinstance(descriptor, USBClass):
-                interfaces[-1].set_class(descriptor)
+                # If we have an interface descriptor, add it to our list of interfaces.
+                if isinstance(descriptor, USBEndpoint):
+                    interfaces[-1].add_endpoint(descriptor)
+                elif isinstance(descriptor, USBInterface):
+                    interfaces.append(descriptor)
+                elif isinstance(descriptor, USBClass):
+                    interfaces[-1].set_class(descriptor)
 
             # Move on to the next descriptor.
-            data = data[length:]
+            offset += length
 
         return interfaces
 
@@ -5,11 +5,13 @@
 from .USB import *
 from .USBClass import *
 from .USBConfiguration import USBConfiguration
+from .USBStringTable import USBStringTable
 
 
 
 import time
 import struct
+import inspect
 
 class USBDevice(USBDescribable):
     name = "generic device"
@@ -28,7 +30,7 @@ class USBDevice(USBDescribable):
         self.quirks = quirks[:]
         self.correct_set_address = ('fast_set_address' not in quirks)
 
-        self.strings = [ ]
+        self.strings = USBStringTable()
 
         self.usb_spec_version           = spec_version
 
@@ -122,16 +124,9 @@ class USBDevice(USBDescribable):
         if isinstance(s, int):
             return s
 
-        # Otherwise, add the string to our list of strings and
+        # Otherwise, add the string to our string table and
         # report the index we assigned it.
-        try:
-            i = self.strings.index(s)
-        except ValueError:
-            # string descriptors start at index 1
-            self.strings.append(s)
-            i = len(self.strings)
-
-        return i
+        return self.strings.get_index(s)
 
     def setup_request_handlers(self):
         # see table 9-4 of USB 2.0 spec, page 279
@@ -252,12 +247,31 @@ class USBDevice(USBDescribable):
     def handle_data_available(self, ep_num, data):
         if self.state == USB.state_configured and ep_num in self.endpoints:
             endpoint = self.endpoints[ep_num]
+
+            # If the endpoint buffers its data, queue it up for any recv() calls.
+            if endpoint.receive_buffer is not None:
+                endpoint.receive_buffer.write(data)
+
             if callable(endpoint.handler):
                 endpoint.handler(data)
 
+    def can_accept_data(self, ep_num):
+        """
+        Returns true iff we're ready to receive more data on the given OUT endpoint.
+        While this is false, backends leave the endpoint un-armed, so the host is
+        NAK'd until we catch up.
+        """
+        return True
+
     def handle_buffer_available(self, ep_num):
         if self.state == USB.state_configured and ep_num in self.endpoints:
             endpoint = self.endpoints[ep_num]
+
+            # If the endpoint is streaming out a transfer, its buffer
+            # is spoken for; send the transfer's next packet.
+            if endpoint.send_next_streamed_packet():
+                return
+
             if callable(endpoint.handler):
                 endpoint.handler()
 
@@ -322,7 +336,12 @@ class USBDevice(USBDescribable):
 
         response = self.descriptors.get(dtype, None)
         if callable(response):
-            response = response(dindex)
+            # String descriptors are additionally selected by language, for
+            # handlers that accept one; older handlers take only the index.
+            if dtype == USB.desc_type_string and self._accepts_language(response):
+                response = response(dindex, lang)
+            else:
+                response = response(dindex)
 
         if response:
             n = min(n, len(response))
@@ -336,33 +355,22 @@ class USBDevice(USBDescribable):
         else:
             self.maxusb_app.stall_ep0()
 
+    @staticmethod
+    def _accepts_language(handler):
+        """ Returns true iff the given descriptor handler can be passed a language ID. """
+        # Handlers without an inspectable signature are assumed to take the legacy form.
+        try:
+            inspect.signature(handler).bind(0, 0)
+            return True
+        except (TypeError, ValueError):
+            return False
+
     def handle_get_configuration_descriptor_request(self, num):
         return self.configurations[num].get_descriptor()
 
-    def handle_get_string_descriptor_request(self, num):
-        if num == 0:
-            # HACK: hard-coding baaaaad
-            d = bytes([
-                    4,      # length of descriptor in bytes
-                    3,      # descriptor type 3 == string
-                    9,      # language code 0, byte 0
-                    4       # language code 0, byte 1
-            ])
-        else:
-            # string descriptors start at 1
-            s = self.strings[num-1].encode('utf-16')
-
-            # Linux doesn't like the leading 2-byte Byte Order Mark (BOM);
-            # FreeBSD is okay without it
-            s = s[2:]
-
-            d = bytearray([
-                    len(s) + 2,     # length of descriptor in bytes
-                    3               # descriptor type 3 == string
-            ])
-            d += s
-
-        return d
+    def handle_get_string_descriptor_request(self, num, lang=None):
+        # Descriptors are pre-encoded by our string table.
+        return self.strings.get_descriptor(num, lang)
 
     # USB 2.0 specification, section 9.4.8 (p 285 of pdf)
     def handle_set_descriptor_request(self, req):
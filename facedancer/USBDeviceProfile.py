@@ -0,0 +1,296 @@
+# USBDeviceProfile.py
+#
+# Contains class definitions for USBDeviceProfile, a compact serialized form
+# of an emulated device, and USBProfileDevice, which emulates a device from one.
+
+import struct
+
+from .USB import *
+from .USBDevice import USBDevice
+from .USBConfiguration import USBConfiguration
+
+
+class USBDeviceProfile:
+    """
+    A device "personality": the raw descriptors and static control responses
+    needed to present a device to a host, keyed by the SETUP packet that
+    requests them. Profiles can be captured from existing USBDevice objects,
+    saved to a compact binary file, and compiled back into an emulated device.
+    """
+
+    MAGIC   = b'FDDP'
+    VERSION = 1
+
+    # File header: magic, format version, name length, record count.
+    HEADER = struct.Struct('<4sBxHI')
+
+    # Each record: bmRequestType, bRequest, wValue, wIndex, response length;
+    # followed by the response itself.
+    RECORD = struct.Struct('<BBHHH')
+
+    GET_DESCRIPTOR_REQUEST = 6
+
+    def __init__(self, name=None, responses=None):
+        """
+        Creates a new device profile.
+
+        name: A human-readable name for the profile.
+        responses: A dictionary mapping (request_type, request, value, index)
+            tuples to the raw response for the relevant control request.
+        """
+        self.name      = name
+        self.responses = responses if responses else {}
+
+
+    def add_response(self, request_type, request, value, index, data):
+        """
+        Adds a static response to a control request.
+
+        request_type, request, value, index: The fields of the SETUP packet
+            this response answers. For OUT requests (direction bit clear), the
+            data should be empty; the request will simply be acknowledged.
+        data: The raw bytes to respond with.
+        """
+        self.responses[(request_type, request, value, index)] = bytes(data)
+
+
+    def add_descriptor(self, descriptor_type, descriptor_index, data, index=0,
+                       recipient=USB.request_recipient_device):
+        """
+        Adds a descriptor to the profile, served in response to GET_DESCRIPTOR.
+
+        descriptor_type: The USB.desc_type_* number of the descriptor.
+        descriptor_index: The index of the descriptor within its type.
+        data: The raw descriptor.
+        index: The wIndex for the request-- the language ID for strings, or the
+            interface number for interface-recipient descriptors.
+        recipient: The USB.request_recipient_* the request is addressed to.
+        """
+        request_type = 0x80 | recipient
+        value = (descriptor_type << 8) | descriptor_index
+        self.add_response(request_type, self.GET_DESCRIPTOR_REQUEST, value, index, data)
+
+
+    def get_descriptor(self, descriptor_type, descriptor_index=0, index=None,
+                       recipient=USB.request_recipient_device):
+        """
+        Returns a descriptor stored in the profile, or None if we don't have it.
+
+        index: The wIndex for the request. If not provided, or if we don't have
+            a descriptor for the given index, the first matching descriptor of any
+            index is returned.
+        """
+        request_type = 0x80 | recipient
+        value = (descriptor_type << 8) | descriptor_index
+
+        if index is not None:
+            descriptor = self.responses.get((request_type, self.GET_DESCRIPTOR_REQUEST, value, index))
+
+            if descriptor is not None:
+                return descriptor
+
+        for key, data in self.responses.items():
+            if key[0:3] == (request_type, self.GET_DESCRIPTOR_REQUEST, value):
+                return data
+
+        return None
+
+
+    @property
+    def device_descriptor(self):
+        return self.get_descriptor(USB.desc_type_device)
+
+
+    @property
+    def configuration_descriptors(self):
+        """ Returns the profile's configuration descriptors, in index order. """
+        descriptors = []
+
+        while True:
+            descriptor = self.get_descriptor(USB.desc_type_configuration, len(descriptors))
+            if descriptor is None:
+                return descriptors
+
+            descriptors.append(descriptor)
+
+
+    @classmethod
+    def from_device(cls, device, name=None):
+        """
+        Captures a profile from an existing USBDevice object, such as one of the
+        hand-written device emulations.
+
+        device: The USBDevice to be captured.
+        name: The name for the new profile; defaults to the device's name.
+        """
+        profile = cls(name if name else device.name)
+
+        profile.add_descriptor(USB.desc_type_device, 0, device.get_descriptor())
+
+        # Capture the string descriptors in each language, including the language ID table...
+        for string_index, language_id, descriptor in device.strings.descriptor_items():
+            profile.add_descriptor(USB.desc_type_string, string_index, descriptor, language_id)
+
+        # ... each configuration, and any class descriptors served by its interfaces.
+        for configuration_index, configuration in enumerate(device.configurations):
+            profile.add_descriptor(USB.desc_type_configuration, configuration_index, configuration.get_descriptor())
+
+            for interface in configuration.interfaces:
+                for descriptor_type, descriptor in interface.descriptors.items():
+                    if descriptor_type == USB.desc_type_interface:
+                        continue
+
+                    if callable(descriptor):
+                        descriptor = descriptor(0)
+
+                    if descriptor:
+                        profile.add_descriptor(descriptor_type, 0, descriptor, interface.number,
+                                               USB.request_recipient_interface)
+
+        return profile
+
+
+    def to_bytes(self):
+        """ Serializes the profile into its compact binary form. """
+        name = self.name.encode('utf-8') if self.name else b''
+        chunks = [self.HEADER.pack(self.MAGIC, self.VERSION, len(name), len(self.responses)), name]
+
+        for (request_type, request, value, index), data in self.responses.items():
+            chunks.append(self.RECORD.pack(request_type, request, value, index, len(data)))
+            chunks.append(data)
+
+        return b''.join(chunks)
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Deserializes a profile from its compact binary form. """
+        magic, version, name_length, record_count = cls.HEADER.unpack_from(data)
+
+        if magic != cls.MAGIC:
+            raise ValueError("not a Facedancer device profile")
+        if version != cls.VERSION:
+            raise ValueError("unsupported device profile version {}".format(version))
+
+        offset = cls.HEADER.size
+        name = bytes(data[offset:offset + name_length]).decode('utf-8')
+        offset += name_length
+
+        responses = {}
+        record = cls.RECORD
+
+        for _ in range(record_count):
+            request_type, request, value, index, length = record.unpack_from(data, offset)
+            offset += record.size
+
+            responses[(request_type, request, value, index)] = bytes(data[offset:offset + length])
+            offset += length
+
+        return cls(name if name else None, responses)
+
+
+    def save(self, filename):
+        """ Writes the profile to the given file. """
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+
+    @classmethod
+    def load(cls, filename):
+        """ Reads a profile from the given file. """
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+    def compile(self, maxusb_app, verbose=0, quirks=[], scheduler=None):
+        """
+        Builds an emulated device that presents this profile to the host.
+
+        maxusb_app: The Facedancer app that will host the emulated device.
+        """
+        return USBProfileDevice(maxusb_app, self, verbose=verbose, quirks=quirks, scheduler=scheduler)
+
+
+    def __repr__(self):
+        return "<USBDeviceProfile name={} responses={}>".format(self.name, len(self.responses))
+
+
+
+class USBProfileDevice(USBDevice):
+    """
+    Device emulated from a USBDeviceProfile. Descriptors and other static control
+    responses are served directly from the profile's prebuilt blobs; standard
+    requests that change device state (e.g. SET_ADDRESS, SET_CONFIGURATION) are
+    handled as for any other USBDevice.
+    """
+    name = "profiled USB device"
+
+    def __init__(self, maxusb_app, profile, verbose=0, quirks=[], scheduler=None):
+        """
+        Creates a new emulated device from a profile.
+
+        maxusb_app: The Facedancer app that will host the emulated device.
+        profile: The USBDeviceProfile to emulate.
+        """
+        self.profile   = profile
+        self.responses = profile.responses
+
+        if profile.name:
+            self.name = profile.name
+
+        device_descriptor = profile.device_descriptor
+        if device_descriptor is None:
+            raise ValueError("device profile has no device descriptor")
+
+        # The BCD fields are unpacked MSB-first, matching how USBDevice serializes
+        # them, so that a profile round-trips to the same spec_version and device_rev.
+        spec_version_msb, spec_version_lsb, device_class, device_subclass, protocol, \
+            max_packet_size_ep0, vendor_id, product_id, device_rev_msb, device_rev_lsb, \
+            manufacturer_string_index, product_string_index, serial_number_string_index, _ = \
+            struct.unpack_from('<xxBBBBBBHHBBBBBB', device_descriptor)
+
+        spec_version = (spec_version_msb << 8) | spec_version_lsb
+        device_rev = (device_rev_msb << 8) | device_rev_lsb
+
+        # Serve the descriptors from the profile, rather than regenerating them.
+        descriptors = {
+            USB.desc_type_device:           device_descriptor,
+            USB.desc_type_configuration:    self._get_profile_descriptor_callback(USB.desc_type_configuration),
+            USB.desc_type_string:           self._get_profile_descriptor_callback(USB.desc_type_string),
+        }
+
+        USBDevice.__init__(self, maxusb_app, device_class, device_subclass, protocol,
+                max_packet_size_ep0, vendor_id, product_id, device_rev, manufacturer_string_index,
+                product_string_index, serial_number_string_index, descriptors={},
+                spec_version=spec_version, verbose=verbose, quirks=quirks, scheduler=scheduler)
+
+        self.descriptors.update(descriptors)
+
+        # Parse the configurations only after base initialization, so their
+        # string indices are left as they appear in the descriptors.
+        self.configurations = [USBConfiguration.from_binary_descriptor(descriptor)
+                               for descriptor in profile.configuration_descriptors]
+
+        for configuration in self.configurations:
+            configuration.set_device(self)
+
+
+    def _get_profile_descriptor_callback(self, descriptor_type):
+        """ Returns a descriptor callback that looks up descriptors in our profile. """
+        return lambda descriptor_index, index=None : \
+            self.profile.get_descriptor(descriptor_type, descriptor_index, index)
+
+
+    def handle_request(self, req):
+        """
+        Answers requests with static responses from our profile where we have
+        them; and falls back to standard handling otherwise.
+        """
+        response = self.responses.get((req.request_type, req.request, req.value, req.index))
+
+        if response is None:
+            USBDevice.handle_request(self, req)
+        elif req.get_direction() == USB.request_direction_device_to_host:
+            self.send_control_message(response[:req.length])
+        else:
+            self.ack_status_stage()
@@ -2,7 +2,11 @@
 #
 # Contains class definition for USBEndpoint.
 
+import time
 import struct
+import threading
+import collections
+
 from .USB import *
 
 class USBEndpoint(USBDescribable):
@@ -27,7 +31,8 @@ class USBEndpoint(USBDescribable):
     usage_type_implicit_feedback = 0x02
 
     def __init__(self, number, direction, transfer_type, sync_type,
-            usage_type, max_packet_size, interval, handler=None, nak_callback=None):
+            usage_type, max_packet_size, interval, handler=None, nak_callback=None,
+            receive_buffer_size=None):
 
         self.number             = number
         self.direction          = direction
@@ -41,6 +46,14 @@ class USBEndpoint(USBDescribable):
 
         self.interface          = None
 
+        # Transfers queued by stream(), each as an iterator over its packets.
+        self.pending_transfers  = collections.deque()
+
+        # Buffer for data received on this endpoint, if enabled; see recv().
+        self.receive_buffer     = None
+        if receive_buffer_size:
+            self.enable_receive_buffer(receive_buffer_size)
+
         self.request_handlers   = {
                 1 : self.handle_clear_feature_request
         }
@@ -121,18 +134,398 @@ class USBEndpoint(USBDescribable):
         dev.maxusb_app.send_on_endpoint(self.number, data, blocking=blocking)
 
 
-    def send(self, data):
-        # Send the relevant data one packet at a time,
-        # chunking if we're larger than the max packet size.
-        # This matches the behavior of the MAX3420E.
-        while data:
-            packet = data[0:self.max_packet_size]
-            data = data[self.max_packet_size:]
+    def _packets(self, data, zero_length_packet=False):
+        """
+        Yields the packets that make up a transfer of the given data, each at
+        most max_packet_size bytes long.
+
+        data: The data to be sent. Can be any bytes-like object, a file-like
+            object (with readinto or read), or an iterable of bytes-like chunks.
+        zero_length_packet: If true, a zero-length packet will follow the
+            transfer if it would otherwise end on a full packet, so the host
+            sees a short packet marking the end of the transfer.
+        """
+        max_packet_size = self.max_packet_size
+        last_packet_size = 0
+
+        # Legacy support: accept lists of byte values, as well as lists of chunks.
+        if isinstance(data, list) and (not data or isinstance(data[0], int)):
+            data = bytes(data)
+
+        # Buffers: yield views into the original data, without copying.
+        try:
+            view = memoryview(data).cast('B')
+        except TypeError:
+            view = None
+
+        if view is not None:
+            for position in range(0, len(view), max_packet_size):
+                packet = view[position:position + max_packet_size]
+                last_packet_size = len(packet)
+                yield packet
+
+        # Files: read each packet directly into a buffer of its own, filling each
+        # packet completely, as a short read doesn't necessarily mean we've hit EOF.
+        elif hasattr(data, 'readinto') or hasattr(data, 'read'):
+            while True:
+                packet = bytearray(max_packet_size)
+                length = 0
+
+                while length < max_packet_size:
+                    if hasattr(data, 'readinto'):
+                        read = data.readinto(memoryview(packet)[length:])
+                    else:
+                        chunk = data.read(max_packet_size - length)
+                        read = len(chunk) if chunk else 0
+                        packet[length:length + read] = chunk if chunk else b''
+
+                    if not read:
+                        break
+
+                    length += read
+
+                if not length:
+                    break
+
+                last_packet_size = length
+                yield memoryview(packet)[:length]
+
+                if length < max_packet_size:
+                    break
+
+        # Iterables of chunks: yield whole packets from each chunk where we can,
+        # and only copy to join the pieces of packets that straddle two chunks.
+        else:
+            partial = bytearray()
+
+            for chunk in data:
+                chunk = memoryview(chunk).cast('B')
+                position = 0
+
+                if partial:
+                    position = max_packet_size - len(partial)
+                    partial += chunk[:position]
+
+                    if len(partial) < max_packet_size:
+                        continue
+
+                    last_packet_size = max_packet_size
+                    yield memoryview(bytes(partial))
+                    partial = bytearray()
+
+                while len(chunk) - position >= max_packet_size:
+                    last_packet_size = max_packet_size
+                    yield chunk[position:position + max_packet_size]
+                    position += max_packet_size
+
+                partial += chunk[position:]
+
+            if partial:
+                last_packet_size = len(partial)
+                yield memoryview(bytes(partial))
+
+        # If our transfer ended on a packet boundary, terminate it with a ZLP if desired.
+        if zero_length_packet and last_packet_size in (0, max_packet_size):
+            yield b''
+
+
+    def send(self, data, blocking=False, zero_length_packet=False):
+        """
+        Sends a transfer on this endpoint, one packet at a time, chunking the
+        data if it's larger than the max packet size. This matches the behavior
+        of the MAX3420E. Each packet is sent as soon as the backend will accept
+        it; see stream() for sending data without waiting.
+
+        data: The data to be sent: a bytes-like object, file-like object, or
+            an iterable of bytes-like chunks. See _packets().
+        blocking: If true, we'll wait for each packet to be sent.
+        zero_length_packet: If true, we'll terminate a transfer that ends on a
+            full packet with a zero-length packet.
+        """
+        for packet in self._packets(data, zero_length_packet):
+            self.send_packet(packet, blocking=blocking)
+
+
+    def stream(self, data, zero_length_packet=False):
+        """
+        Queues a transfer to be sent in the background. Rather than blocking
+        until the backend can accept each packet, we send one packet each time
+        the backend reports that the endpoint's buffer is available. Transfers
+        queued while another is streaming are sent once it completes.
+
+        Accepts the same arguments as send(). Note that streamed data is read
+        lazily; buffers shouldn't be modified until they've been sent.
+        """
+        self.pending_transfers.append(self._packets(data, zero_length_packet))
+
+
+    def is_streaming(self):
+        """ Returns true iff this endpoint has streamed data waiting to be sent. """
+        return bool(self.pending_transfers)
+
+
+    def send_next_streamed_packet(self):
+        """
+        Sends the next packet of any streamed transfers. Called when the backend
+        reports that our buffer is available.
+
+        returns: True iff a packet was sent.
+        """
+        while self.pending_transfers:
+            try:
+                packet = next(self.pending_transfers[0])
+            except StopIteration:
+                self.pending_transfers.popleft()
+                continue
 
             self.send_packet(packet)
+            return True
+
+        return False
+
+
+    def enable_receive_buffer(self, size=65536):
+        """
+        Buffers the data received on this (OUT) endpoint, so it can be read using
+        recv() and its related functions-- e.g. from a worker thread, while the
+        main loop keeps servicing the bus. Any handler is still called as well.
+
+        size: The maximum number of bytes to buffer. Packets that arrive while the
+            buffer is full are dropped, and counted in the buffer's statistics.
+        """
+        self.receive_buffer = USBReceiveBuffer(size)
+
+
+    def recv(self, length=None, timeout=None):
+        """
+        Receives data from this endpoint.
+
+        Without a receive buffer, this reads directly from the backend, and the
+        arguments are ignored. With one, this returns up to length bytes (or all
+        buffered data, if length is None) as soon as any are available.
+
+        timeout: The maximum time to wait for data, in seconds; or None to wait
+            indefinitely. If no data arrives in time, an empty bytes is returned.
+        """
+        if self.receive_buffer is None:
+            dev = self.interface.configuration.device
+            data = dev.maxusb_app.read_from_endpoint(self.number)
+            return data
+
+        data = self.receive_buffer.read(length, 1, timeout)
+        return data if data is not None else b''
+
+
+    def recv_exact(self, length, timeout=None):
+        """
+        Receives exactly length bytes from this endpoint's receive buffer.
+
+        timeout: The maximum time to wait for the full length, in seconds; or
+            None to wait indefinitely. Raises TimeoutError if it expires; in which
+            case, no data is consumed.
+
+        Raises ValueError if length is larger than the receive buffer, as the data
+        could never all be buffered at once.
+        """
+        data = self._require_receive_buffer().read(length, length, timeout)
+
+        if data is None:
+            raise TimeoutError("timed out waiting for {} bytes on endpoint {}".format(length, self.number))
+
+        return data
+
+
+    def recv_until(self, delimiter, timeout=None):
+        """
+        Receives data from this endpoint's receive buffer up to and including
+        the next occurrence of delimiter.
+
+        timeout: The maximum time to wait, in seconds; or None to wait
+            indefinitely. Raises TimeoutError if it expires.
+        """
+        data = self._require_receive_buffer().read_until(delimiter, timeout)
+
+        if data is None:
+            raise TimeoutError("timed out waiting for delimiter on endpoint {}".format(self.number))
+
+        return data
+
+
+    def recv_message(self, header, length_of, timeout=None):
+        """
+        Receives a single length-prefixed message from this endpoint's receive buffer.
+
+        header: A struct.Struct (or struct format string) describing the message header.
+        length_of: A function that accepts the unpacked header fields, and returns
+            the total length of the message, including the header.
+        timeout: The maximum time to wait for the full message, in seconds; or
+            None to wait indefinitely. Raises TimeoutError if it expires.
+
+        returns: The raw bytes of the whole message. Raises ValueError if the message
+            is larger than the receive buffer.
+        """
+        if not isinstance(header, struct.Struct):
+            header = struct.Struct(header)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        receive_buffer = self._require_receive_buffer()
+
+        # Peek at the header to figure out how long our message is...
+        raw_header = receive_buffer.peek(header.size, timeout)
+        if raw_header is None:
+            raise TimeoutError("timed out waiting for a message header on endpoint {}".format(self.number))
+
+        length = max(length_of(header.unpack(raw_header)), header.size)
+
+        # ... and then read the whole thing.
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        return self.recv_exact(length, remaining)
+
+
+    def _require_receive_buffer(self):
+        if self.receive_buffer is None:
+            raise ValueError("endpoint {} doesn't have a receive buffer".format(self.number))
+
+        return self.receive_buffer
+
+
+
+class USBReceiveBuffer:
+    """
+    Bounded, thread-safe ring buffer that holds data received on an endpoint
+    until it's consumed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+
+        # Position of the oldest buffered byte, and the number of bytes buffered.
+        self.head = 0
+        self.count = 0
+
+        # Statistics for data we've had to drop.
+        self.dropped_packets = 0
+        self.dropped_bytes = 0
+
+        self.condition = threading.Condition()
+
+
+    def __len__(self):
+        return self.count
+
+
+    def write(self, data):
+        """
+        Adds received data to the buffer, waking any readers. If the data won't fit,
+        it's dropped whole, so the buffer never contains partial packets.
+
+        returns: True iff the data was buffered.
+        """
+        length = len(data)
+
+        with self.condition:
+            if length > self.size - self.count:
+                self.dropped_packets += 1
+                self.dropped_bytes += length
+                return False
+
+            # Copy the data in at our tail, wrapping around the end of the buffer if necessary.
+            tail = (self.head + self.count) % self.size
+            first = min(length, self.size - tail)
+
+            self.buffer[tail:tail + first] = data[:first]
+            self.buffer[:length - first] = data[first:]
+
+            self.count += length
+            self.condition.notify_all()
+
+        return True
+
+
+    def _copy_out(self, length):
+        """ Returns the oldest length bytes in the buffer, without consuming them. """
+        first = min(length, self.size - self.head)
+        data = self.buffer[self.head:self.head + first]
+
+        if first < length:
+            data += self.buffer[:length - first]
+
+        return bytes(data)
+
+
+    def _consume(self, length):
+        self.head = (self.head + length) % self.size
+        self.count -= length
+
+
+    def _check_fits(self, length):
+        if length > self.size:
+            raise ValueError("can't wait for {} bytes in a {}-byte receive buffer".format(length, self.size))
+
+
+    def _wait_for(self, predicate, timeout):
+        """ Waits for the given predicate to become true; must be called with our lock held. """
+        return self.condition.wait_for(predicate, timeout)
+
+
+    def read(self, length=None, minimum=1, timeout=None):
+        """
+        Reads and consumes up to length bytes from the buffer, once at least
+        minimum bytes are available.
+
+        returns: The data read, or None if timeout seconds elapse first. Raises
+            ValueError if minimum is larger than the buffer, as it could never be met.
+        """
+        self._check_fits(minimum)
+
+        with self.condition:
+            if not self._wait_for(lambda: self.count >= minimum, timeout):
+                return None
+
+            length = self.count if length is None else min(length, self.count)
+            data = self._copy_out(length)
+            self._consume(length)
 
-    def recv(self):
-        dev = self.interface.configuration.device
-        data = dev.maxusb_app.read_from_endpoint(self.number)
         return data
 
+
+    def peek(self, length, timeout=None):
+        """
+        Returns the next length bytes in the buffer without consuming them, waiting
+        for them to arrive if necessary.
+
+        returns: The data, or None if timeout seconds elapse first. Raises
+            ValueError if length is larger than the buffer.
+        """
+        self._check_fits(length)
+
+        with self.condition:
+            if not self._wait_for(lambda: self.count >= length, timeout):
+                return None
+
+            return self._copy_out(length)
+
+
+    def read_until(self, delimiter, timeout=None):
+        """
+        Reads and consumes data up to and including the next occurrence of delimiter.
+
+        returns: The data read, or None if timeout seconds elapse first.
+        """
+        delimiter = bytes(delimiter)
+        found = []
+
+        def delimiter_end():
+            position = self._copy_out(self.count).find(delimiter)
+            found[:] = [position + len(delimiter)] if position >= 0 else []
+            return bool(found)
+
+        with self.condition:
+            if not self._wait_for(delimiter_end, timeout):
+                return None
+
+            data = self._copy_out(found[0])
+            self._consume(found[0])
+
+        return data
@@ -0,0 +1,392 @@
+# USBHostFuzzer.py
+#
+# Contains class definitions for USBHostFuzzer, which uses a FacedancerUSBHost
+# to fuzz a device's control endpoint.
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+
+from .errors import *
+from .core import FacedancerUSBHost
+
+
+class USBControlFuzzCase:
+    """ A single control request generated by the fuzzer. """
+
+    __slots__ = ('index', 'is_in', 'request_type', 'recipient', 'request', 'value', 'index_field', 'length', 'data')
+
+    def __init__(self, index, is_in, request_type, recipient, request, value, index_field, length, data=b''):
+        self.index        = index
+        self.is_in        = is_in
+        self.request_type = request_type
+        self.recipient    = recipient
+        self.request      = request
+        self.value        = value
+        self.index_field  = index_field
+        self.length       = length
+        self.data         = data
+
+
+    def setup_packet(self):
+        """ Returns the raw SETUP packet for this request. """
+        return bytes(FacedancerUSBHost._build_setup_request(self.is_in, self.request_type, self.recipient,
+            self.request, self.value, self.index_field, self.length if self.is_in else len(self.data)))
+
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'setup': self.setup_packet().hex(),
+            'data':  bytes(self.data).hex(),
+        }
+
+
+    def __repr__(self):
+        return "<USBControlFuzzCase {} setup={} data={}>".format(self.index, self.setup_packet().hex(),
+            bytes(self.data).hex() if self.data else "none")
+
+
+
+class USBHostFuzzer:
+    """
+    Fuzzes a device's control endpoint from a Facedancer acting as its host.
+
+    Requests are generated from a seeded grammar of the standard, class and vendor
+    request spaces: standard requests use their real request numbers, with values
+    that are mostly plausible; class and vendor requests are aimed at the device's
+    real interfaces and endpoints, with boundary values in every field. Case n of a
+    given seed is always the same request, so any case can be regenerated with
+    generate_case().
+
+    Responses are hashed; any case that produces a response (or an error) we haven't
+    seen before is interesting, and is saved to our corpus. If the device stops
+    responding or disconnects, it's reset and re-enumerated as quickly as possible,
+    and the case that caused it is saved as a crash.
+    """
+
+    REQUEST_SPACES = ('standard', 'class', 'vendor')
+
+    # Standard requests we generate, by request number: the direction, the
+    # recipients they make sense for, and a weight. SET_ADDRESS is left out, as it
+    # would only make the device disappear from our view.
+    STANDARD_REQUESTS = {
+        0x00: (True,  (0, 1, 2), 2),    # GET_STATUS
+        0x01: (False, (0, 1, 2), 1),    # CLEAR_FEATURE
+        0x03: (False, (0, 1, 2), 1),    # SET_FEATURE
+        0x06: (True,  (0,),      8),    # GET_DESCRIPTOR
+        0x07: (False, (0,),      1),    # SET_DESCRIPTOR
+        0x08: (True,  (0,),      1),    # GET_CONFIGURATION
+        0x09: (False, (0,),      1),    # SET_CONFIGURATION
+        0x0A: (True,  (1,),      2),    # GET_INTERFACE
+        0x0B: (False, (1,),      1),    # SET_INTERFACE
+        0x0C: (True,  (2,),      1),    # SYNCH_FRAME
+    }
+
+    # Descriptor types worth asking for; the standard types, plus class-specific ones.
+    DESCRIPTOR_TYPES = (0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x0B, 0x0F, 0x10, 0x21, 0x22, 0x23, 0x24, 0x25, 0x29, 0x2A)
+
+    # Values most likely to find edge cases in 16-bit fields, and in lengths.
+    BOUNDARY_VALUES = (0x0000, 0x0001, 0x0002, 0x007F, 0x0080, 0x00FF, 0x0100, 0x7FFF, 0x8000, 0xFFFE, 0xFFFF)
+    BOUNDARY_LENGTHS = (0, 1, 2, 7, 8, 9, 18, 63, 64, 65, 255, 256, 512, 1024, 4095, 4096)
+
+    # The number of cases generated from each seed of our random number generator.
+    CASES_PER_BATCH = 1024
+
+    # The bus reset delay used when recovering; much shorter than enumeration's usual
+    # delay, as the device has been connected all along.
+    RECOVERY_RESET_DELAY = 0.02
+
+    def __init__(self, host, seed=None, spaces=REQUEST_SPACES, address=1, configuration=1,
+                 corpus_directory=None, recovery_timeout=10, verbose=0):
+        """
+        Sets up a new fuzzer. The device should already have been initialized by the
+        host, e.g. with initialize_device(), using the given address and configuration.
+
+        host: The FacedancerUSBHost connected to the device to be fuzzed.
+        seed: The seed for our request grammar. If not provided, one is chosen at
+            random; either way, it's available as our seed attribute.
+        spaces: The request spaces to fuzz; any of 'standard', 'class' and 'vendor'.
+        address, configuration: The address and configuration to restore when the
+            device needs to be re-enumerated.
+        corpus_directory: If provided, interesting cases and crashes are saved here.
+        recovery_timeout: How long to wait for the device to come back after a
+            crash, in seconds.
+        """
+        unknown = set(spaces) - set(self.REQUEST_SPACES)
+        if unknown:
+            raise ValueError("unknown request spaces {}".format(", ".join(unknown)))
+
+        self.host = host
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        self.spaces = tuple(spaces)
+        self.address = address
+        self.configuration = configuration
+        self.recovery_timeout = recovery_timeout
+        self.verbose = verbose
+
+        # Find the interfaces and endpoints that class and vendor requests can target.
+        configuration_descriptor = host.get_configuration_descriptor(configuration - 1)
+        self.interface_numbers = sorted(set(interface.number for interface in configuration_descriptor.interfaces)) or [0]
+        self.endpoint_addresses = sorted(set(endpoint.get_address() for interface in configuration_descriptor.interfaces
+                                             for endpoint in interface.endpoints)) or [0]
+
+        # The weighted list of standard requests we generate from.
+        self.standard_requests = [request for request, (_, _, weight) in sorted(self.STANDARD_REQUESTS.items())
+                                  for _ in range(weight)]
+
+        self.batch = None
+        self.batch_number = None
+
+        # Hashes of every response we've seen.
+        self.seen_responses = set()
+
+        self.cases_run = 0
+        self.stalls = 0
+        self.crashes = 0
+        self.interesting = 0
+        self.recovery_time = 0.0
+        self.started = None
+        self.elapsed = 0.0
+
+        self.corpus_file = None
+        self.crash_file = None
+        if corpus_directory:
+            os.makedirs(corpus_directory, exist_ok=True)
+            self.corpus_file = open(os.path.join(corpus_directory, "corpus-{}.jsonl".format(self.seed)), 'a')
+            self.crash_file = open(os.path.join(corpus_directory, "crashes-{}.jsonl".format(self.seed)), 'a')
+
+
+    def close(self):
+        """ Closes our corpus files. """
+        for f in (self.corpus_file, self.crash_file):
+            if f:
+                f.close()
+
+        self.corpus_file = self.crash_file = None
+
+
+    #
+    # Case generation.
+    #
+
+    def generate_case(self, index):
+        """ Returns the control request for the given case number. """
+        batch_number, offset = divmod(index, self.CASES_PER_BATCH)
+
+        if batch_number != self.batch_number:
+            self.batch = self._generate_batch(batch_number)
+            self.batch_number = batch_number
+
+        return self.batch[offset]
+
+
+    def _generate_batch(self, batch_number):
+        """ Generates a batch of cases, which depend only on our seed and the batch number. """
+        rng = random.Random("{}:{}".format(self.seed, batch_number))
+        first = batch_number * self.CASES_PER_BATCH
+
+        return [self._generate_request(rng, first + offset) for offset in range(self.CASES_PER_BATCH)]
+
+
+    def _boundary_or_random(self, rng):
+        return rng.choice(self.BOUNDARY_VALUES) if rng.random() < 0.5 else rng.getrandbits(16)
+
+
+    def _generate_request(self, rng, index):
+        space = rng.choice(self.spaces)
+
+        if space == 'standard':
+            request = rng.choice(self.standard_requests)
+            is_in, recipients, _ = self.STANDARD_REQUESTS[request]
+            recipient = rng.choice(recipients)
+            request_type = FacedancerUSBHost.REQUEST_TYPE_STANDARD
+
+            if request == FacedancerUSBHost.STANDARD_REQUEST_GET_DESCRIPTOR:
+                value = (rng.choice(self.DESCRIPTOR_TYPES) << 8) | (rng.randrange(4) if rng.random() < 0.8 else rng.getrandbits(8))
+                index_field = rng.choice((0, 0x0409)) if rng.random() < 0.8 else rng.getrandbits(16)
+            else:
+                value = rng.randrange(4) if rng.random() < 0.7 else self._boundary_or_random(rng)
+                index_field = self._target_index(rng, recipient)
+        else:
+            request_type = FacedancerUSBHost.REQUEST_TYPE_CLASS if space == 'class' else FacedancerUSBHost.REQUEST_TYPE_VENDOR
+            is_in = rng.random() < 0.5
+            recipient = rng.choice((0, 1, 1, 1, 2)) if space == 'class' else rng.choice((0, 0, 1, 2))
+            request = rng.getrandbits(8)
+            value = self._boundary_or_random(rng)
+            index_field = self._target_index(rng, recipient)
+
+        length = rng.choice(self.BOUNDARY_LENGTHS) if rng.random() < 0.7 else rng.randrange(4097)
+
+        if is_in:
+            data = b''
+        else:
+            length = min(length, 64)
+            data = bytes(rng.getrandbits(8) for _ in range(length))
+
+        return USBControlFuzzCase(index, is_in, request_type, recipient, request, value, index_field, length, data)
+
+
+    def _target_index(self, rng, recipient):
+        """ Generates a wIndex value, usually aimed at one of the device's real interfaces or endpoints. """
+        if rng.random() < 0.2:
+            return self._boundary_or_random(rng)
+        if recipient == FacedancerUSBHost.REQUEST_RECIPIENT_INTERFACE:
+            return rng.choice(self.interface_numbers)
+        if recipient == FacedancerUSBHost.REQUEST_RECIPIENT_ENDPOINT:
+            return rng.choice(self.endpoint_addresses)
+        return 0
+
+
+    #
+    # Execution.
+    #
+
+    def run_case(self, case):
+        """
+        Issues a single case to the device.
+
+        returns: An (outcome, response) tuple; outcome is 'ok', 'stall' or 'crash'.
+            Crashes are recorded to our crash file as they happen. Raises
+            DeviceNotFoundError if the device doesn't recover from a crash.
+        """
+        host = self.host
+
+        try:
+            if case.is_in:
+                response = host.control_request_in(case.request_type, case.recipient, case.request,
+                                                   case.value, case.index_field, case.length)
+            else:
+                response = host.control_request_out(case.request_type, case.recipient, case.request,
+                                                    case.value, case.index_field, case.data)
+
+            return 'ok', bytes(response) if response else b''
+
+        except IOError:
+            self.stalls += 1
+
+        # A stall is usually just the device rejecting the request; make sure it's
+        # still responding before we carry on.
+        if self._device_responds():
+            return 'stall', b''
+
+        # Record the crash before trying to recover, so it's kept even if the
+        # device never comes back.
+        if self.crash_file:
+            self._record(self.crash_file, case, 'crash', b'')
+
+        self._recover()
+        return 'crash', b''
+
+
+    def _device_responds(self):
+        """ Returns true iff the device answers a GET_STATUS request. """
+        host = self.host
+
+        try:
+            return host.device_is_connected() and \
+                host.control_request_in(host.REQUEST_TYPE_STANDARD, host.REQUEST_RECIPIENT_DEVICE,
+                                        host.STANDARD_REQUEST_GET_STATUS, length=2) is not None
+        except IOError:
+            return False
+
+
+    def _recover(self):
+        """ Resets and re-enumerates the device, after it's stopped responding. """
+        started = time.monotonic()
+        deadline = started + self.recovery_timeout
+        self.crashes += 1
+
+        if self.verbose > 0:
+            print("-- device stopped responding; re-enumerating --", file=sys.stderr)
+
+        try:
+            while True:
+                try:
+                    self.host.bus_reset(delay=self.RECOVERY_RESET_DELAY)
+
+                    # Enumeration is mostly served from the host's descriptor cache.
+                    self.host.initialize_device(apply_configuration=self.configuration, assign_address=self.address,
+                                                timeout=max(deadline - time.monotonic(), 0))
+                    return
+
+                except IOError:
+                    if time.monotonic() >= deadline:
+                        raise DeviceNotFoundError("Device didn't recover within {}s!".format(self.recovery_timeout))
+        finally:
+            self.recovery_time += time.monotonic() - started
+
+
+    def _record(self, f, case, outcome, response):
+        record = case.to_dict()
+        record.update({'seed': self.seed, 'outcome': outcome, 'response': response.hex()})
+
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+
+
+    def fuzz(self, count=None, duration=None, first_case=0, report_interval=None):
+        """
+        Runs the fuzzer.
+
+        count: The number of cases to run; or None to run indefinitely.
+        duration: The longest to run for, in seconds; or None to run indefinitely.
+        first_case: The case to start from, e.g. to resume an earlier run.
+        report_interval: If provided, a summary is printed every report_interval seconds.
+
+        returns: The number of the next case to run.
+        """
+        self.started = started = time.monotonic()
+        last_report = started
+        index = first_case
+        end = first_case + count if count is not None else None
+        seen_responses = self.seen_responses
+
+        try:
+            while end is None or index < end:
+                case = self.generate_case(index)
+                outcome, response = self.run_case(case)
+                index += 1
+                self.cases_run += 1
+
+                # Cases that produce something new are worth keeping.
+                digest = hashlib.blake2b(response, digest_size=16, person=outcome.encode()).digest()
+                if digest not in seen_responses:
+                    seen_responses.add(digest)
+                    self.interesting += 1
+
+                    if self.corpus_file:
+                        self._record(self.corpus_file, case, outcome, response)
+
+                now = time.monotonic()
+                if duration is not None and now - started >= duration:
+                    break
+                if report_interval and now - last_report >= report_interval:
+                    print(self.summary(), file=sys.stderr)
+                    last_report = now
+        finally:
+            self.elapsed += time.monotonic() - started
+            self.started = None
+
+        return index
+
+
+    #
+    # Metrics.
+    #
+
+    @property
+    def requests_per_second(self):
+        """ The rate at which we've issued cases, including time spent recovering. """
+        elapsed = self.elapsed + (time.monotonic() - self.started if self.started else 0)
+        return self.cases_run / elapsed if elapsed else 0.0
+
+
+    def summary(self):
+        """ Returns a human-readable summary of the fuzzer's progress. """
+        return "-- fuzzer (seed {}): {} requests, {:.1f}/s; {} stalls, {} crashes, {:.1f}s recovering; " \
+               "{} unique responses --".format(self.seed, self.cases_run, self.requests_per_second,
+                self.stalls, self.crashes, self.recovery_time, self.interesting)
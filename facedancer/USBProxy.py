@@ -13,6 +13,12 @@ from facedancer.USBInterface import *
 from facedancer.USBEndpoint import *
 from facedancer.USBVendor import *
 from facedancer.errors import *
+from facedancer.USBProxyWorkers import USBProxyInEndpointReader, USBProxyOutEndpointWriter
+
+import time
+import array
+import functools
+import collections
 
 import usb
 from usb.core import USBError
@@ -23,6 +29,34 @@ class USBProxyFilter:
     Base class for filters that modify USB data.
     """
 
+    # The filter hooks called by USBProxyDevice. Hooks a filter doesn't override
+    # are skipped entirely, so filters need only implement the ones they use.
+    HOOKS = ('filter_control_in_setup', 'filter_control_in', 'filter_control_out',
+             'handle_out_request_complete', 'handle_out_request_stall', 'filter_in_token',
+             'filter_in', 'filter_out', 'handle_out_stall')
+
+    # Hooks that apply to traffic on a single non-control endpoint.
+    ENDPOINT_HOOKS = ('filter_in_token', 'filter_in', 'filter_out', 'handle_out_stall')
+
+    # The endpoint numbers whose traffic this filter wants to see, or None for
+    # all endpoints. Only affects the endpoint hooks; filters are selected by the
+    # endpoint the traffic arrived on.
+    endpoints = None
+
+
+    def handles(self, hook_name):
+        """
+        Returns true iff this filter should be called for the given hook. By default,
+        a filter handles each hook it overrides.
+        """
+        return getattr(type(self), hook_name) is not getattr(USBProxyFilter, hook_name)
+
+
+    def handles_endpoint(self, ep_num):
+        """ Returns true iff this filter wants to see traffic on the given endpoint. """
+        return self.endpoints is None or ep_num in self.endpoints
+
+
     def filter_control_in_setup(self, req, stalled):
         """
         Filters a SETUP stage for an IN control request. This allows us to modify
@@ -73,6 +107,18 @@ class USBProxyFilter:
         return req, data
 
 
+    def handle_out_request_complete(self, req, data):
+        """
+        Handles an OUT request that was accepted by the proxied device.
+
+        req: The request header for the request that completed.
+        data: The data stage for the request, if appropriate.
+
+        returns: The arguments, for the next filter.
+        """
+        return req, data
+
+
     def handle_out_request_stall(self, req, data, stalled):
         """
         Handles an OUT request that was stalled by the proxied device.
@@ -144,18 +190,104 @@ class USBProxyFilter:
 class USBProxyDevice(USBDevice):
     name = "Proxy'd USB Device"
 
-    filter_list = []
+    GET_DESCRIPTOR_REQUEST    = 6
+    SET_CONFIGURATION_REQUEST = 9
+    SET_INTERFACE_REQUEST     = 11
 
-    def __init__(self, maxusb_app, verbose=0, index=0, quirks=[], scheduler=None, **kwargs):
+    # The number of packets buffered for IN endpoints we read in the background
+    # for other reasons-- polling, or in_transfer_size-- without in_buffer_depth.
+    DEFAULT_IN_BUFFER_DEPTH   = 16
+
+    def __init__(self, maxusb_app, verbose=0, index=0, quirks=[], scheduler=None,
+                 in_buffer_depth=0, out_queue_depth=64, cache_descriptors=False,
+                 interrupt_mode='queued', statistics=None, in_transfer_size=None, in_transfer_timeout=1000,
+                 libusb_device=None, **kwargs):
         """
         Sets up a new USBProxy instance.
-        """
+
+        libusb_device: The pyusb device to be proxied. If not provided, we proxy the
+            index'th device matching the remaining keyword arguments, which are
+            passed to usb.core.find.
+
+        in_buffer_depth: If nonzero, the number of packets to read ahead on each of
+            the proxied device's IN endpoints. Reads are kept outstanding in the
+            background, so the host's IN tokens can be answered without waiting on
+            the proxied device. Note that any packets read ahead but not yet sent
+            when the device is reconfigured or disconnected are discarded-- having
+            been read from the proxied device, but never seen by the host-- and
+            counted as 'discarded' events. By default, we read synchronously when
+            the host asks.
+        out_queue_depth: The number of packets to queue for each of the proxied
+            device's OUT endpoints. Data from the host is written to the proxied
+            device in the background; once an endpoint's queue is full, the host
+            is NAK'd until there's room. Stalls are reported to the filters'
+            handle_out_stall later, from the main loop, and stall the affected
+            endpoint. Set to zero to instead write synchronously as data arrives.
+        cache_descriptors: If true, responses to standard GET_DESCRIPTOR requests
+            are cached, and repeated requests are answered without asking the
+            proxied device. The cache is cleared whenever the host changes the
+            device's configuration or alternate settings.
+        interrupt_mode: How to proxy the device's interrupt IN endpoints. These are
+            polled continuously once the device is configured (libusb issues the
+            transfers on each endpoint's bInterval), and reports are handed to the
+            Facedancer as soon as its endpoint buffer is free, rather than when the
+            host is NAK'd. In 'queued' mode, every report is passed on, in order;
+            in 'latest' mode, only the newest report is kept. If None, interrupt
+            endpoints are proxied on NAK, like bulk endpoints.
+        statistics: A USBProxyStatistics object. If provided, each stage of every
+            proxied transfer is timed, and NAKs, stalls and timeouts are counted.
+        in_transfer_size: If provided, the amount of data to request from the proxied
+            device with each read on a bulk IN endpoint, once it's partway through
+            a transfer; responses are split back into packets for the host. This
+            greatly reduces the number of libusb calls for large transfers. But if
+            one of these reads times out, the data it received is lost; so only use
+            this with devices that never pause mid-transfer for longer than
+            in_transfer_timeout. After a timeout, the endpoint falls back to reading
+            a packet at a time. See USBProxyInEndpointReader.
+        in_transfer_timeout: The timeout for each in_transfer_size read, in milliseconds.
+        """
+
+        # Our filters, in the order they're applied; and, for each hook, the
+        # bound hook methods of those filters that implement it.
+        self.filter_list = []
+        self._compile_filters()
+
+        self.in_buffer_depth = in_buffer_depth
+        self.in_transfer_size = in_transfer_size
+        self.in_transfer_timeout = in_transfer_timeout
+        self.in_readers = {}
+
+        if interrupt_mode not in ('queued', 'latest', None):
+            raise ValueError("unknown interrupt mode {}".format(interrupt_mode))
+
+        # The interrupt IN endpoints we're polling, by endpoint number.
+        self.interrupt_mode = interrupt_mode
+        self.polled_endpoints = {}
+
+        self.out_queue_depth = out_queue_depth
+        self.out_writers = {}
+
+        # OUT transfers that failed in the background, waiting to be handled; each
+        # is tagged with the configuration generation of the writer that failed it.
+        self.pending_out_stalls = collections.deque()
+        self.out_generation = 0
+
+        # Cached descriptor responses, keyed by (request_type, value, index); each
+        # entry holds the length requested and the proxied device's response.
+        self.cache_descriptors = cache_descriptors
+        self.descriptor_cache = {}
+        self.descriptor_cache_hits = 0
+
+        self.statistics = statistics
 
         # Open a connection to the proxied device...
-        usb_devices = list(usb.core.find(find_all=True, **kwargs))
-        if len(usb_devices) <= index:
-            raise DeviceNotFoundError("Could not find device to proxy!")
-        self.libusb_device = usb_devices[index]
+        if libusb_device is None:
+            usb_devices = list(usb.core.find(find_all=True, **kwargs))
+            if len(usb_devices) <= index:
+                raise DeviceNotFoundError("Could not find device to proxy!")
+            libusb_device = usb_devices[index]
+
+        self.libusb_device = libusb_device
 
         # If possible, detach the device from any kernel-side driver that may prevent us
         # from communicating with it.
@@ -169,6 +301,12 @@ class USBProxyDevice(USBDevice):
         # We'll do almost nothing, as we'll be proxying packets by default to the device.
         USBDevice.__init__(self, maxusb_app, verbose=verbose, quirks=quirks, scheduler=scheduler)
 
+        # Handle events from our background workers as part of the main loop.
+        self.scheduler.add_task(self._handle_pending_out_stalls)
+
+        if statistics:
+            self.scheduler.add_task(statistics.service)
+
 
     def connect(self):
         """
@@ -183,26 +321,185 @@ class USBProxyDevice(USBDevice):
         self.state = USB.state_powered
 
 
-    def configured(self, configuration):
+    def configured(self, configuration, endpoints=None):
         """
         Callback that handles when the target device becomes configured.
         If you're using the standard filters, this will be called automatically;
         if not, you'll have to call it once you know the device has been configured.
 
         configuration: The configuration to be applied.
+        endpoints: A dictionary mapping endpoint numbers to the configuration's
+            endpoints, if one's already been built; otherwise, we'll build it.
         """
 
+        # Any data read ahead or queued for the previous configuration is now stale.
+        # We don't wait for the proxied device to accept queued data, which could
+        # take a long time; and we ignore any stalls from the old writers, which
+        # apply to endpoints that no longer exist.
+        self._stop_in_readers()
+        self._stop_out_writers(discard=True)
+
         # Gather the configuration's endpoints for easy access, later...
-        self.endpoints = {}
-        for interface in configuration.interfaces:
-            for endpoint in interface.endpoints:
-                self.endpoints[endpoint.number] = endpoint
+        if endpoints is None:
+            endpoints = {endpoint.number: endpoint for interface in configuration.interfaces
+                         for endpoint in interface.endpoints}
+
+        self.endpoints = dict(endpoints)
+        self.polled_endpoints = {}
+
+        if self.interrupt_mode:
+            for endpoint in self.endpoints.values():
+                if endpoint.direction == USBEndpoint.direction_in and \
+                   endpoint.transfer_type == USBEndpoint.transfer_type_interrupt:
+                    self.polled_endpoints[endpoint.number] = endpoint
+
+        # ... start polling any interrupt endpoints, so reports are ready as soon as the host asks ...
+        for endpoint in self.polled_endpoints.values():
+            self._get_in_reader(endpoint.number, endpoint.max_packet_size)
 
         # ... and pass our configuration on to the core device.
         self.maxusb_app.configured(configuration)
+        self._release_configuration()
+        self.configuration = configuration
         configuration.set_device(self)
 
 
+    def _release_configuration(self):
+        """
+        Unbinds our current configuration from this device, so a cached copy can
+        be reused by later proxy sessions.
+        """
+        if self.configuration is not None and self.configuration.device is self:
+            self.configuration.set_device(None)
+
+        self.configuration = None
+
+
+    def disconnect(self):
+        """
+        Disconnects from the target host, and stops any background transfers.
+        """
+        self._stop_in_readers()
+        self._stop_out_writers()
+        USBDevice.disconnect(self)
+        self._release_configuration()
+
+        if self.statistics and self.statistics.export_filename:
+            self.statistics.export()
+
+
+    def _get_in_reader(self, ep_num, max_packet_size):
+        """
+        Returns the background reader for the given proxied IN endpoint, starting
+        one if we don't yet have it.
+        """
+        reader = self.in_readers.get(ep_num)
+
+        if reader is None:
+            if self.interrupt_mode == 'latest' and ep_num in self.polled_endpoints:
+                reader = USBProxyInEndpointReader(self.libusb_device, ep_num, max_packet_size,
+                    depth=1, keep_latest=True, statistics=self.statistics)
+            else:
+                endpoint = self.endpoints.get(ep_num)
+                is_bulk = endpoint is not None and endpoint.transfer_type == USBEndpoint.transfer_type_bulk
+
+                reader = USBProxyInEndpointReader(self.libusb_device, ep_num, max_packet_size,
+                    self.in_buffer_depth or self.DEFAULT_IN_BUFFER_DEPTH, statistics=self.statistics,
+                    transfer_size=self.in_transfer_size if is_bulk else None,
+                    transfer_timeout=self.in_transfer_timeout)
+
+            reader.start()
+            self.in_readers[ep_num] = reader
+
+        return reader
+
+
+    def _stop_in_readers(self):
+        """
+        Stops all background readers, discarding any data they've buffered. This
+        data has already been consumed from the proxied device, so the host will
+        never see it; each discarded packet is counted in our statistics.
+        """
+        for ep_num, reader in self.in_readers.items():
+            discarded = reader.stop()
+
+            if discarded:
+                if self.statistics:
+                    self.statistics.record_event(ep_num | 0x80, 'discarded', discarded)
+                if self.verbose > 0:
+                    print("-- Discarded {} unread packet(s) from EP{} IN --".format(discarded, ep_num))
+
+        self.in_readers = {}
+
+
+    def _get_out_writer(self, ep_num):
+        """
+        Returns the background writer for the given proxied OUT endpoint, starting
+        one if we don't yet have it.
+        """
+        writer = self.out_writers.get(ep_num)
+
+        if writer is None:
+            error_callback = functools.partial(self._queue_out_stall, self.out_generation)
+            writer = USBProxyOutEndpointWriter(self.libusb_device, ep_num,
+                error_callback, self.out_queue_depth, statistics=self.statistics)
+            writer.start()
+            self.out_writers[ep_num] = writer
+
+        return writer
+
+
+    def _stop_out_writers(self, discard=False):
+        """
+        Stops all background writers.
+
+        discard: If true, any queued data that hasn't yet been written is discarded,
+            and counted in our statistics; we don't wait for writes in progress, and
+            any stalls they report are ignored. Otherwise, we wait for all queued
+            data to be written.
+        """
+        for ep_num, writer in self.out_writers.items():
+            discarded = writer.stop(wait=not discard, discard=discard)
+
+            if discarded:
+                if self.statistics:
+                    self.statistics.record_event(ep_num, 'discarded', discarded)
+                if self.verbose > 0:
+                    print("-- Discarded {} unsent packet(s) for EP{} OUT --".format(discarded, ep_num))
+
+        self.out_writers = {}
+
+        if discard:
+            self.out_generation += 1
+            self.pending_out_stalls.clear()
+
+
+    def can_accept_data(self, ep_num):
+        """
+        Returns true iff there's room to queue more data for the given OUT endpoint;
+        while there isn't, the host is NAK'd.
+        """
+        writer = self.out_writers.get(ep_num)
+        return writer is None or writer.has_room()
+
+
+    def _queue_out_stall(self, generation, ep_num, data):
+        """
+        Notes that a background write stalled, so it can be handled from the main loop.
+        Called from the writer's thread.
+        """
+        self.pending_out_stalls.append((generation, ep_num, data))
+
+
+    def _handle_pending_out_stalls(self):
+        """ Handles any OUT stalls reported by our current background writers. """
+        while self.pending_out_stalls:
+            generation, ep_num, data = self.pending_out_stalls.popleft()
+
+            if generation == self.out_generation:
+                self._handle_out_stall(ep_num, data)
+
+
     def add_filter(self, filter_object, head=False):
         """
         Adds a filter to the USBProxy filter stack.
@@ -212,6 +509,45 @@ class USBProxyDevice(USBDevice):
         else:
             self.filter_list.append(filter_object)
 
+        self._compile_filters()
+
+
+    def remove_filter(self, filter_object):
+        """
+        Removes a filter from the USBProxy filter stack.
+        """
+        self.filter_list.remove(filter_object)
+        self._compile_filters()
+
+
+    def _compile_filters(self):
+        """
+        Builds the per-hook filter chains, which contain only the filters that
+        implement each hook. Must be called whenever the filter list changes.
+        """
+        self.filter_chains = {}
+
+        for hook in USBProxyFilter.HOOKS:
+            self.filter_chains[hook] = [getattr(f, hook) for f in self.filter_list if f.handles(hook)]
+
+        # Chains for the endpoint hooks are further narrowed per endpoint as
+        # traffic arrives; see _get_endpoint_filters.
+        self.endpoint_filter_chains = {}
+
+
+    def _get_endpoint_filters(self, hook, ep_num):
+        """
+        Returns the chain of filter methods for an endpoint hook, containing only
+        the filters that want to see traffic on the given endpoint. An empty chain
+        means the traffic can be proxied without filtering.
+        """
+        try:
+            return self.endpoint_filter_chains[hook, ep_num]
+        except KeyError:
+            chain = [method for method in self.filter_chains[hook] if method.__self__.handles_endpoint(ep_num)]
+            self.endpoint_filter_chains[hook, ep_num] = chain
+            return chain
+
 
     def handle_request(self, req):
         """
@@ -232,31 +568,57 @@ class USBProxyDevice(USBDevice):
         data = []
         stalled = False
 
+        statistics = self.statistics
+        if statistics:
+            started = time.perf_counter_ns()
+
         # Filter the setup stage generated by the target device. We can use this
         # to e.g. change the setup stage before proxying it to the target device,
         # or to absorb a packet before it's proxied.
-        for f in self.filter_list:
-            req, stalled = f.filter_control_in_setup(req, stalled)
+        for filter_control_in_setup in self.filter_chains['filter_control_in_setup']:
+            req, stalled = filter_control_in_setup(req, stalled)
 
         # If we stalled immediately, handle the stall and return without proxying.
         if stalled:
             self.maxusb_app.stall_ep0()
+
+            if statistics:
+                statistics.record_event(0x80, 'stall')
             return
 
         # If we filtered out the setup request, NAK.
         if req is None:
             return
 
-        # Read any data from the real device...
-        try:
-            data = self.libusb_device.ctrl_transfer(req.request_type, req.request,
-                                         req.value, req.index, req.length)
-        except USBError as e:
-            stalled = True
+        if statistics:
+            filtered = time.perf_counter_ns()
+
+        # Read any data from the real device; or from our cache, if we can...
+        cacheable = self.cache_descriptors and self._is_cacheable_request(req)
+        cached = self._get_cached_descriptor(req) if cacheable else None
+
+        if cached is not None:
+            data = cached
+        else:
+            try:
+                data = self.libusb_device.ctrl_transfer(req.request_type, req.request,
+                                             req.value, req.index, req.length)
+
+                if cacheable:
+                    self.descriptor_cache[(req.request_type, req.value, req.index)] = (req.length, bytes(data))
+
+            except USBError as e:
+                stalled = True
+
+        if statistics:
+            transferred = time.perf_counter_ns()
 
         # Run filters here.
-        for f in self.filter_list:
-            req, data, stalled = f.filter_control_in(req, data, stalled)
+        for filter_control_in in self.filter_chains['filter_control_in']:
+            req, data, stalled = filter_control_in(req, data, stalled)
+
+        if statistics:
+            responded = time.perf_counter_ns()
 
         #... and proxy it to our victim.
         if stalled:
@@ -265,6 +627,47 @@ class USBProxyDevice(USBDevice):
         else:
             self.send_control_message(data)
 
+        if statistics:
+            statistics.record_transfer(0x80, 0 if stalled else len(data), (filtered - started) + (responded - transferred),
+                                       transferred - filtered, time.perf_counter_ns() - responded)
+            if stalled:
+                statistics.record_event(0x80, 'stall')
+            if cached is not None:
+                statistics.record_event(0x80, 'cache_hit')
+
+
+    def _is_cacheable_request(self, req):
+        """ Returns true iff the given request is a standard GET_DESCRIPTOR request. """
+        return req.get_type() == 0 and req.request == self.GET_DESCRIPTOR_REQUEST
+
+
+    def _get_cached_descriptor(self, req):
+        """
+        Returns a copy of the cached response to the given request, or None if we
+        can't answer it from our cache.
+        """
+        try:
+            cached_length, cached_data = self.descriptor_cache[(req.request_type, req.value, req.index)]
+        except KeyError:
+            return None
+
+        # We can serve any request up to the length we originally asked for. If the
+        # device sent less than that, we have the whole descriptor, and can serve
+        # requests of any length.
+        if req.length > cached_length and len(cached_data) == cached_length:
+            return None
+
+        self.descriptor_cache_hits += 1
+
+        # Filters receive a fresh copy, just as they would from pyusb, so they're
+        # free to modify it without affecting the cache.
+        return array.array('B', cached_data[:req.length])
+
+
+    def invalidate_descriptor_cache(self):
+        """ Discards all cached descriptor responses. """
+        self.descriptor_cache.clear()
+
 
     def _proxy_out_request(self, req):
         """
@@ -274,26 +677,52 @@ class USBProxyDevice(USBDevice):
 
         data = req.data
 
-        for f in self.filter_list:
-            req, data = f.filter_control_out(req, data)
+        statistics = self.statistics
+        if statistics:
+            started = time.perf_counter_ns()
+
+        for filter_control_out in self.filter_chains['filter_control_out']:
+            req, data = filter_control_out(req, data)
+
+        if statistics:
+            filtered = time.perf_counter_ns()
 
         # ... forward the request to the real device.
         if req:
             try:
                 self.libusb_device.ctrl_transfer(req.request_type, req.request,
                     req.value, req.index, data)
+
+                if statistics:
+                    transferred = time.perf_counter_ns()
+
                 self.ack_status_stage()
 
+                if statistics:
+                    statistics.record_transfer(0x00, len(data) if data else 0, filtered - started,
+                                               transferred - filtered, time.perf_counter_ns() - transferred)
+
+                # The device's descriptors may depend on its configuration; so
+                # don't trust our cache once it's changed.
+                if req.get_type() == 0 and req.request in (self.SET_CONFIGURATION_REQUEST, self.SET_INTERFACE_REQUEST):
+                    self.invalidate_descriptor_cache()
+
+                for handle_out_request_complete in self.filter_chains['handle_out_request_complete']:
+                    req, data = handle_out_request_complete(req, data)
+
             # Special case: we've stalled, allow the filters to decide what to do.
             except USBError as e:
                 stalled = True
 
-                for f in self.filter_list:
-                    req, data, stalled = f.handle_out_request_stall(req, data, stalled)
+                for handle_out_request_stall in self.filter_chains['handle_out_request_stall']:
+                    req, data, stalled = handle_out_request_stall(req, data, stalled)
 
                 if stalled:
                     self.maxusb_app.stall_ep0()
 
+                if statistics:
+                    statistics.record_event(0x00, 'stall')
+
 
     def handle_data_available(self, ep_num, data):
         """
@@ -301,23 +730,64 @@ class USBProxyDevice(USBDevice):
         that needs to be proxied to the target device.
         """
 
-        # Run the data through all of our filters.
-        for f in self.filter_list:
-            ep_num, data = f.filter_out(ep_num, data)
+        statistics = self.statistics
+        if statistics:
+            address = ep_num
+            started = time.perf_counter_ns()
+
+        # Run the data through any filters that apply to this endpoint.
+        for filter_out in self._get_endpoint_filters('filter_out', ep_num):
+            ep_num, data = filter_out(ep_num, data)
+
+        if statistics:
+            filtered = time.perf_counter_ns()
 
         # If the data wasn't filtered out, communicate it to the target device.
+        # When writing in the background, the libusb stage is just the time
+        # spent queueing the data.
         if data:
+            self.send_to_device(ep_num, data)
+
+        if statistics:
+            statistics.record_transfer(address, len(data) if data else 0, filtered - started,
+                                       time.perf_counter_ns() - filtered, 0)
+
+
+    def send_to_device(self, ep_num, data):
+        """
+        Sends data to one of the proxied device's OUT endpoints, without running
+        it through our filters. Used for OUT data, once it's been filtered; and by
+        filters that hold data back to deliver later.
+        """
+        if self.out_queue_depth:
+            # If the writer's queue is full, the data's dropped; report it as a stall,
+            # rather than losing it silently.
+            if not self._get_out_writer(ep_num).write(data):
+                self._handle_out_stall(ep_num, data)
+        else:
             try:
                 self.libusb_device.write(ep_num, data)
             except USBError as e:
-                stalled = True
+                self._handle_out_stall(ep_num, data)
 
-                for f in self.filter_list:
-                    req, data, stalled = f.handle_out_stall(ep_num, data, stalled)
 
-                if stalled:
-                    self.maxusb_app.stall_ep0()
+    def _handle_out_stall(self, ep_num, data):
+        """
+        Handles an OUT transfer that was stalled by the proxied device, giving
+        our filters the chance to decide whether to stall the target host. As
+        stalls from background writes are reported after the fact, we stall the
+        affected OUT endpoint, rather than whatever's happening on EP0.
+        """
+        stalled = True
 
+        for handle_out_stall in self._get_endpoint_filters('handle_out_stall', ep_num):
+            ep_num, data, stalled = handle_out_stall(ep_num, data, stalled)
+
+        if stalled:
+            self.maxusb_app.stall_endpoint(ep_num, 0)
+
+        if self.statistics:
+            self.statistics.record_event(ep_num, 'stall')
 
 
     def handle_nak(self, ep_num):
@@ -327,10 +797,8 @@ class USBProxyDevice(USBDevice):
         in communications.
         """
 
-        # TODO: Currently, we use this for _all_ non-control transfers, as we
-        # don't e.g. periodically schedule isochronous or interrupt transfers.
-        # We probably should set up those to be independently scheduled and
-        # then limit this to only bulk endpoints.
+        # TODO: Isochronous endpoints are still proxied on NAK, rather than
+        # being independently scheduled.
 
         # Get the endpoint object we reference.
         endpoint = self.endpoints[ep_num]
@@ -339,9 +807,33 @@ class USBProxyDevice(USBDevice):
         if not endpoint.direction:
             return
 
+        if self.statistics:
+            self.statistics.record_event(ep_num | 0x80, 'nak')
+
         self._proxy_in_transfer(endpoint)
 
 
+    def handle_buffer_available(self, ep_num):
+        """
+        Handles the case where an IN endpoint's buffer on the Facedancer is empty.
+        For polled interrupt endpoints, and for endpoints whose reader already has
+        data waiting, we immediately fill it with the next packet, so the host
+        receives it on its next IN token rather than being NAK'd.
+        """
+        endpoint = self.polled_endpoints.get(ep_num)
+
+        if endpoint is None:
+            reader = self.in_readers.get(ep_num)
+
+            if reader is None or not reader.has_packets():
+                return
+
+            endpoint = self.endpoints.get(ep_num)
+
+        if endpoint is not None:
+            self._proxy_in_transfer(endpoint)
+
+
     def _proxy_in_transfer(self, endpoint):
         """
         Proxy OUT requests, which sends a request from the target device to the
@@ -350,24 +842,54 @@ class USBProxyDevice(USBDevice):
 
         ep_num = endpoint.number
 
+        statistics = self.statistics
+        if statistics:
+            address = ep_num | 0x80
+            started = time.perf_counter_ns()
+
         # Filter the "IN token" generated by the target device. We can use this
         # to e.g. change the endpoint before proxying to the target device, or
         # to absorb a packet before it's proxied.
-        for f in self.filter_list:
-            ep_num = f.filter_in_token(ep_num)
+        for filter_in_token in self._get_endpoint_filters('filter_in_token', ep_num):
+            ep_num = filter_in_token(ep_num)
 
         if ep_num is None:
             return
 
-        # Read the target data from the target device.
-        endpoint_address = ep_num | 0x80
-        data = self.libusb_device.read(endpoint_address, endpoint.max_packet_size)
+        if statistics:
+            filtered = time.perf_counter_ns()
 
-        # Run the data through all of our filters.
-        for f in self.filter_list:
-            ep_num, data = f.filter_in(endpoint.number, data)
+        # Read the target data from the target device. If we're reading ahead,
+        # take the next packet our background reader has buffered; if it hasn't
+        # received anything yet, we'll NAK, and the host will try again.
+        if self.in_buffer_depth or self.in_transfer_size or endpoint.number in self.polled_endpoints:
+            data = self._get_in_reader(ep_num, endpoint.max_packet_size).read_packet()
 
-        # If our data wasn't filtered out, transmit it to the target!
-        if data:
+            if data is None:
+                if statistics:
+                    statistics.record_event(address, 'no_data')
+                return
+        else:
+            endpoint_address = ep_num | 0x80
+            data = self.libusb_device.read(endpoint_address, endpoint.max_packet_size)
+
+        if statistics:
+            transferred = time.perf_counter_ns()
+
+        # Run the data through any filters that apply to this endpoint.
+        for filter_in in self._get_endpoint_filters('filter_in', endpoint.number):
+            ep_num, data = filter_in(endpoint.number, data)
+
+        if statistics:
+            responded = time.perf_counter_ns()
+
+        # If our data wasn't filtered out, transmit it to the target! Note that
+        # empty data is a zero-length packet, which must be sent to correctly
+        # end the device's transfer.
+        if data is not None:
             endpoint.send_packet(data)
 
+        if statistics:
+            statistics.record_transfer(address, len(data) if data else 0, (filtered - started) + (responded - transferred),
+                                       transferred - filtered, time.perf_counter_ns() - responded)
+
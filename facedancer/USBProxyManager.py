@@ -0,0 +1,156 @@
+# USBProxyManager.py
+#
+# Contains class definitions for USBProxyManager, which proxies several USB
+# devices at once, each through its own Facedancer.
+
+import usb
+import usb.backend.libusb1
+
+from .core import FacedancerBasicScheduler
+from .USBProxy import USBProxyDevice
+from .filters.standard import USBProxySetupFilters
+
+
+class USBProxyManager:
+    """
+    Proxies several devices at once-- e.g. the devices behind a dock's hub, or a
+    set of peers that only work together. Each proxied device is presented to the
+    target host by its own Facedancer board, and has its own filters; but all of
+    the proxies share a single libusb context, and a single scheduler, whose loop
+    services every board in turn.
+    """
+
+    HUB_DEVICE_CLASS = 0x09
+
+    def __init__(self, scheduler=None, backend=None, verbose=0, **proxy_kwargs):
+        """
+        Sets up a new proxy manager.
+
+        scheduler: The scheduler that runs all of our proxies; if not provided, a
+            basic scheduler is created.
+        backend: The pyusb backend used to find and talk to the proxied devices; if
+            not provided, the default libusb1 backend.
+        verbose: The verbosity level for each of our proxies.
+        proxy_kwargs: Default keyword arguments for each USBProxyDevice we create,
+            e.g. in_buffer_depth; these can be overridden per device.
+        """
+        self.scheduler = scheduler if scheduler else FacedancerBasicScheduler()
+        self.backend = backend if backend else usb.backend.libusb1.get_backend()
+        self.verbose = verbose
+        self.proxy_kwargs = proxy_kwargs
+
+        self.proxies = []
+
+
+    @staticmethod
+    def device_path(libusb_device):
+        """
+        Returns a (bus, port numbers) tuple describing where a device is in the USB
+        topology. Devices behind a hub share the hub's path as a prefix of theirs.
+        """
+        return libusb_device.bus, tuple(libusb_device.port_numbers or ())
+
+
+    @classmethod
+    def device_location(cls, libusb_device):
+        """ Returns a device's location as a string, in the style of Linux's sysfs, e.g. "1-2.4". """
+        bus, ports = cls.device_path(libusb_device)
+        return "{}-{}".format(bus, ".".join(str(port) for port in ports)) if ports else "usb{}".format(bus)
+
+
+    @classmethod
+    def is_downstream_of(cls, libusb_device, hub):
+        """ Returns true iff the given device is connected, directly or not, to the given hub. """
+        bus, ports = cls.device_path(libusb_device)
+        hub_bus, hub_ports = cls.device_path(hub)
+
+        return bus == hub_bus and len(ports) > len(hub_ports) and ports[:len(hub_ports)] == hub_ports
+
+
+    def find_devices(self, hub=None, include_hubs=False, **kwargs):
+        """
+        Finds the devices that could be proxied, in topology order.
+
+        hub: If provided, only devices downstream of this hub are returned.
+        include_hubs: If true, hubs are returned too. By default, they're skipped, as
+            a Facedancer can't stand in for a hub; instead, proxy the devices behind it.
+        kwargs: Any further criteria for usb.core.find, e.g. idVendor.
+        """
+        devices = usb.core.find(find_all=True, backend=self.backend, **kwargs)
+
+        if not include_hubs:
+            devices = (device for device in devices if device.bDeviceClass != self.HUB_DEVICE_CLASS)
+        if hub is not None:
+            devices = (device for device in devices if self.is_downstream_of(device, hub))
+
+        return sorted(devices, key=self.device_path)
+
+
+    def add_proxy(self, maxusb_app, libusb_device=None, setup_filters=True, **kwargs):
+        """
+        Creates a proxy for a single device, presented to the host by the given
+        Facedancer. Add any filters specific to this device to the returned proxy.
+
+        maxusb_app: The Facedancer app for the board that will stand in for the device.
+        libusb_device: The pyusb device to be proxied. If not provided, the first
+            device matching the search criteria in kwargs is used.
+        setup_filters: If true, the standard USBProxySetupFilters are added to the
+            proxy, as is almost always needed.
+        kwargs: Keyword arguments for USBProxyDevice, overriding our defaults.
+        """
+        options = dict(self.proxy_kwargs, verbose=self.verbose)
+        options.update(kwargs)
+
+        # Find our device using our shared libusb context.
+        if libusb_device is None:
+            options.setdefault('backend', self.backend)
+
+        proxy = USBProxyDevice(maxusb_app, scheduler=self.scheduler, libusb_device=libusb_device, **options)
+
+        if setup_filters:
+            proxy.add_filter(USBProxySetupFilters(proxy, verbose=self.verbose))
+
+        self.proxies.append(proxy)
+        return proxy
+
+
+    def add_hub_proxies(self, hub, maxusb_apps, **kwargs):
+        """
+        Proxies each of the devices behind a hub, e.g. the devices built into a dock.
+
+        hub: The pyusb device for the hub.
+        maxusb_apps: The Facedancer apps to present the devices to the host, one per
+            device; devices are assigned to them in topology order.
+        kwargs: Keyword arguments for each USBProxyDevice, overriding our defaults.
+
+        returns: The new proxies, in the same order as maxusb_apps.
+        """
+        devices = self.find_devices(hub=hub)
+
+        if len(devices) > len(maxusb_apps):
+            raise ValueError("hub {} has {} devices to proxy, but only {} Facedancers were provided".format(
+                self.device_location(hub), len(devices), len(maxusb_apps)))
+
+        return [self.add_proxy(maxusb_app, device, **kwargs) for maxusb_app, device in zip(maxusb_apps, devices)]
+
+
+    def connect(self):
+        """ Connects each of our proxies to the target host. """
+        for proxy in self.proxies:
+            proxy.connect()
+
+
+    def disconnect(self):
+        """ Disconnects each of our proxies from the target host, and stops their background transfers. """
+        for proxy in self.proxies:
+            proxy.disconnect()
+
+
+    def run(self):
+        """ Runs all of our proxies, until stop() is called. """
+        self.scheduler.run()
+
+
+    def stop(self):
+        """ Stops our proxies' shared loop. """
+        self.scheduler.stop()
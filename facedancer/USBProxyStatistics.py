@@ -0,0 +1,258 @@
+# USBProxyStatistics.py
+#
+# Contains class definitions for USBProxyStatistics, which gathers latency and
+# throughput measurements from a USBProxyDevice.
+
+import json
+import time
+import threading
+import collections
+
+
+class USBProxyEndpointStatistics:
+    """
+    Measurements for traffic on a single endpoint address. Stage durations are
+    kept in histograms with power-of-two microsecond buckets, so recording a
+    measurement is just a few integer operations.
+    """
+
+    # The stages of proxying a single transfer.
+    STAGES = ('filter', 'libusb', 'send', 'total')
+
+    # Bucket n holds durations of less than 2**n microseconds; the last bucket
+    # holds everything longer.
+    HISTOGRAM_BUCKETS = 24
+
+    def __init__(self, address):
+        self.address   = address
+
+        self.transfers = 0
+        self.bytes     = 0
+
+        # Counts of notable events, e.g. NAKs, stalls and timeouts.
+        self.events    = collections.Counter()
+
+        self.histograms   = {stage: [0] * self.HISTOGRAM_BUCKETS for stage in self.STAGES}
+        self.total_ns     = dict.fromkeys(self.STAGES, 0)
+        self.maximum_ns   = dict.fromkeys(self.STAGES, 0)
+
+        self.first_transfer = None
+        self.last_transfer  = None
+
+        # Totals as of the last periodic summary, for computing recent rates.
+        self.last_summary_bytes = 0
+        self.last_summary_events = collections.Counter()
+
+
+    def record(self, length, stage_durations):
+        """
+        Records a single transfer.
+
+        length: The number of bytes transferred.
+        stage_durations: A (filter, libusb, send) tuple of durations, in nanoseconds.
+        """
+        now = time.monotonic()
+        if self.first_transfer is None:
+            self.first_transfer = now
+        self.last_transfer = now
+
+        self.transfers += 1
+        self.bytes += length
+
+        filter_ns, libusb_ns, send_ns = stage_durations
+        durations = (filter_ns, libusb_ns, send_ns, filter_ns + libusb_ns + send_ns)
+
+        last_bucket = self.HISTOGRAM_BUCKETS - 1
+        for stage, duration in zip(self.STAGES, durations):
+            bucket = (duration // 1000).bit_length()
+            self.histograms[stage][bucket if bucket < last_bucket else last_bucket] += 1
+
+            self.total_ns[stage] += duration
+            if duration > self.maximum_ns[stage]:
+                self.maximum_ns[stage] = duration
+
+
+    @property
+    def bytes_per_second(self):
+        """ Average throughput between the first and last transfers. """
+        if self.first_transfer is None or self.last_transfer == self.first_transfer:
+            return 0.0
+
+        return self.bytes / (self.last_transfer - self.first_transfer)
+
+
+    def mean_us(self, stage):
+        """ Returns the mean duration of the given stage, in microseconds. """
+        return self.total_ns[stage] / self.transfers / 1000 if self.transfers else 0.0
+
+
+    def percentile_us(self, stage, fraction):
+        """
+        Returns an upper bound on the given percentile (as a fraction) of the
+        stage's duration, in microseconds, from its histogram.
+        """
+        histogram = self.histograms[stage]
+        target = fraction * sum(histogram)
+        seen = 0
+
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= target:
+                return 2 ** bucket
+
+        return 0
+
+
+    def to_dict(self):
+        return {
+            'address':          self.address,
+            'transfers':        self.transfers,
+            'bytes':            self.bytes,
+            'bytes_per_second': self.bytes_per_second,
+            'events':           dict(self.events),
+            'stages': {
+                stage: {
+                    'mean_us':      self.mean_us(stage),
+                    'max_us':       self.maximum_ns[stage] / 1000,
+                    'histogram_us': {2 ** bucket: count for bucket, count in enumerate(self.histograms[stage]) if count},
+                } for stage in self.STAGES
+            }
+        }
+
+
+
+class USBProxyStatistics:
+    """
+    Latency and throughput measurements for a proxied device, per endpoint address.
+    Pass an instance to USBProxyDevice to have its transfers measured.
+    """
+
+    def __init__(self, summary_interval=None, export_filename=None):
+        """
+        Sets up a new set of proxy statistics.
+
+        summary_interval: If provided, a summary is printed every summary_interval
+            seconds while the proxy runs.
+        export_filename: If provided, the statistics are exported to this file as
+            JSON along with each summary, and when the proxy disconnects.
+        """
+        self.summary_interval = summary_interval
+        self.export_filename  = export_filename
+
+        self.endpoints = {}
+        self.started   = time.monotonic()
+        self.last_summary = self.started
+
+        # Events can be reported from our background workers.
+        self.event_lock    = threading.Lock()
+        self.endpoint_lock = threading.Lock()
+
+
+    def endpoint(self, address):
+        """ Returns the statistics for the given endpoint address. """
+        statistics = self.endpoints.get(address)
+
+        # Endpoints can be added from our workers' threads, too.
+        if statistics is None:
+            with self.endpoint_lock:
+                statistics = self.endpoints.setdefault(address, USBProxyEndpointStatistics(address))
+
+        return statistics
+
+
+    def record_transfer(self, address, length, filter_ns, libusb_ns, send_ns):
+        """
+        Records a proxied transfer.
+
+        address: The endpoint address, including the direction bit.
+        length: The number of bytes proxied.
+        filter_ns, libusb_ns, send_ns: The time spent in the filters, talking to
+            the proxied device, and talking to the host, in nanoseconds.
+        """
+        self.endpoint(address).record(length, (filter_ns, libusb_ns, send_ns))
+
+
+    def record_event(self, address, event, count=1):
+        """
+        Counts an event, e.g. 'nak', 'stall' or 'timeout', on the given endpoint
+        address. Safe to call from any thread.
+        """
+        with self.event_lock:
+            self.endpoint(address).events[event] += count
+
+
+    def service(self):
+        """ Prints and exports a periodic summary, when one's due. """
+        if not self.summary_interval:
+            return
+
+        now = time.monotonic()
+        if now - self.last_summary < self.summary_interval:
+            return
+
+        print(self.summary(now - self.last_summary))
+        self.last_summary = now
+
+        if self.export_filename:
+            self.export()
+
+
+    def summary(self, interval=None):
+        """
+        Returns a human-readable summary of the statistics. If interval is provided,
+        also reports the throughput and event rates since the last summary.
+        """
+        lines = ["-- USBProxy statistics after {:.1f}s --".format(time.monotonic() - self.started)]
+
+        with self.endpoint_lock:
+            endpoints = sorted(self.endpoints.items())
+
+        for address, statistics in endpoints:
+            name = "EP{} {}".format(address & 0x7F, "IN" if address & 0x80 else "OUT")
+
+            line = "{:>8}: {} transfers, {} bytes, {:.0f} B/s".format(name,
+                statistics.transfers, statistics.bytes, statistics.bytes_per_second)
+
+            if interval:
+                recent_bytes = statistics.bytes - statistics.last_summary_bytes
+                line += " ({:.0f} B/s recently)".format(recent_bytes / interval)
+                statistics.last_summary_bytes = statistics.bytes
+
+            lines.append(line)
+
+            if statistics.transfers:
+                lines.append("          " + ", ".join("{} {:.1f}us (p99 <{}us)".format(stage,
+                    statistics.mean_us(stage), statistics.percentile_us(stage, 0.99))
+                    for stage in statistics.STAGES))
+
+            if statistics.events:
+                with self.event_lock:
+                    events = statistics.events.copy()
+
+                if interval:
+                    lines.append("          " + ", ".join("{} {} ({:.1f}/s)".format(event, count,
+                        (count - statistics.last_summary_events[event]) / interval)
+                        for event, count in sorted(events.items())))
+                    statistics.last_summary_events = events
+                else:
+                    lines.append("          " + ", ".join("{} {}".format(event, count)
+                        for event, count in sorted(events.items())))
+
+        return "\n".join(lines)
+
+
+    def to_dict(self):
+        with self.endpoint_lock:
+            endpoints = sorted(self.endpoints.items())
+
+        with self.event_lock:
+            return {
+                'elapsed':   time.monotonic() - self.started,
+                'endpoints': [statistics.to_dict() for _, statistics in endpoints],
+            }
+
+
+    def export(self, filename=None):
+        """ Writes the statistics to a JSON file; by default, our export_filename. """
+        with open(filename if filename else self.export_filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
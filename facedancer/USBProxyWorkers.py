@@ -0,0 +1,364 @@
+# USBProxyWorkers.py
+#
+# Contains background workers that communicate with a proxied device on behalf
+# of USBProxyDevice, so slow transfers don't hold up the Facedancer event loop.
+
+import time
+import queue
+import errno
+import threading
+import collections
+
+import usb
+from usb.core import USBError
+
+
+def is_timeout_error(error):
+    """ Returns true iff the given USBError represents a transfer timeout. """
+
+    timeout_error = getattr(usb.core, 'USBTimeoutError', None)
+    if timeout_error and isinstance(error, timeout_error):
+        return True
+
+    # Older versions of pyusb report timeouts as generic errors.
+    return error.errno == errno.ETIMEDOUT or getattr(error, 'backend_error_code', None) == -7
+
+
+
+class USBProxyInEndpointReader:
+    """
+    Background worker that keeps a read outstanding on one of the proxied device's
+    IN endpoints, buffering the packets it returns until the target host asks for
+    them. This lets us answer the host's IN tokens immediately, rather than
+    waiting on the proxied device from inside the event loop.
+    """
+
+    # Time to wait after an error before re-issuing a read, in seconds.
+    ERROR_BACKOFF = 0.010
+
+    def __init__(self, libusb_device, endpoint_number, max_packet_size, depth=16, timeout=100,
+                 keep_latest=False, statistics=None, transfer_size=None, transfer_timeout=1000):
+        """
+        Sets up a new reader; call start() to begin reading.
+
+        libusb_device: The pyusb device being proxied.
+        endpoint_number: The number of the IN endpoint to read from.
+        max_packet_size: The amount of data to request with each read.
+        depth: The maximum number of packets to buffer. Once the buffer's full,
+            we stop issuing reads until the host consumes a packet. A single read
+            may take us past this, by up to one transfer's worth of packets.
+        timeout: The timeout for each read, in milliseconds. This bounds how long
+            stop() may take.
+        keep_latest: If true, we never stop reading; once the buffer's full, each
+            new packet replaces the oldest. Useful for e.g. HID reports, where
+            only the most recent state matters.
+        statistics: A USBProxyStatistics object to report timeouts, errors and
+            overflows to, if desired.
+        transfer_size: If provided, the amount of data to request with each read
+            once the device is partway through a transfer; the data returned is
+            split back into packets of max_packet_size. This saves a libusb round-
+            trip per packet on bulk endpoints. While the endpoint's idle, we still
+            read a packet at a time, so idle timeouts lose nothing.
+        transfer_timeout: The timeout for each multi-packet read, in milliseconds.
+            pyusb discards the data from a read that times out; so if a multi-
+            packet read ever times out-- e.g. because the device paused partway
+            through a transfer-- any packets it had received are LOST. Should that
+            happen, we count it in aggregate_timeouts, and fall back to reading a
+            packet at a time for the rest of our life. This also bounds how long
+            stop() may take while a multi-packet read is outstanding.
+        """
+        self.libusb_device   = libusb_device
+        self.endpoint_number = endpoint_number
+        self.max_packet_size = max_packet_size
+        self.depth           = depth
+        self.timeout         = timeout
+        self.keep_latest     = keep_latest
+        self.statistics      = statistics
+
+        if transfer_size and transfer_size > max_packet_size:
+            self.transfer_size = transfer_size - (transfer_size % max_packet_size)
+        else:
+            self.transfer_size = max_packet_size
+
+        # We aggregate reads only while the device is partway through a transfer--
+        # i.e. after a full-sized packet-- and only until an aggregated read times out.
+        self.transfer_timeout = transfer_timeout
+        self.aggregating     = self.transfer_size > max_packet_size
+        self.in_transfer     = False
+
+        self.packets         = collections.deque()
+        self.condition       = threading.Condition()
+        self.stopping        = False
+
+        # Statistics.
+        self.packets_read    = 0
+        self.overflows       = 0
+        self.superseded      = 0
+        self.timeouts        = 0
+        self.aggregate_timeouts = 0
+        self.errors          = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True,
+            name="USBProxy EP{} IN reader".format(endpoint_number))
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self, wait=True):
+        """
+        Stops the reader, discarding any packets that haven't been consumed.
+
+        returns: The number of packets discarded, including any read while we
+            were stopping. If wait is false, packets from a read still in progress
+            may not be counted.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+        if wait and self.thread.is_alive():
+            self.thread.join()
+
+        with self.condition:
+            discarded = len(self.packets)
+            self.packets.clear()
+
+        return discarded
+
+
+    def has_packets(self):
+        """ Returns true iff we have packets ready to be read. """
+        return bool(self.packets)
+
+
+    def read_packet(self):
+        """
+        Returns the oldest packet read from the proxied device, or None if we
+        don't have any buffered.
+        """
+        with self.condition:
+            if not self.packets:
+                return None
+
+            packet = self.packets.popleft()
+            self.condition.notify()
+
+        return packet
+
+
+    def _run(self):
+        address = self.endpoint_number | 0x80
+
+        while True:
+
+            # If our buffer's full, wait until the host consumes a packet. We count
+            # each time this happens as an overflow: the proxied device had data
+            # to send that the host wasn't ready for.
+            with self.condition:
+                if len(self.packets) >= self.depth and not self.stopping and not self.keep_latest:
+                    self.overflows += 1
+                    self._record_event('overflow')
+                    self.condition.wait_for(lambda: len(self.packets) < self.depth or self.stopping)
+
+                if self.stopping:
+                    return
+
+            aggregated = self.aggregating and self.in_transfer
+
+            try:
+                if aggregated:
+                    data = self.libusb_device.read(address, self.transfer_size, self.transfer_timeout)
+                else:
+                    data = self.libusb_device.read(address, self.max_packet_size, self.timeout)
+            except USBError as e:
+                if is_timeout_error(e):
+                    self.timeouts += 1
+                    self._record_event('timeout')
+
+                    # Any data the timed-out read received is gone; don't risk it again.
+                    if aggregated:
+                        self.aggregating = False
+                        self.aggregate_timeouts += 1
+                        self._record_event('aggregate_timeout')
+                else:
+                    self.errors += 1
+                    self._record_event('error')
+                    time.sleep(self.ERROR_BACKOFF)
+                continue
+
+            if aggregated:
+                packets = self._split_transfer(data)
+                self.in_transfer = len(data) == self.transfer_size
+            else:
+                packets = (data,)
+                self.in_transfer = len(data) == self.max_packet_size
+
+            # Buffer what we've read even if we're stopping, so stop() counts it
+            # among the packets it discards.
+            with self.condition:
+                if self.keep_latest and len(self.packets) >= self.depth:
+                    self.packets.popleft()
+                    self.superseded += 1
+
+                self.packets.extend(packets)
+                self.packets_read += len(packets)
+
+                if self.stopping:
+                    return
+
+
+    def _split_transfer(self, data):
+        """
+        Splits the data returned by a multi-packet read back into the packets the
+        device sent. Every packet but the last must have been full-sized; so only
+        the last can be short. The read may have ended partway through a transfer,
+        or (if the device sent one) on a short packet belonging to the next one.
+        """
+        data = bytes(data)
+        max_packet_size = self.max_packet_size
+
+        packets = [data[i:i + max_packet_size] for i in range(0, len(data), max_packet_size)]
+
+        # If the read ended on a packet boundary before it was filled, the device
+        # must have ended its transfer with a zero-length packet; reproduce it.
+        if len(data) % max_packet_size == 0 and len(data) < self.transfer_size:
+            packets.append(b'')
+
+        return packets
+
+
+    def _record_event(self, event):
+        if self.statistics:
+            self.statistics.record_event(self.endpoint_number | 0x80, event)
+
+
+
+class USBProxyOutEndpointWriter:
+    """
+    Background worker that forwards data the target host sent on an OUT endpoint
+    to the proxied device, so the event loop can continue servicing other
+    endpoints while the proxied device accepts it.
+    """
+
+    def __init__(self, libusb_device, endpoint_number, error_callback, depth=64, timeout=None,
+                 statistics=None):
+        """
+        Sets up a new writer; call start() to begin writing.
+
+        libusb_device: The pyusb device being proxied.
+        endpoint_number: The number of the OUT endpoint to write to.
+        error_callback: Function called as error_callback(endpoint_number, data)
+            when the proxied device stalls or fails a write. Called from the
+            writer's thread.
+        depth: The maximum number of packets to queue. Once the queue's full,
+            has_room() returns false, and the Facedancer should stop accepting
+            data from the host-- NAKing it-- until the proxied device catches up.
+            write() never blocks; packets that arrive anyway are refused, and
+            counted as overflows.
+        timeout: The timeout for each write, in milliseconds; or None to use
+            pyusb's default.
+        statistics: A USBProxyStatistics object to report overflows and timeouts
+            to, if desired.
+        """
+        self.libusb_device   = libusb_device
+        self.endpoint_number = endpoint_number
+        self.error_callback  = error_callback
+        self.timeout         = timeout
+        self.statistics      = statistics
+
+        self.queue           = queue.Queue(depth)
+
+        # Statistics.
+        self.packets_written = 0
+        self.overflows       = 0
+        self.errors          = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True,
+            name="USBProxy EP{} OUT writer".format(endpoint_number))
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def has_room(self):
+        """ Returns true iff there's room in our queue for another packet. """
+        return not self.queue.full()
+
+
+    def write(self, data):
+        """
+        Queues data to be written to the proxied device. Never blocks.
+
+        returns: True iff the data was queued; or False if our queue was full,
+            in which case the data's been dropped.
+        """
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except queue.Full:
+            self.overflows += 1
+            if self.statistics:
+                self.statistics.record_event(self.endpoint_number, 'overflow')
+            return False
+
+
+    def flush(self):
+        """ Waits until all queued data has been written (or failed). """
+        self.queue.join()
+
+
+    def stop(self, wait=True, discard=False):
+        """
+        Stops the writer, once it's finished with any data already queued.
+
+        discard: If true, any data that hasn't yet been written is discarded, and
+            the writer stops once it's finished with its current write.
+
+        returns: The number of packets discarded.
+        """
+        discarded = 0
+
+        if discard:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                self.queue.task_done()
+                discarded += 1
+
+        self.queue.put(None)
+
+        if wait and self.thread.is_alive():
+            self.thread.join()
+
+        return discarded
+
+
+    def _run(self):
+        address = self.endpoint_number
+
+        while True:
+            data = self.queue.get()
+
+            try:
+                if data is None:
+                    return
+
+                self.libusb_device.write(address, data, self.timeout)
+                self.packets_written += 1
+
+            except USBError as e:
+                self.errors += 1
+
+                if self.statistics and is_timeout_error(e):
+                    self.statistics.record_event(self.endpoint_number, 'timeout')
+
+                self.error_callback(self.endpoint_number, data)
+
+            finally:
+                self.queue.task_done()
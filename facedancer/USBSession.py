@@ -0,0 +1,417 @@
+# USBSession.py
+#
+# Contains class definitions for recorded USB sessions: USBSessionWriter, which
+# records the traffic exchanged with a device, USBSessionReader, which provides
+# indexed access to a recording, and USBReplayDevice, which emulates a device by
+# replaying one.
+
+import mmap
+import time
+import array
+import struct
+import functools
+
+from .USB import *
+from .USBDeviceProfile import USBDeviceProfile, USBProfileDevice
+
+
+class USBSessionFormat:
+    """
+    Layout of a session file. A session is a header, followed by one record per
+    exchange, in the order they happened; followed by an index of those records
+    and a footer that locates the index.
+    """
+
+    MAGIC        = b'FDSN'
+    INDEX_MAGIC  = b'FDSX'
+    VERSION      = 1
+
+    # File header: magic, format version.
+    HEADER       = struct.Struct('<4sB3x')
+
+    # Each record: kind, endpoint number, flags, data length, timestamp (ns);
+    # followed by the SETUP packet for control records, and then the data.
+    RECORD       = struct.Struct('<BBBxIQ')
+
+    # Index header: number of control request keys, number of endpoint streams.
+    INDEX_HEADER = struct.Struct('<II')
+
+    # Control index entries: SETUP packet, number of records; followed by the
+    # offset of each record made in response to that SETUP packet.
+    CONTROL_ENTRY = struct.Struct('<8sI')
+
+    # Stream index entries: record kind, endpoint number, number of records, and
+    # the file offset of an (8-byte aligned) array of the records' offsets.
+    STREAM_ENTRY = struct.Struct('<BB2xIQ')
+
+    # Footer: the file offset of the index.
+    FOOTER       = struct.Struct('<Q4s')
+
+    # Record kinds.
+    KIND_CONTROL_IN  = 0
+    KIND_CONTROL_OUT = 1
+    KIND_IN          = 2
+    KIND_OUT         = 3
+
+    # Record flags.
+    FLAG_STALLED     = 0x01
+
+    SETUP_LENGTH     = 8
+
+
+
+class USBSessionWriter(USBSessionFormat):
+    """
+    Records the exchanges between a host and a device into a session file.
+    """
+
+    def __init__(self, filename, buffer_size=1024 * 1024):
+        """
+        Creates a new session file.
+
+        filename: The session file to write.
+        buffer_size: The size of the file's write buffer, in bytes.
+        """
+        self.file   = open(filename, 'wb', buffering=buffer_size)
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+        self.offset = self.HEADER.size
+
+        # Record offsets for each SETUP packet, and for each (kind, endpoint) stream.
+        self.control_index = {}
+        self.stream_index  = {}
+
+        self.last_control_out = None
+
+
+    def _write_record(self, kind, endpoint, flags, setup, data):
+        """ Appends a record to the session, returning its offset. """
+        offset = self.offset
+        header = self.RECORD.pack(kind, endpoint, flags, len(data), time.time_ns())
+
+        self.file.write(header)
+        if setup is not None:
+            self.file.write(setup)
+        self.file.write(data)
+
+        self.offset += len(header) + (len(setup) if setup is not None else 0) + len(data)
+        return offset
+
+
+    def record_control_in(self, setup, data, stalled=False):
+        """
+        Records an IN control request.
+
+        setup: The raw SETUP packet for the request.
+        data: The data returned by the device.
+        stalled: True iff the device stalled the request.
+        """
+        data = bytes(data) if data and not stalled else b''
+        offset = self._write_record(self.KIND_CONTROL_IN, 0, self.FLAG_STALLED if stalled else 0, setup, data)
+        self.control_index.setdefault(setup, array.array('Q')).append(offset)
+
+
+    def record_control_out(self, setup, data):
+        """
+        Records an OUT control request, and the data sent with it. If the device
+        stalls the request, call mark_control_out_stalled().
+        """
+        data = bytes(data) if data else b''
+        offset = self._write_record(self.KIND_CONTROL_OUT, 0, 0, setup, data)
+        self.control_index.setdefault(setup, array.array('Q')).append(offset)
+        self.last_control_out = offset
+
+
+    def mark_control_out_stalled(self):
+        """ Marks the most recently recorded OUT control request as stalled. """
+        if self.last_control_out is None:
+            return
+
+        # Stalls are rare, so it's fine to have our buffer flushed to patch in the flag.
+        self.file.seek(self.last_control_out + 2)
+        self.file.write(bytes([self.FLAG_STALLED]))
+        self.file.seek(self.offset)
+
+
+    def record_packet(self, kind, ep_num, data):
+        """
+        Records a packet sent on a non-control endpoint.
+
+        kind: KIND_IN for data sent to the host; or KIND_OUT for data sent by the host.
+        """
+        offset = self._write_record(kind, ep_num, 0, None, bytes(data))
+        self.stream_index.setdefault((kind, ep_num), array.array('Q')).append(offset)
+
+
+    def close(self):
+        """ Writes the session's index, and closes the file. """
+        if self.file.closed:
+            return
+
+        index_offset = self.offset
+        chunks = [self.INDEX_HEADER.pack(len(self.control_index), len(self.stream_index))]
+
+        for setup, offsets in self.control_index.items():
+            chunks.append(self.CONTROL_ENTRY.pack(setup, len(offsets)))
+            chunks.append(offsets.tobytes())
+
+        # Lay out the stream offset arrays after the stream entries, aligned so
+        # they can be viewed directly from a memory map.
+        position = index_offset + sum(len(chunk) for chunk in chunks) + \
+            self.STREAM_ENTRY.size * len(self.stream_index)
+        padding = -position % 8
+        position += padding
+
+        arrays = [bytes(padding)]
+        for (kind, ep_num), offsets in self.stream_index.items():
+            chunks.append(self.STREAM_ENTRY.pack(kind, ep_num, len(offsets), position))
+            arrays.append(offsets.tobytes())
+            position += len(arrays[-1])
+
+        chunks.extend(arrays)
+        chunks.append(self.FOOTER.pack(index_offset, self.INDEX_MAGIC))
+
+        self.file.write(b''.join(chunks))
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+class USBSessionReader(USBSessionFormat):
+    """
+    Provides access to a recorded session. The session is memory mapped, and only
+    its control index is read up front, so even very large sessions open quickly;
+    any record can be found in constant time.
+    """
+
+    def __init__(self, filename):
+        """ Opens a session file for reading. """
+
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+
+        magic, version = self.HEADER.unpack_from(self.data)
+        if magic != self.MAGIC:
+            raise ValueError("not a Facedancer session")
+        if version != self.VERSION:
+            raise ValueError("unsupported session version {}".format(version))
+
+        index_offset, index_magic = self.FOOTER.unpack_from(self.data, len(self.data) - self.FOOTER.size)
+        if index_magic != self.INDEX_MAGIC:
+            raise ValueError("session has no index; was it closed properly?")
+
+        self._read_index(index_offset)
+
+
+    def _read_index(self, offset):
+        control_count, stream_count = self.INDEX_HEADER.unpack_from(self.data, offset)
+        offset += self.INDEX_HEADER.size
+
+        # Control request keys -> offsets of the records made in response.
+        self.control_index = {}
+        for _ in range(control_count):
+            setup, count = self.CONTROL_ENTRY.unpack_from(self.data, offset)
+            offset += self.CONTROL_ENTRY.size
+
+            self.control_index[setup] = self.view[offset:offset + count * 8].cast('Q')
+            offset += count * 8
+
+        # (kind, endpoint) -> offsets of each packet in that stream.
+        self.stream_index = {}
+        for _ in range(stream_count):
+            kind, ep_num, count, position = self.STREAM_ENTRY.unpack_from(self.data, offset)
+            offset += self.STREAM_ENTRY.size
+
+            self.stream_index[(kind, ep_num)] = self.view[position:position + count * 8].cast('Q')
+
+
+    def read_record(self, offset):
+        """
+        Reads the record at the given offset.
+
+        returns: A tuple of (kind, endpoint number, stalled, setup, data); where
+            setup is None for non-control records, and data is a memoryview into
+            the session.
+        """
+        kind, ep_num, flags, length, _ = self.RECORD.unpack_from(self.data, offset)
+        offset += self.RECORD.size
+
+        setup = None
+        if kind in (self.KIND_CONTROL_IN, self.KIND_CONTROL_OUT):
+            setup = bytes(self.view[offset:offset + self.SETUP_LENGTH])
+            offset += self.SETUP_LENGTH
+
+        return kind, ep_num, bool(flags & self.FLAG_STALLED), setup, self.view[offset:offset + length]
+
+
+    def control_records(self, setup):
+        """ Returns the offsets of each record made for the given SETUP packet. """
+        return self.control_index.get(bytes(setup), ())
+
+
+    def stream_records(self, kind, ep_num):
+        """ Returns the offsets of each packet recorded on the given endpoint. """
+        return self.stream_index.get((kind, ep_num), ())
+
+
+    def to_profile(self, name=None):
+        """
+        Builds a USBDeviceProfile from the session, containing the longest response
+        the device gave to each IN control request. This gives us all of the
+        descriptors the host saw.
+        """
+        profile = USBDeviceProfile(name)
+
+        for setup, offsets in self.control_index.items():
+            request_type, request, value, index, _ = struct.unpack('<BBHHH', setup)
+
+            if not request_type & 0x80:
+                continue
+
+            for offset in offsets:
+                _, _, stalled, _, data = self.read_record(offset)
+                key = (request_type, request, value, index)
+
+                if not stalled and len(data) > len(profile.responses.get(key, b'')):
+                    profile.add_response(request_type, request, value, index, data)
+
+        return profile
+
+
+    def close(self):
+        for indexed in list(self.control_index.values()) + list(self.stream_index.values()):
+            indexed.release()
+        self.control_index = self.stream_index = {}
+
+        self.view.release()
+        self.data.close()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+class USBReplayDevice(USBProfileDevice):
+    """
+    Device emulated by replaying a recorded session. Control requests are answered
+    with the responses recorded for the same SETUP packet, in the order they were
+    recorded; and each IN endpoint sends the packets recorded on it, in order, as
+    the host asks for them. Replays are deterministic: the same sequence of host
+    requests always receives the same responses.
+    """
+    name = "replayed USB device"
+
+    def __init__(self, maxusb_app, session, verbose=0, quirks=[], scheduler=None):
+        """
+        Creates a new device that replays a session.
+
+        maxusb_app: The Facedancer app that will host the emulated device.
+        session: The USBSessionReader to replay, or the filename of a session.
+        """
+        if isinstance(session, str):
+            session = USBSessionReader(session)
+
+        self.session = session
+
+        # The position of the next response to replay for each SETUP packet, and
+        # of the next packet to replay on each IN endpoint.
+        self.control_positions = {}
+        self.in_positions = {}
+
+        # The number of OUT packets that didn't match those recorded.
+        self.out_mismatches = 0
+        self.out_positions = {}
+
+        USBProfileDevice.__init__(self, maxusb_app, session.to_profile(), verbose=verbose,
+                quirks=quirks, scheduler=scheduler)
+
+
+    def _next_control_record(self, setup):
+        """
+        Returns the next recorded response to the given SETUP packet. Once we've
+        replayed every recorded response, we keep replaying the last one.
+        """
+        offsets = self.session.control_records(setup)
+        if not offsets:
+            return None
+
+        position = self.control_positions.get(setup, 0)
+        self.control_positions[setup] = position + 1
+
+        return self.session.read_record(offsets[min(position, len(offsets) - 1)])
+
+
+    def handle_request(self, req):
+        """
+        Replays the recorded response to a control request. Standard OUT requests
+        change our state, so we always handle those ourselves.
+        """
+        is_in = req.get_direction() == USB.request_direction_device_to_host
+
+        if is_in or req.get_type() != USB.request_type_standard:
+            record = self._next_control_record(req.raw())
+
+            if record is not None:
+                _, _, stalled, _, data = record
+
+                if stalled:
+                    self.maxusb_app.stall_ep0()
+                elif is_in:
+                    self.send_control_message(bytes(data[:req.length]))
+                else:
+                    self.ack_status_stage()
+
+                return
+
+        USBProfileDevice.handle_request(self, req)
+
+
+    def handle_set_configuration_request(self, req):
+        USBProfileDevice.handle_set_configuration_request(self, req)
+
+        # Replay recorded data on each of the new configuration's endpoints.
+        for endpoint in self.endpoints.values():
+            if endpoint.direction == endpoint.direction_in:
+                endpoint.set_handler(functools.partial(self._replay_in_packet, endpoint))
+            else:
+                endpoint.set_handler(functools.partial(self._check_out_packet, endpoint))
+
+
+    def _replay_in_packet(self, endpoint):
+        """ Sends the next recorded packet on an IN endpoint, if we have one. """
+        offsets = self.session.stream_records(USBSessionFormat.KIND_IN, endpoint.number)
+        position = self.in_positions.get(endpoint.number, 0)
+
+        if position >= len(offsets):
+            return
+
+        self.in_positions[endpoint.number] = position + 1
+
+        _, _, _, _, data = self.session.read_record(offsets[position])
+        endpoint.send_packet(bytes(data))
+
+
+    def _check_out_packet(self, endpoint, data):
+        """ Compares data the host sent on an OUT endpoint against the recording. """
+        offsets = self.session.stream_records(USBSessionFormat.KIND_OUT, endpoint.number)
+        position = self.out_positions.get(endpoint.number, 0)
+        self.out_positions[endpoint.number] = position + 1
+
+        if position >= len(offsets) or self.session.read_record(offsets[position])[4] != bytes(data):
+            self.out_mismatches += 1
+
+            if self.verbose > 1:
+                print("-- OUT data on EP{} differs from the recorded session --".format(endpoint.number))
@@ -0,0 +1,141 @@
+# USBStringTable.py
+#
+# Contains class definition for USBStringTable, which tracks a device's strings
+# and serves their string descriptors.
+
+
+class USBStringTable:
+    """
+    Table of the strings presented by a device. Strings are indexed as they're
+    added, and each string descriptor is encoded once, when its string is added,
+    so requests for them can be served with a single lookup.
+    """
+
+    DEFAULT_LANGUAGE_ID = 0x0409    # English (United States)
+
+    # A string descriptor's length must fit in its one-byte bLength field; so its
+    # string can be at most this many UTF-16 code units long.
+    MAX_STRING_LENGTH   = (255 - 2) // 2
+
+    def __init__(self, languages=None):
+        """
+        Creates a new string table.
+
+        languages: The language IDs the device supports, in order of preference.
+            Defaults to US English.
+        """
+        self.languages = []
+
+        # Strings in the order they were added; string indices start at 1.
+        self.strings = []
+        self.indices = {}
+
+        # Encoded descriptors for each string index, and for any per-language
+        # translations, keyed by (index, language ID).
+        self.descriptors = {}
+        self.translations = {}
+
+        for language in (languages if languages else [self.DEFAULT_LANGUAGE_ID]):
+            self.add_language(language)
+
+
+    @classmethod
+    def encode_descriptor(cls, s):
+        """ Encodes a python string as a USB string descriptor. """
+
+        # Note that we emit UTF-16LE without a Byte Order Mark (BOM);
+        # Linux doesn't like the leading BOM, and FreeBSD is okay without it.
+        encoded = s.encode('utf-16-le')
+
+        # Characters outside the BMP take two code units, so truncate the encoded
+        # string, taking care not to split a surrogate pair.
+        if len(encoded) > cls.MAX_STRING_LENGTH * 2:
+            encoded = encoded[:cls.MAX_STRING_LENGTH * 2]
+
+            if 0xD800 <= int.from_bytes(encoded[-2:], 'little') <= 0xDBFF:
+                encoded = encoded[:-2]
+
+        return bytes([
+            len(encoded) + 2,   # length of descriptor in bytes
+            3                   # descriptor type 3 == string
+        ]) + encoded
+
+
+    def add_language(self, language_id):
+        """
+        Adds a supported language ID, which will be reported in string descriptor zero.
+        """
+        if language_id in self.languages:
+            return
+
+        self.languages.append(language_id)
+
+        language_table = b''.join(language.to_bytes(2, byteorder='little') for language in self.languages)
+        self.descriptors[0] = bytes([len(language_table) + 2, 3]) + language_table
+
+
+    def get_index(self, s):
+        """
+        Returns the string index for the given string, adding the string to the
+        table if it's not already present.
+        """
+        try:
+            return self.indices[s]
+        except KeyError:
+            self.strings.append(s)
+
+            # string descriptors start at index 1
+            index = len(self.strings)
+            self.indices[s] = index
+            self.descriptors[index] = self.encode_descriptor(s)
+
+            return index
+
+
+    def add_translation(self, index, language_id, s):
+        """
+        Provides the string to be served for a given string index when a specific
+        language is requested. Requests for other languages receive the string as
+        originally added.
+
+        index: The string index being translated.
+        language_id: The language ID the translation applies to.
+        s: The translated string.
+        """
+        self.add_language(language_id)
+        self.translations[(index, language_id)] = self.encode_descriptor(s)
+
+
+    def get_descriptor(self, index, language_id=None):
+        """
+        Returns the string descriptor for the given index and language, or None if
+        we don't have a string with the given index.
+        """
+        if language_id is not None and self.translations:
+            descriptor = self.translations.get((index, language_id))
+
+            if descriptor is not None:
+                return descriptor
+
+        return self.descriptors.get(index)
+
+
+    def descriptor_items(self):
+        """
+        Yields an (index, language ID, descriptor) tuple for each string descriptor
+        we can serve, including the language table at index zero.
+        """
+        yield 0, 0, self.descriptors[0]
+
+        for index in range(1, len(self.strings) + 1):
+            for language_id in self.languages:
+                yield index, language_id, self.get_descriptor(index, language_id)
+
+
+    def __len__(self):
+        return len(self.strings)
+
+
+    def __getitem__(self, index):
+        """ Returns the string at the given (zero-based) position in the table. """
+        return self.strings[index]
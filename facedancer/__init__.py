@@ -3,4 +3,10 @@ from __future__ import print_function
 # Alias objects to make them easier to import.
 from .core import FacedancerUSBApp, FacedancerUSBHostApp, FacedancerBasicScheduler
 from .backends import *
-from .USBProxy import USBProxyFilter, USBProxyDevice
+
+# USBProxy requires pyusb; allow the rest of the package to be used without it.
+try:
+    from .USBProxy import USBProxyFilter, USBProxyDevice
+    from .USBProxyManager import USBProxyManager
+except ImportError:
+    pass
@@ -101,6 +101,10 @@ class GreatDancerApp(FacedancerApp):
         # for data transfer readiness.
         self.configuration = None
 
+        # OUT endpoints we've left un-primed because our device wasn't ready for
+        # more data; we prime them once it is.
+        self.deferred_out_endpoints = set()
+
         #
         # Store our list of quirks to handle.
         #
@@ -614,9 +618,25 @@ class GreatDancerApp(FacedancerApp):
 
                     # If this is an OUT endpoint, we'll need to prime the endpoint to
                     # accept new data. This provides a place for data to go once the
-                    # host sends an OUT token.
-                    else:
+                    # host sends an OUT token. If our device isn't ready for more
+                    # data, we leave the endpoint un-primed, and the host is NAK'd.
+                    elif self.connected_device.can_accept_data(endpoint.number):
+                        self.deferred_out_endpoints.discard(endpoint.number)
                         self._prime_out_endpoint(endpoint.number)
+                    else:
+                        self.deferred_out_endpoints.add(endpoint.number)
+
+
+    def _handle_deferred_out_endpoints(self):
+        """
+        Primes any OUT endpoints we've held off on, once our device is ready
+        for their data. Nothing else would prompt us to: until they're primed,
+        the host's OUT tokens are NAK'd without generating any events.
+        """
+        for endpoint_number in list(self.deferred_out_endpoints):
+            if self.connected_device.can_accept_data(endpoint_number):
+                self.deferred_out_endpoints.discard(endpoint_number)
+                self._prime_out_endpoint(endpoint_number)
 
 
     def _is_ready_for_priming(self, ep_num, direction):
@@ -718,6 +738,7 @@ class GreatDancerApp(FacedancerApp):
         """
         self._configure_endpoints(configuration)
         self.configuration = configuration
+        self.deferred_out_endpoints.clear()
 
         # If we've just set up endpoints, check to see if any of them
         # need to be primed, or have NAKs waiting.
@@ -750,3 +771,6 @@ class GreatDancerApp(FacedancerApp):
         if status & self.USBSTS_D_NAKI:
             self._handle_nak_events()
 
+        if self.deferred_out_endpoints:
+            self._handle_deferred_out_endpoints()
+
@@ -9,6 +9,117 @@ import struct
 
 from ..core import *
 
+
+class GreatDancerCompletionTracker:
+    """
+    Tracks the completion of transfers on a GreatDancer host's endpoints, in one
+    direction. The status register reports completions and stalls for every
+    endpoint, and reading it clears them all; so we keep each bit we read until
+    the endpoint it belongs to collects it. This lets several endpoints have
+    transfers in flight without losing each other's completions.
+    """
+
+    # How long to wait between polls of the status register: no wait at first,
+    # as most transfers complete quickly, and then backing off up to a maximum.
+    POLL_BACKOFF_INITIAL = 0.0001
+    POLL_BACKOFF_MAXIMUM = 0.005
+
+    def __init__(self, fetch_status):
+        """
+        fetch_status: A function that reads the status register; bit n reports a
+            stall on endpoint n, and bit n + 16, a completion.
+        """
+        self.fetch_status = fetch_status
+
+        # Status bits read, but not yet collected.
+        self.status = 0
+
+        # Deadlines for the transfers in flight, by endpoint number.
+        self.pending = {}
+
+
+    def start(self, endpoint_number, timeout=None):
+        """
+        Notes that a transfer is about to start on the given endpoint. Call this
+        before starting the transfer, so its completion can't be mistaken for stale.
+
+        timeout: The longest to wait for the transfer to complete, in seconds; or
+            None to wait indefinitely.
+        """
+        self.status &= ~self._mask(endpoint_number)
+        self.pending[endpoint_number] = time.monotonic() + timeout if timeout is not None else None
+
+
+    @staticmethod
+    def _mask(endpoint_number):
+        return (1 << endpoint_number) | (1 << (endpoint_number + 16))
+
+
+    def poll(self):
+        """ Reads the status register once, keeping its bits for whichever endpoints they belong to. """
+        self.status |= self.fetch_status()
+
+
+    def _collect(self, endpoint_number):
+        """
+        Collects the given endpoint's status bits.
+
+        returns: True iff its transfer has completed; raises IOError on a stall.
+        """
+        status = self.status
+
+        stalled  = (status >> endpoint_number) & 0x1
+        complete = (status >> (endpoint_number + 16)) & 0x1
+
+        if not (stalled or complete):
+            return False
+
+        self.status &= ~self._mask(endpoint_number)
+        self.pending.pop(endpoint_number, None)
+
+        if stalled:
+            raise IOError("Stalled!")
+
+        return True
+
+
+    def is_complete(self, endpoint_number):
+        """
+        Returns true iff the transfer on the given endpoint has completed, without
+        waiting. Raises IOError if it stalled.
+        """
+        if self._collect(endpoint_number):
+            return True
+
+        self.poll()
+        return self._collect(endpoint_number)
+
+
+    def wait(self, endpoint_number):
+        """
+        Waits for the transfer on the given endpoint to complete. Raises IOError if
+        it stalls, or TimeoutError if it misses its deadline.
+
+        There's no way to cancel a transfer, so one that times out is left in
+        flight on the GreatDancer; its eventual completion is discarded when the
+        next transfer on that endpoint starts.
+        """
+        deadline = self.pending.get(endpoint_number)
+        backoff = 0
+
+        while not self.is_complete(endpoint_number):
+            if deadline is not None and time.monotonic() >= deadline:
+                self.pending.pop(endpoint_number, None)
+                raise TimeoutError("timed out waiting for a transfer on endpoint {}".format(endpoint_number))
+
+            if backoff:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.POLL_BACKOFF_MAXIMUM)
+            else:
+                backoff = self.POLL_BACKOFF_INITIAL
+
+
+
 class GreatDancerHostApp(FacedancerUSBHost):
     """
     Class that represets a GreatFET-based USB host.
@@ -105,9 +216,15 @@ class GreatDancerHostApp(FacedancerUSBHost):
             return False
 
 
-    def __init__(self, verbose=0, quirks=[], autoconnect=True, device=None):
+    def __init__(self, verbose=0, quirks=[], autoconnect=True, device=None, transfer_timeout=None):
         """
         Sets up a GreatFET-based host connection.
+
+        transfer_timeout: The longest to wait for each transfer to complete, in
+            seconds, unless overridden; by default, transfers wait indefinitely,
+            as e.g. an interrupt IN read may wait on a human. A transfer that
+            times out is left in flight, so should be followed by a bus reset or
+            a retry on the same endpoint.
         """
 
         import greatfet
@@ -123,6 +240,11 @@ class GreatDancerHostApp(FacedancerUSBHost):
         # Grab a reference to our protocol definitions.
         self.vendor_requests = greatfet.protocol.vendor_requests
 
+        # Track the completion of transfers in each direction.
+        self.transfer_timeout = transfer_timeout
+        self.read_completions = GreatDancerCompletionTracker(self._get_read_status)
+        self.write_completions = GreatDancerCompletionTracker(self._get_write_status)
+
         if autoconnect:
             self.connect()
 
@@ -327,7 +449,7 @@ class GreatDancerHostApp(FacedancerUSBHost):
 
 
     def send_on_endpoint(self, endpoint_number, data, is_setup=False,
-                         blocking=True, data_packet_pid=0):
+                         blocking=True, data_packet_pid=0, timeout=None):
         """
         Sends a block of data on the provided endpoints.
 
@@ -335,10 +457,14 @@ class GreatDancerHostApp(FacedancerUSBHost):
         data -- The data to be transmitted.
         is_setup -- True iff this transfer should begin with a SETUP token.
         blocking -- True iff this transaction should wait for the transaction to complete.
+            If false, use wait_for_send to wait for it later.
         data_packet_pid -- The data packet PID to use (1 or 0). Ignored if the endpoint is set to automatically
                 alternate data PIDs.
+        timeout -- The longest to wait for the transfer to complete, in seconds; by
+                default, our transfer_timeout.
 
-        raises an IOError on a communications error or stall
+        raises an IOError on a communications error or stall, or a TimeoutError if the
+        transfer doesn't complete in time
         """
 
         # Determine the PID token with which to start the request...
@@ -346,27 +472,26 @@ class GreatDancerHostApp(FacedancerUSBHost):
 
         # Issue the actual send itself.
         # TODO: validate length
-
+        self.write_completions.start(endpoint_number, self._transfer_timeout(timeout))
         self.device.comms._vendor_request_out(self.vendor_requests.USBHOST_SEND_ON_ENDPOINT,
                                        index=endpoint_number, value=(data_packet_pid << 8) | pid_token,
                                        data=data)
 
         # ... and if we're blocking, also finish it.
         if blocking:
-            complete = False
-            stalled  = False
+            self.write_completions.wait(endpoint_number)
 
-            # Wait until we get a complete flag in the status register.
-            # XXX: This isn't entirely correct-- it'll clear too much status.
-            while not complete:
-                status = self._get_write_status()
 
-                stalled  = (status >> endpoint_number) & 0x1
-                complete = (status >> (endpoint_number + 16)) & 0x1
+    def wait_for_send(self, endpoint_number):
+        """
+        Waits for a non-blocking send on the given endpoint to complete. Raises an
+        IOError on a stall, or a TimeoutError if it doesn't complete in time.
+        """
+        self.write_completions.wait(endpoint_number)
 
-                if stalled:
-                    raise IOError("Stalled!")
 
+    def _transfer_timeout(self, timeout):
+        return timeout if timeout is not None else self.transfer_timeout
 
 
     def read_from_endpoint(self, endpoint_number, expected_read_size=64, data_packet_pid=0):
@@ -380,25 +505,52 @@ class GreatDancerHostApp(FacedancerUSBHost):
 
         raises an IOError on a communications error or stall
         """
+        self.start_read(endpoint_number, expected_read_size, data_packet_pid)
+        data = self.finish_read(endpoint_number)
+        return data.tobytes() if data else b''
 
-        # Start the request...
+
+    def _read_from_endpoint_into(self, endpoint_number, view):
+        """
+        Performs a single IN transfer for bulk_read, copying the data straight
+        from the vendor request's buffer into the caller's.
+        """
+        self.start_read(endpoint_number, len(view))
+        data = self.finish_read(endpoint_number)
+
+        if data:
+            view[:len(data)] = data
+
+        return len(data) if data else 0
+
+
+    def start_read(self, endpoint_number, expected_read_size=64, data_packet_pid=0, timeout=None):
+        """
+        Starts reading from the given endpoint, without waiting for the read to
+        complete; finish it with finish_read. Reads can be in flight on several
+        endpoints at once.
+
+        endpoint_number -- The endpoint number from which to read.
+        expected_read_size -- The expected amount of data to be read.
+        data_packet_pid -- The data packet PID to use (1 or 0).
+            Ignored if the endpoint is set to automatically alternate data PIDs.
+        timeout -- The longest to wait for the read to complete, in seconds; by
+            default, our transfer_timeout.
+        """
+        self.read_completions.start(endpoint_number, self._transfer_timeout(timeout))
         self.device.comms._vendor_request_out(self.vendor_requests.USBHOST_START_NONBLOCKING_READ,
                                        index=(data_packet_pid << 8) | endpoint_number, value=expected_read_size)
 
-        # ... and if we're blocking, also finish it.
-        complete = False
-        stalled  = False
-
-        # Wait until we get a complete flag in the status register.
-        # XXX: This isn't entirely correct-- it'll clear too much status.
-        while not complete:
-            status = self._get_read_status()
 
-            stalled  = (status >> endpoint_number) & 0x1
-            complete = (status >> (endpoint_number + 16)) & 0x1
+    def finish_read(self, endpoint_number):
+        """
+        Waits for a read started with start_read to complete, and returns the raw
+        data read, or None if the device sent no data.
 
-            if stalled:
-                raise IOError("Stalled!")
+        raises an IOError on a communications error or stall, or a TimeoutError if the
+        read doesn't complete in time
+        """
+        self.read_completions.wait(endpoint_number)
 
         # Figure out how muhc to read.
         raw_length = self.device.comms._vendor_request_in(self.vendor_requests.USBHOST_GET_NONBLOCKING_LENGTH,
@@ -410,10 +562,8 @@ class GreatDancerHostApp(FacedancerUSBHost):
 
         # If there's no data available, we don't need to waste time reading anyting.
         if length == 0:
-            return b''
+            return None
 
         # Otherwise, read the data from the endpoint and return it.
-        data = self.device.comms._vendor_request_in(self.vendor_requests.USBHOST_FINISH_NONBLOCKING_READ,
+        return self.device.comms._vendor_request_in(self.vendor_requests.USBHOST_FINISH_NONBLOCKING_READ,
                                              index=endpoint_number, length=length)
-        return data.tostring()
-
@@ -4,13 +4,184 @@
 
 import sys
 import time
+import array
 import codecs
+import ctypes
 import struct
-
-import usb
+import threading
+import concurrent.futures
 
 from ..core import *
 
+class LibUSBAsyncTransfers:
+    """
+    Issues bulk and interrupt transfers through libusb's asynchronous API, using
+    the ctypes bindings set up by pyusb's libusb1 backend. Transfers are handed to
+    libusb in the order they're submitted, so transfers on the same endpoint
+    complete in order; and any number can be in flight at once. A single thread
+    runs libusb's event loop while any are outstanding.
+    """
+
+    # libusb transfer types, for each endpoint transfer type.
+    TRANSFER_TYPES = {0x2: 2, 0x3: 3}
+
+    @classmethod
+    def for_device(cls, device):
+        """
+        Returns an instance that issues transfers to the given pyusb device; or
+        None, if the device isn't using pyusb's libusb1 backend.
+        """
+        try:
+            import usb.backend.libusb1 as libusb1
+        except ImportError:
+            return None
+
+        resources = getattr(device, '_ctx', None)
+        if resources is None or not isinstance(resources.backend, libusb1._LibUSB):
+            return None
+
+        return cls(device, libusb1)
+
+
+    def __init__(self, device, libusb1):
+        self.device = device
+        self.libusb1 = libusb1
+        self.lib = device._ctx.backend.lib
+        self.context = device._ctx.backend.ctx
+
+        # Outstanding transfers, keyed by the address of their libusb_transfer.
+        self.outstanding = {}
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+        # A single callback serves every transfer; we keep it, so it's never freed.
+        self.callback = libusb1._libusb_transfer_cb_fn_p(self._complete)
+
+
+    def submit(self, endpoint_address, buffer, length, timeout=0):
+        """
+        Submits a transfer.
+
+        endpoint_address: The address of the endpoint, including its direction bit.
+        buffer: A writable buffer of at least length bytes, holding the data to be
+            written or receiving the data read. It must not be touched until the
+            transfer completes.
+        timeout: The transfer's timeout, in milliseconds; or 0 to wait indefinitely.
+
+        returns: A concurrent.futures.Future; its result is a memoryview of the data
+            read, for IN transfers, or the number of bytes written, for OUT transfers.
+        """
+        resources = self.device._ctx
+        _, endpoint = resources.setup_request(self.device, endpoint_address)
+
+        transfer_type = self.TRANSFER_TYPES.get(endpoint.bmAttributes & 0x3)
+        if transfer_type is None:
+            raise ValueError("only bulk and interrupt endpoints can be used asynchronously")
+
+        transfer_buffer = (ctypes.c_ubyte * length).from_buffer(buffer)
+        transfer_pointer = self.lib.libusb_alloc_transfer(0)
+        if not transfer_pointer:
+            raise MemoryError("couldn't allocate a libusb transfer")
+
+        transfer = transfer_pointer.contents
+        transfer.dev_handle = resources.handle.handle
+        transfer.flags = 0
+        transfer.endpoint = endpoint_address
+        transfer.type = transfer_type
+        transfer.timeout = timeout
+        transfer.length = length
+        transfer.buffer = ctypes.cast(transfer_buffer, ctypes.c_void_p)
+        transfer.callback = self.callback
+        transfer.num_iso_packets = 0
+
+        # Our futures are running as soon as they're submitted; cancel them with cancel().
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+
+        key = ctypes.addressof(transfer)
+        with self.condition:
+            self.outstanding[key] = (transfer_pointer, transfer_buffer, buffer, future)
+
+        try:
+            self.libusb1._check(self.lib.libusb_submit_transfer(transfer_pointer))
+        except:
+            with self.condition:
+                del self.outstanding[key]
+            self.lib.libusb_free_transfer(transfer_pointer)
+            raise
+
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name="LibUSBHostApp events")
+                self.thread.start()
+            self.condition.notify_all()
+
+        return future
+
+
+    def cancel(self, future):
+        """ Cancels the transfer behind the given future, if it's still outstanding. """
+        with self.condition:
+            transfers = [entry[0] for entry in self.outstanding.values() if entry[3] is future]
+
+        for transfer_pointer in transfers:
+            self.lib.libusb_cancel_transfer(transfer_pointer)
+
+
+    def close(self):
+        """ Cancels any outstanding transfers, and stops our event thread once they've completed. """
+        with self.condition:
+            transfers = [entry[0] for entry in self.outstanding.values()]
+
+        for transfer_pointer in transfers:
+            self.lib.libusb_cancel_transfer(transfer_pointer)
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+            thread = self.thread
+
+        if thread is not None:
+            thread.join()
+
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.outstanding or self.stopping)
+
+                if not self.outstanding:
+                    self.thread = None
+                    return
+
+            self.libusb1._check(self.lib.libusb_handle_events(self.context))
+
+
+    def _complete(self, transfer_pointer):
+        """ Called by libusb, from our event thread, as each transfer completes. """
+        transfer = transfer_pointer.contents
+
+        with self.condition:
+            entry = self.outstanding.pop(ctypes.addressof(transfer), None)
+
+        if entry is None:
+            return
+
+        _, _, buffer, future = entry
+        status, actual_length, endpoint_address = transfer.status, transfer.actual_length, transfer.endpoint
+        self.lib.libusb_free_transfer(transfer_pointer)
+
+        libusb1 = self.libusb1
+
+        if status == libusb1.LIBUSB_TRANSFER_COMPLETED:
+            future.set_result(memoryview(buffer)[:actual_length] if endpoint_address & 0x80 else actual_length)
+        else:
+            error_type = libusb1.USBTimeoutError if status == libusb1.LIBUSB_TRANSFER_TIMED_OUT else libusb1.USBError
+            future.set_exception(error_type(libusb1._str_transfer_error[status], status, libusb1._transfer_errno[status]))
+
+
+
 class LibUSBHostApp(FacedancerUSBHost):
     """
     Class that represets a libusb-based USB host.
@@ -40,13 +211,39 @@ class LibUSBHostApp(FacedancerUSBHost):
         return False
 
 
-    def __init__(self, verbose=0, quirks=[], index=0, **kwargs):
+    def __init__(self, verbose=0, quirks=[], index=0, device=None, **kwargs):
         """
         Creates a new libusb backend for communicating with a target device.
+
+        device -- The pyusb device to talk to. If not provided, we search for one,
+            using kwargs and the LIBUSB_* environment variables.
         """
 
         self.verbose = verbose
-    
+
+        # Transfers submitted with submit_read and submit_write are run through
+        # libusb's asynchronous API where we can, or else by a thread per endpoint.
+        self.async_transfers = None
+        self.endpoint_workers = {}
+
+        if device is None:
+            device = self._find_device(index, **kwargs)
+        self.device = device
+        self.async_transfers = LibUSBAsyncTransfers.for_device(device)
+
+        # Detach any existing drivers, where possible.
+        try:
+            index = self.device.get_active_configuration().index
+            self.device.detach_kernel_driver(index)
+        except:
+            # FIXME: note this here, with a warning?
+            pass
+
+
+    @staticmethod
+    def _find_device(index, **kwargs):
+        """ Finds the device to talk to, given search criteria for usb.core.find. """
+
         # If we have a specified bus/port, accept them.
         # TODO: accept these via quirks?
         desired_bus = os.environ.get('LIBUSB_BUS')
@@ -61,19 +258,13 @@ class LibUSBHostApp(FacedancerUSBHost):
         if desired_address:
             kwargs['address'] = int(desired_address)
 
+        import usb
+
         # Open a connection to the target device...
         usb_devices = list(usb.core.find(find_all=True, **kwargs))
         if len(usb_devices) <= index:
             raise DeviceNotFoundError("Could not find a device to connect to via libusb!")
-        self.device = usb_devices[index]
-
-        # Detach any existing drivers, where possible.
-        try:
-            index = self.device.get_active_configuration().index
-            self.device.detach_kernel_driver(index)
-        except:
-            # FIXME: note this here, with a warning?
-            pass
+        return usb_devices[index]
 
 
     def connect(self):
@@ -197,7 +388,118 @@ class LibUSBHostApp(FacedancerUSBHost):
         raises an IOError on a communications error or stall
         """
         data = self.device.read(endpoint_number, expected_read_size)
-        return data.tostring()
+        return data.tobytes()
+
+
+    def bulk_read(self, endpoint_number, length, buffer=None):
+        """ Reads a large block of data from a bulk IN endpoint.
+
+        libusb splits the read into packets itself, and keeps several of them queued
+        with the host controller at once; so we issue it as a single transfer.
+
+        endpoint_number -- The endpoint number to read from.
+        length -- The maximum amount of data to read.
+        buffer -- A writable buffer of at least length bytes to read into. If it's an
+            array.array('B') of exactly length bytes, libusb fills it directly;
+            reusing one across reads avoids both allocating and copying.
+
+        Returns a memoryview of the data read, backed by the buffer.
+        """
+        if isinstance(buffer, array.array) and len(buffer) == length:
+            target = buffer
+        else:
+            target = array.array('B', bytes(length))
+
+        received = self.device.read(endpoint_number | self.ENDPOINT_DIRECTION_IN, target)
+
+        if buffer is None or target is buffer:
+            return memoryview(target)[:received]
+
+        view = memoryview(buffer)
+        view[:received] = memoryview(target)[:received]
+        return view[:received]
+
+
+    def bulk_write(self, endpoint_number, data):
+        """ Writes a large block of data to a bulk OUT endpoint.
+
+        libusb splits the write into packets itself, keeping several queued with the
+        host controller at once; so we issue it as a single transfer.
+
+        endpoint_number -- The endpoint number to write to.
+        data -- The data to be written; any bytes-like object.
+        """
+        self.device.write(endpoint_number, data)
+
+
+    def submit_read(self, endpoint_number, length, buffer=None):
+        """ Starts a bulk read, without waiting for it to complete.
+
+        Reads are issued through libusb's asynchronous API, so any number can be in
+        flight at once, on one endpoint or many; reads on the same endpoint complete
+        in the order they were submitted. For devices that don't use pyusb's libusb1
+        backend, each endpoint instead gets a thread, which performs its reads one
+        at a time, in order.
+
+        endpoint_number -- The endpoint number to read from.
+        length -- The maximum amount of data to read.
+        buffer -- A writable buffer of at least length bytes to read into; as with
+            bulk_read. It must not be touched until the read completes.
+
+        Returns a concurrent.futures.Future whose result is a memoryview of the data read.
+        """
+        endpoint_address = endpoint_number | self.ENDPOINT_DIRECTION_IN
+
+        if self.async_transfers:
+            if buffer is None:
+                buffer = array.array('B', bytes(length))
+            return self.async_transfers.submit(endpoint_address, buffer, length)
+
+        return self._get_endpoint_worker(endpoint_address).submit(self.bulk_read, endpoint_number, length, buffer)
+
+
+    def submit_write(self, endpoint_number, data):
+        """ Starts a bulk write, without waiting for it to complete.
+
+        endpoint_number -- The endpoint number to write to.
+        data -- The data to be written; it must not be modified until the write completes.
+
+        Returns a concurrent.futures.Future, which completes once the data is written.
+        """
+        if self.async_transfers:
+            buffer = data if isinstance(data, (bytearray, array.array)) else bytearray(data)
+            return self.async_transfers.submit(endpoint_number, buffer, len(buffer))
+
+        return self._get_endpoint_worker(endpoint_number).submit(self.bulk_write, endpoint_number, data)
+
+
+    def cancel_transfer(self, future):
+        """ Cancels a transfer started with submit_read or submit_write, if it hasn't completed. """
+        if self.async_transfers:
+            self.async_transfers.cancel(future)
+        else:
+            future.cancel()
+
+
+    def _get_endpoint_worker(self, endpoint_address):
+        worker = self.endpoint_workers.get(endpoint_address)
+
+        if worker is None:
+            worker = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix="LibUSBHostApp EP{:02x}".format(endpoint_address))
+            self.endpoint_workers[endpoint_address] = worker
+
+        return worker
+
+
+    def close(self):
+        """ Cancels any asynchronous transfers in flight, and stops our transfer threads. """
+        if self.async_transfers:
+            self.async_transfers.close()
+
+        for worker in self.endpoint_workers.values():
+            worker.shutdown(wait=True)
+        self.endpoint_workers = {}
 
 
     def control_request_in(self, request_type, recipient, request, value=0, index=0, length=0):
@@ -214,7 +516,7 @@ class LibUSBHostApp(FacedancerUSBHost):
         request_type = self._build_request_type(True, request_type, recipient)
         data = self.device.ctrl_transfer(request_type, request,
                                          value, index, length)
-        return data.tostring()
+        return data.tobytes()
 
 
     def control_request_out(self, request_type, recipient, request, value=0, index=0, data=[]):
@@ -120,7 +120,7 @@ class MAXUSBApp(FacedancerApp):
         if ep_number == 0:
             self.write_register(self.reg_ep_stalls, 0x23)
         elif ep_number < 4:
-            self.write_writer(self.reg_ep_stalls, 1 << (ep_num + 1))
+            self.write_register(self.reg_ep_stalls, 1 << (ep_number + 1))
         else:
             raise ValueError("Invalid endpoint for MAXUSB device!")
 
@@ -182,7 +182,9 @@ class MAXUSBApp(FacedancerApp):
             req = USBDeviceRequest(b)
             self.connected_device.handle_request(req)
 
-        if irq & self.is_out1_data_avail:
+        # If our device isn't ready for more data, leave it in the FIFO; the
+        # MAX3420 will NAK the host until we've read it.
+        if irq & self.is_out1_data_avail and self.connected_device.can_accept_data(1):
             data = self.read_from_endpoint(1)
             if data:
                 self.connected_device.handle_data_available(1, data)
@@ -5,8 +5,14 @@
 # and GoodFETMonitorApp.
 
 import os
+import time
+import array
+import struct
+import collections
+import concurrent.futures
 
 from .errors import *
+from .USB import USB
 from .USBDevice import USBDevice
 from .USBConfiguration import USBConfiguration
 from .USBEndpoint import USBEndpoint
@@ -156,6 +162,36 @@ class FacedancerUSBHost:
     STANDARD_REQUEST_GET_DESCRIPTOR = 6
     STANDARD_REQUEST_SET_CONFIGURATION = 9
 
+    # The most data bulk_read and bulk_write move in a single endpoint transfer.
+    MAX_BULK_TRANSFER_SIZE = 4096
+
+    # The delay used with the first bus reset while waiting for a device to connect,
+    # which is doubled after each failed attempt, up to the maximum.
+    CONNECT_BACKOFF_INITIAL = 0.1
+    CONNECT_BACKOFF_MAXIMUM = 0.5
+
+    # How much of each configuration descriptor to ask for at first. Most
+    # configurations fit, so we rarely need a second read for the rest.
+    CONFIGURATION_READ_LENGTH = 255
+
+    # The language we read serial numbers in.
+    SERIAL_NUMBER_LANGUAGE_ID = 0x0409
+
+    # Raw descriptors read from devices we've enumerated, shared across host
+    # connections and keyed by (serial number, raw device descriptor). Only devices
+    # with serial numbers are remembered, as identical devices without them can't
+    # be told apart. Each entry maps (descriptor type, index, language ID) to
+    # (length requested, data).
+    known_device_descriptors = {}
+
+    # The descriptor cache for the current device, or None if we're not caching;
+    # see initialize_device.
+    cached_descriptors = None
+    descriptor_cache_hits = 0
+
+    # (step name, duration in seconds) tuples for the last call to initialize_device.
+    enumeration_timings = ()
+
 
     @classmethod
     def autodetect(cls, verbose=0, quirks=None):
@@ -336,7 +372,150 @@ class FacedancerUSBHost:
         self.read_from_endpoint(0, 0, data_packet_pid=1)
 
 
-    def initialize_device(self, apply_configuration=0, assign_address=0):
+    def bulk_read(self, endpoint_number, length, buffer=None):
+        """ Reads a large block of data from a bulk IN endpoint.
+
+        The read is split into as many endpoint transfers as necessary. As with any
+        bulk transfer, it ends early if the device sends a short packet.
+
+        endpoint_number -- The endpoint number to read from.
+        length -- The maximum amount of data to read.
+        buffer -- A writable buffer of at least length bytes to read into, e.g. a bytearray.
+            Reusing a buffer across reads avoids allocating a new one each time.
+
+        Returns a memoryview of the data read, backed by the buffer.
+        """
+        if buffer is None:
+            buffer = bytearray(length)
+
+        view = memoryview(buffer)
+        position = 0
+
+        while position < length:
+            requested = min(self.MAX_BULK_TRANSFER_SIZE, length - position)
+            received = self._read_from_endpoint_into(endpoint_number, view[position:position + requested])
+            position += received
+
+            # A short transfer means the device has nothing more to send.
+            if received < requested:
+                break
+
+        return view[:position]
+
+
+    def _read_from_endpoint_into(self, endpoint_number, view):
+        """
+        Performs a single endpoint transfer into the given memoryview, and returns
+        the number of bytes read. Backends can override this to avoid copying.
+        """
+        data = self.read_from_endpoint(endpoint_number, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+    def bulk_write(self, endpoint_number, data):
+        """ Writes a large block of data to a bulk OUT endpoint.
+
+        The write is split into as many endpoint transfers as necessary; slices of
+        the data are sent directly, without being copied.
+
+        endpoint_number -- The endpoint number to write to.
+        data -- The data to be written; any bytes-like object.
+        """
+        view = memoryview(data)
+        transfer_size = self.MAX_BULK_TRANSFER_SIZE
+
+        for position in range(0, len(view), transfer_size):
+            self.send_on_endpoint(endpoint_number, view[position:position + transfer_size])
+
+
+    def submit_read(self, endpoint_number, length, buffer=None):
+        """ Starts a bulk read, without waiting for it to complete.
+
+        Backends that can have several transfers in flight at once override this;
+        by default, the read is performed immediately. Either way, reads on the same
+        endpoint complete in the order they were submitted.
+
+        endpoint_number -- The endpoint number to read from.
+        length -- The maximum amount of data to read.
+        buffer -- A writable buffer of at least length bytes to read into; as with bulk_read.
+
+        Returns a concurrent.futures.Future whose result is a memoryview of the data read.
+        """
+        return self._completed_future(self.bulk_read, endpoint_number, length, buffer)
+
+
+    def submit_write(self, endpoint_number, data):
+        """ Starts a bulk write, without waiting for it to complete.
+
+        endpoint_number -- The endpoint number to write to.
+        data -- The data to be written; it must not be modified until the write completes.
+
+        Returns a concurrent.futures.Future, which completes once the data is written.
+        """
+        return self._completed_future(self.bulk_write, endpoint_number, data)
+
+
+    def cancel_transfer(self, future):
+        """ Cancels a transfer started with submit_read or submit_write, if it hasn't completed. """
+        future.cancel()
+
+
+    @staticmethod
+    def _completed_future(function, *args):
+        future = concurrent.futures.Future()
+
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+    def stream_read(self, endpoint_number, transfer_size, count=None, depth=4):
+        """ Reads continuously from a bulk IN endpoint, keeping several reads outstanding.
+
+        Each read gets its own buffer, allocated up front and reused; so each block of
+        data yielded is only valid until the next is requested. Copy any you need to keep.
+
+        endpoint_number -- The endpoint number to read from.
+        transfer_size -- The maximum amount of data to read with each transfer.
+        count -- The number of transfers to perform; or None to read until stopped.
+        depth -- The number of reads to keep outstanding.
+
+        Yields a memoryview of the data read by each transfer, in the order the
+        device sent it.
+        """
+        buffers = [array.array('B', bytes(transfer_size)) for _ in range(depth)]
+        pending = collections.deque()
+        submitted = 0
+
+        def submit(buffer):
+            nonlocal submitted
+            if count is None or submitted < count:
+                pending.append((buffer, self.submit_read(endpoint_number, transfer_size, buffer)))
+                submitted += 1
+
+        try:
+            for buffer in buffers:
+                submit(buffer)
+
+            while pending:
+                buffer, future = pending.popleft()
+                yield future.result()
+
+                # Once the consumer's done with this buffer, read into it again.
+                submit(buffer)
+
+        finally:
+            # Let any reads still in flight finish before their buffers are released.
+            for _, future in pending:
+                self.cancel_transfer(future)
+            concurrent.futures.wait([future for _, future in pending])
+
+
+    def initialize_device(self, apply_configuration=0, assign_address=0, timeout=None, use_cache=True):
         """
         Sets up a conenction to a directly-attached USB device.
 
@@ -344,13 +523,36 @@ class FacedancerUSBHost:
             index will be applied to the relevant device.
         assign_address -- If non-zero, the device will be assigned the given
             address as part of the enumeration/initialization process.
+        timeout -- The longest to wait for a device to connect, in seconds; or
+            None to wait indefinitely. Raises DeviceNotFoundError on timeout.
+        use_cache -- If true, the device's standard descriptors are cached; and if
+            we've seen the same device before, identified by its serial number,
+            its descriptors aren't read again.
+
+        The time taken by each step is stored in enumeration_timings.
         """
 
-        # TODO: support timeouts in waiting for a connection
+        timings = self.enumeration_timings = []
+        step_started = time.monotonic()
+        deadline = step_started + timeout if timeout is not None else None
+
+        def finish_step(name):
+            nonlocal step_started
+            now = time.monotonic()
+            timings.append((name, now - step_started))
+            step_started = now
 
-        # Repeatedly attempt to connect to any connected devices.
+        # Repeatedly attempt to connect to any connected devices, backing off between
+        # attempts, so devices that are slow to connect don't need a flood of resets.
+        backoff = self.CONNECT_BACKOFF_INITIAL
         while not self.device_is_connected():
-            self.bus_reset()
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeviceNotFoundError("No device connected within {}s!".format(timeout))
+
+            self.bus_reset(delay=backoff)
+            backoff = min(backoff * 2, self.CONNECT_BACKOFF_MAXIMUM)
+
+        finish_step("connect")
 
         # Assume the default device addresses, and read the device's speed.
         self.last_device_address = 0
@@ -360,6 +562,13 @@ class FacedancerUSBHost:
         if self.verbose > 3:
             print("Initializing control endpoint...")
         self.initialize_control_endpoint()
+        finish_step("control endpoint")
+
+        # Figure out which device this is, so we can reuse anything we've read from it before.
+        self.cached_descriptors = {} if use_cache else None
+        if use_cache:
+            self._identify_device()
+            finish_step("identify")
 
         # If we've been asked to assign an address,
         # set the device's address, and reinitialize the control endpoint
@@ -367,22 +576,83 @@ class FacedancerUSBHost:
         if assign_address:
             self.set_address(assign_address)
             self.initialize_control_endpoint()
+            finish_step("set address")
 
         # If we're auto-configuring the device, read the full configuration descriptor,
         # assign the first configuration, and then set up endpoints accordingly
         if apply_configuration:
             self.apply_configuration(apply_configuration)
+            finish_step("configure")
+
+
+    def _identify_device(self):
+        """
+        Reads the device's identity-- its device descriptor and serial number--
+        and, if we've enumerated it before, switches to the descriptors we cached then.
+        Devices without a serial number are only cached for this enumeration.
+        """
+        raw_descriptor = self.get_descriptor(USBDevice.DESCRIPTOR_TYPE_NUMBER, 0, 0, USBDevice.DESCRIPTOR_LENGTH)
+
+        # If we couldn't read the whole descriptor (e.g. because its control endpoint
+        # has a smaller maximum packet size than we've assumed), don't guess.
+        if raw_descriptor is None or len(raw_descriptor) < USBDevice.DESCRIPTOR_LENGTH:
+            self.cached_descriptors = None
+            return
+
+        serial_number_index = raw_descriptor[16]
+
+        serial_number = None
+        if serial_number_index:
+            raw_string = self.get_descriptor(USB.desc_type_string, serial_number_index,
+                                             self.SERIAL_NUMBER_LANGUAGE_ID, 255)
+            if raw_string:
+                serial_number = bytes(raw_string[2:raw_string[0]]).decode('utf_16_le', errors='replace')
+
+        # Without a serial number, this could be any of several identical devices;
+        # keep what we read to ourselves.
+        if not serial_number:
+            return
+
+        identity = (serial_number, bytes(raw_descriptor))
+        known_descriptors = self.known_device_descriptors.setdefault(identity, {})
+        known_descriptors.update(self.cached_descriptors)
+        self.cached_descriptors = known_descriptors
+
+
+    def forget_device_descriptors(self):
+        """ Discards all cached descriptors, e.g. after a device's firmware has changed. """
+        self.known_device_descriptors.clear()
+
+        if self.cached_descriptors is not None:
+            self.cached_descriptors = {}
 
 
     def get_descriptor(self, descriptor_type, descriptor_index,
                        language_id, max_length):
         """ Reads up to max_length bytes of a device's descriptors. """
 
-        return self.control_request_in(
+        cache = self.cached_descriptors
+        key = (descriptor_type, descriptor_index, language_id)
+
+        # If we've already read enough of this descriptor, use our cached copy. If
+        # the device sent less than we asked for, we have the whole descriptor.
+        if cache is not None and key in cache:
+            requested, data = cache[key]
+
+            if max_length <= requested or len(data) < requested:
+                self.descriptor_cache_hits += 1
+                return data[:max_length]
+
+        data = self.control_request_in(
                 self.REQUEST_TYPE_STANDARD, self.REQUEST_RECIPIENT_DEVICE,
                 self.STANDARD_REQUEST_GET_DESCRIPTOR,
                 (descriptor_type << 8) | descriptor_index, language_id, max_length)
 
+        if cache is not None and data is not None:
+            cache[key] = (max_length, bytes(data))
+
+        return data
+
 
     def get_device_descriptor(self, max_length=18):
         """ Returns the device's device descriptor. """
@@ -397,13 +667,18 @@ class FacedancerUSBHost:
         include_subordinate -- if true, subordinate descriptors will also be returned
         """
 
-        # Read just the raw configuration descriptor.
-        raw_descriptor = self.get_descriptor(USBConfiguration.DESCRIPTOR_TYPE_NUMBER, index, 0, USBConfiguration.DESCRIPTOR_SIZE_BYTES)
+        if not include_subordinates:
+            raw_descriptor = self.get_descriptor(USBConfiguration.DESCRIPTOR_TYPE_NUMBER, index, 0, USBConfiguration.DESCRIPTOR_SIZE_BYTES)
+            return USBConfiguration.from_binary_descriptor(raw_descriptor)
+
+        # Read the configuration descriptor, along with as many of its subordinate
+        # descriptors as are likely to fit...
+        raw_descriptor = self.get_descriptor(USBConfiguration.DESCRIPTOR_TYPE_NUMBER, index, 0, self.CONFIGURATION_READ_LENGTH)
 
-        # If we want to include the subordinate descriptors, read-read the configuration descriptor with an updated length.
-        if include_subordinates:
-            descriptor = USBConfiguration.from_binary_descriptor(raw_descriptor)
-            raw_descriptor = self.get_descriptor(USBConfiguration.DESCRIPTOR_TYPE_NUMBER, index, 0, descriptor.total_descriptor_lengths)
+        # ... and if they didn't all fit, re-read the configuration descriptor with an updated length.
+        total_length = struct.unpack_from('<H', raw_descriptor, 2)[0] if len(raw_descriptor) >= 4 else 0
+        if total_length > len(raw_descriptor):
+            raw_descriptor = self.get_descriptor(USBConfiguration.DESCRIPTOR_TYPE_NUMBER, index, 0, total_length)
 
         return USBConfiguration.from_binary_descriptor(raw_descriptor)
 
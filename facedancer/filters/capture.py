@@ -0,0 +1,264 @@
+#
+# USBProxy capture filters
+#
+
+import time
+import queue
+import errno
+import struct
+import atexit
+import threading
+
+from ..USBProxy import USBProxyFilter
+from ..USBEndpoint import USBEndpoint
+
+
+class USBProxyCaptureFilter(USBProxyFilter):
+    """
+    Filter that captures proxied USB traffic to a pcapng file, which can be opened
+    in Wireshark. Packets are framed as Linux usbmon records, so Wireshark's USB
+    dissectors can decode control requests and descriptors.
+
+    Each packet is only timestamped and queued from the proxy's event loop; the
+    records are formatted and written from a background thread.
+    """
+
+    # pcapng block types.
+    SECTION_HEADER_BLOCK   = 0x0A0D0D0A
+    INTERFACE_DESCRIPTION  = 0x00000001
+    ENHANCED_PACKET_BLOCK  = 0x00000006
+
+    BYTE_ORDER_MAGIC       = 0x1A2B3C4D
+
+    # LINKTYPE_USB_LINUX_MMAPPED: a 64-byte usbmon header, followed by the packet.
+    LINKTYPE_USB_LINUX_MMAPPED = 220
+
+    # Interface options.
+    OPTION_END_OF_OPTIONS  = 0
+    OPTION_IF_TSRESOL      = 9
+
+    # Our timestamps are in nanoseconds.
+    TIMESTAMP_RESOLUTION   = 9
+
+    SNAPLEN = 0x40000
+
+    ENHANCED_PACKET       = struct.Struct('<IIIIIII')
+    USBMON_HEADER         = struct.Struct('<QBBBBHccqiiII8siiII')
+
+    # usbmon event types.
+    EVENT_SUBMIT   = b'S'
+    EVENT_COMPLETE = b'C'
+
+    # usbmon transfer types, indexed by USB transfer type.
+    USBMON_TRANSFER_TYPES = {
+        USBEndpoint.transfer_type_isochronous:  0,
+        USBEndpoint.transfer_type_interrupt:    1,
+        USBEndpoint.transfer_type_control:      2,
+        USBEndpoint.transfer_type_bulk:         3,
+    }
+    USBMON_CONTROL = 2
+
+    # Maximum number of records to format before handing them to the file.
+    WRITE_BATCH_SIZE = 256
+
+
+    def __init__(self, device, filename, bus_number=1, buffer_size=1024 * 1024):
+        """
+        Sets up a new capture filter, and starts writing its capture file.
+
+        device: The USBProxyDevice whose traffic is being captured. Used to look up
+            the device's address and the transfer types of its endpoints.
+        filename: The pcapng file to write.
+        bus_number: The bus number to report for the captured device.
+        buffer_size: The size of the file's write buffer, in bytes.
+        """
+        self.device     = device
+        self.bus_number = bus_number
+
+        # Each record is a tuple of (URB ID, timestamp, device address, event type,
+        # usbmon transfer type, endpoint address, status, setup packet, length, data).
+        self.records    = queue.SimpleQueue()
+        self.urb_id     = 0
+
+        # The URB ID of the control OUT request awaiting its completion, if any.
+        self.control_out_urb_id = None
+
+        self.records_written = 0
+        self.bytes_written   = 0
+
+        self.file = open(filename, 'wb', buffering=buffer_size)
+        self.file.write(self._section_header() + self._interface_description())
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True, name="USBProxy capture writer")
+        self.thread.start()
+
+        # Make sure everything we've queued makes it to disk, even if we're never
+        # explicitly closed.
+        atexit.register(self.close)
+
+
+    def close(self):
+        """ Writes any queued records, and closes the capture file. """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.records.put(None)
+        self.thread.join()
+        self.file.close()
+
+        atexit.unregister(self.close)
+
+
+    def filter_control_in(self, req, data, stalled):
+        if req is not None:
+            urb_id = self._next_urb_id()
+            data_captured = bytes(data) if data and not stalled else b''
+
+            self._queue(urb_id, self.EVENT_SUBMIT, self.USBMON_CONTROL, 0x80, 0, req.raw(), req.length)
+            self._queue(urb_id, self.EVENT_COMPLETE, self.USBMON_CONTROL, 0x80,
+                        -errno.EPIPE if stalled else 0, None, len(data_captured), data_captured)
+
+        return req, data, stalled
+
+
+    def filter_control_out(self, req, data):
+        if req is not None:
+            self.control_out_urb_id = self._next_urb_id()
+            self._queue(self.control_out_urb_id, self.EVENT_SUBMIT, self.USBMON_CONTROL, 0x00, 0,
+                        req.raw(), req.length, bytes(data) if data else b'')
+
+        return req, data
+
+
+    def handle_out_request_complete(self, req, data):
+        self._complete_control_out(0, len(data) if data else 0)
+        return req, data
+
+
+    def handle_out_request_stall(self, req, data, stalled):
+        self._complete_control_out(-errno.EPIPE if stalled else 0)
+        return req, data, stalled
+
+
+    def _complete_control_out(self, status, length=0):
+        """ Records the completion of the control OUT request we last saw submitted. """
+        urb_id, self.control_out_urb_id = self.control_out_urb_id, None
+
+        if urb_id is not None:
+            self._queue(urb_id, self.EVENT_COMPLETE, self.USBMON_CONTROL, 0x00, status, None, length)
+
+
+    def filter_in(self, ep_num, data):
+        if data is not None:
+            self._queue(self._next_urb_id(), self.EVENT_COMPLETE, self._get_transfer_type(ep_num),
+                        ep_num | 0x80, 0, None, len(data), bytes(data))
+
+        return ep_num, data
+
+
+    def filter_out(self, ep_num, data):
+        if data is not None:
+            self._queue(self._next_urb_id(), self.EVENT_SUBMIT, self._get_transfer_type(ep_num),
+                        ep_num, 0, None, len(data), bytes(data))
+
+        return ep_num, data
+
+
+    def handle_out_stall(self, ep_num, data, stalled):
+        if stalled:
+            self._queue(self._next_urb_id(), self.EVENT_COMPLETE, self._get_transfer_type(ep_num),
+                        ep_num, -errno.EPIPE)
+
+        return ep_num, data, stalled
+
+
+    def _queue(self, urb_id, event, transfer_type, endpoint_address, status, setup=None, length=0, data=b''):
+        """ Timestamps a record, and queues it to be written. """
+        self.records.put((urb_id, time.time_ns(), self.device.address, event, transfer_type,
+                          endpoint_address, status, setup, length, data))
+
+
+    def _next_urb_id(self):
+        self.urb_id += 1
+        return self.urb_id
+
+
+    def _get_transfer_type(self, ep_num):
+        """ Returns the usbmon transfer type for the given endpoint. """
+        endpoint = getattr(self.device, 'endpoints', {}).get(ep_num)
+
+        if endpoint is None:
+            return self.USBMON_TRANSFER_TYPES[USBEndpoint.transfer_type_bulk]
+
+        return self.USBMON_TRANSFER_TYPES[endpoint.transfer_type]
+
+
+    def _section_header(self):
+        """ Returns a pcapng Section Header Block. """
+        length = 28
+        return struct.pack('<IIIHHqI', self.SECTION_HEADER_BLOCK, length, self.BYTE_ORDER_MAGIC,
+                           1, 0, -1, length)
+
+
+    def _interface_description(self):
+        """ Returns a pcapng Interface Description Block for our single USB interface. """
+        options = struct.pack('<HHB3x', self.OPTION_IF_TSRESOL, 1, self.TIMESTAMP_RESOLUTION)
+        options += struct.pack('<HH', self.OPTION_END_OF_OPTIONS, 0)
+
+        length = 20 + len(options)
+        return struct.pack('<IIHHI', self.INTERFACE_DESCRIPTION, length, self.LINKTYPE_USB_LINUX_MMAPPED,
+                           0, self.SNAPLEN) + options + struct.pack('<I', length)
+
+
+    def _format_record(self, record):
+        """ Formats a queued record as a pcapng Enhanced Packet Block. """
+        urb_id, timestamp, address, event, transfer_type, endpoint_address, status, setup, length, data = record
+
+        seconds, nanoseconds = divmod(timestamp, 1000000000)
+
+        usbmon_header = self.USBMON_HEADER.pack(
+            urb_id, event[0], transfer_type, endpoint_address, address, self.bus_number,
+            b'\0' if setup else b'-',
+            b'\0' if data else (b'<' if endpoint_address & 0x80 else b'>'),
+            seconds, nanoseconds // 1000, status, length, len(data),
+            setup if setup else bytes(8), 0, 0, 0, 0)
+
+        captured_length = len(usbmon_header) + len(data)
+        padding = -captured_length % 4
+        block_length = self.ENHANCED_PACKET.size + captured_length + padding + 4
+
+        return b''.join((
+            self.ENHANCED_PACKET.pack(self.ENHANCED_PACKET_BLOCK, block_length, 0,
+                                      timestamp >> 32, timestamp & 0xFFFFFFFF,
+                                      captured_length, captured_length),
+            usbmon_header, data, bytes(padding), struct.pack('<I', block_length)
+        ))
+
+
+    def _run(self):
+        """ Writes queued records to our capture file until we're closed. """
+        while True:
+            records = [self.records.get()]
+
+            # Gather up whatever else is waiting, so we can write it all at once.
+            try:
+                while len(records) < self.WRITE_BATCH_SIZE:
+                    records.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+
+            stopping = None in records
+            if stopping:
+                records = records[:records.index(None)]
+
+            blocks = b''.join(self._format_record(record) for record in records)
+            self.file.write(blocks)
+
+            self.records_written += len(records)
+            self.bytes_written   += len(blocks)
+
+            if stopping:
+                self.file.flush()
+                return
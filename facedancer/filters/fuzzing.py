@@ -0,0 +1,293 @@
+#
+# USBProxy fuzzing filters, which mutate the data a proxied device returns
+#
+
+import sys
+import time
+import random
+
+from ..USBProxy import USBProxyFilter
+
+
+class USBProxyFuzzingFilter(USBProxyFilter):
+    """
+    Filter that mutates the data returned by the proxied device, to fuzz the host's
+    drivers with traffic that's mostly realistic.
+
+    Mutations are drawn from a schedule generated up front from a seed. The filter
+    counts the packets it sees; packet n receives mutation n of the schedule, which
+    may be no mutation at all. So mutating a packet takes only a table lookup and
+    the mutation itself, and a run can be reproduced exactly from its seed. Each
+    mutated packet's index is logged, so a crash can be traced back to the packets
+    that caused it; and replay() reproduces any packet's mutation on its own.
+
+    Mutations include bit flips, bytes set to boundary values, truncation, added
+    data, and-- for descriptors read over the control endpoint-- boundary values
+    in the fields that describe lengths and counts.
+
+    This filter should be added after USBProxySetupFilters, so the Facedancer is
+    configured from the device's real descriptors, rather than the mutated ones.
+    """
+
+    # Kinds of mutation.
+    MUTATION_NONE     = 0
+    MUTATION_BIT_FLIP = 1
+    MUTATION_BYTE     = 2
+    MUTATION_TRUNCATE = 3
+    MUTATION_EXTEND   = 4
+    MUTATION_FIELD    = 5
+
+    MUTATION_NAMES = {
+        MUTATION_NONE:     'none',
+        MUTATION_BIT_FLIP: 'bit_flip',
+        MUTATION_BYTE:     'byte',
+        MUTATION_TRUNCATE: 'truncate',
+        MUTATION_EXTEND:   'extend',
+        MUTATION_FIELD:    'field',
+    }
+
+    # Byte values most likely to find edge cases.
+    BOUNDARY_BYTES = (0x00, 0x01, 0x7F, 0x80, 0xFE, 0xFF)
+
+    # Values for descriptor fields, which can be up to 16 bits long.
+    BOUNDARY_VALUES = (0x0000, 0x0001, 0x0002, 0x007F, 0x0080, 0x00FF, 0x0100, 0x7FFF, 0x8000, 0xFFFF)
+
+    # The fields that describe lengths and counts in each type of descriptor,
+    # as (offset, size) tuples.
+    DESCRIPTOR_FIELDS = {
+        0x01: ((0, 1), (7, 1), (17, 1)),                   # device: bLength, bMaxPacketSize0, bNumConfigurations
+        0x02: ((0, 1), (2, 2), (4, 1)),                    # configuration: bLength, wTotalLength, bNumInterfaces
+        0x03: ((0, 1),),                                   # string: bLength
+        0x04: ((0, 1), (4, 1)),                            # interface: bLength, bNumEndpoints
+        0x05: ((0, 1), (4, 2), (6, 1)),                    # endpoint: bLength, wMaxPacketSize, bInterval
+        0x0F: ((0, 1), (2, 2), (4, 1)),                    # BOS: bLength, wTotalLength, bNumDeviceCaps
+        0x21: ((0, 1), (5, 1), (7, 2)),                    # HID: bLength, bNumDescriptors, wDescriptorLength
+    }
+
+    # The relative likelihood of each kind of mutation.
+    DATA_MUTATIONS    = ((MUTATION_BIT_FLIP, 4), (MUTATION_BYTE, 3), (MUTATION_TRUNCATE, 1), (MUTATION_EXTEND, 1))
+    CONTROL_MUTATIONS = DATA_MUTATIONS + ((MUTATION_FIELD, 6),)
+
+    # The most bytes an extend mutation adds.
+    MAX_EXTENSION = 64
+
+
+    def __init__(self, device, seed=None, probability=0.1, endpoints=None, control=True,
+                 schedule_length=1 << 16, log_filename=None, report_interval=None):
+        """
+        Sets up a new fuzzing filter, and generates its mutation schedules.
+
+        device: The USBProxyDevice being fuzzed.
+        seed: The seed for our mutation schedules. If not provided, one is chosen
+            at random; either way, it's available as our seed attribute.
+        probability: The fraction of packets to mutate.
+        endpoints: The IN endpoint numbers to fuzz; or None to fuzz every endpoint.
+        control: True iff responses to control requests should be fuzzed, too.
+        schedule_length: The number of mutations in each schedule; must be a power
+            of two. Longer schedules take longer to generate, but repeat less often.
+        log_filename: If provided, each mutated packet is logged to this file.
+        report_interval: If provided, the mutation rate is printed every
+            report_interval seconds.
+        """
+        if schedule_length & (schedule_length - 1):
+            raise ValueError("schedule_length must be a power of two")
+
+        self.device = device
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        self.probability = probability
+        self.endpoints = set(endpoints) if endpoints is not None else None
+        self.control = control
+
+        # Endpoint data and control responses each get their own schedule, so the
+        # mutations applied to one don't depend on how much of the other there's been.
+        self.schedule_mask = schedule_length - 1
+        self.data_schedule = self._generate_schedule('data', self.DATA_MUTATIONS, schedule_length)
+        self.control_schedule = self._generate_schedule('control', self.CONTROL_MUTATIONS, schedule_length)
+
+        self.data_index = 0
+        self.control_index = 0
+
+        self.mutated = 0
+        self.started = time.monotonic()
+        self.report_interval = report_interval
+        self.last_report = self.started
+        self.last_report_mutated = 0
+
+        self.log_file = None
+        if log_filename:
+            self.log_file = open(log_filename, 'w', buffering=1 << 16)
+            self.log_file.write("# seed {} probability {}\n# stream index address mutation\n".format(
+                self.seed, self.probability))
+
+        if report_interval:
+            device.scheduler.add_task(self.service)
+
+
+    def close(self):
+        """ Flushes and closes our log. """
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+
+    def handles(self, hook_name):
+        if hook_name == 'filter_control_in':
+            return self.control
+        return hook_name == 'filter_in'
+
+
+    def _generate_schedule(self, stream, mutations, length):
+        """
+        Generates a mutation schedule: a list of (kind, a, b) tuples, with
+        arguments that depend on the kind of mutation.
+        """
+
+        # Seed each stream separately; string seeds are hashed deterministically.
+        rng = random.Random("{}:{}".format(self.seed, stream))
+
+        kinds = [kind for kind, _ in mutations]
+        weights = [weight for _, weight in mutations]
+        no_mutation = (self.MUTATION_NONE, 0, 0)
+
+        schedule = []
+        for kind in rng.choices(kinds, weights, k=length):
+            if rng.random() < self.probability:
+                schedule.append(self._generate_mutation(rng, kind))
+            else:
+                schedule.append(no_mutation)
+
+        return schedule
+
+
+    @classmethod
+    def _generate_mutation(cls, rng, kind):
+        # Offsets are generated without knowing the packets' lengths; they're
+        # reduced modulo the length when they're applied.
+        if kind == cls.MUTATION_BIT_FLIP:
+            return kind, rng.getrandbits(16), 1 << rng.randrange(8)
+        if kind == cls.MUTATION_BYTE:
+            return kind, rng.getrandbits(16), rng.choice(cls.BOUNDARY_BYTES)
+        if kind == cls.MUTATION_TRUNCATE:
+            return kind, rng.getrandbits(16), 0
+        if kind == cls.MUTATION_EXTEND:
+            return kind, bytes(rng.getrandbits(8) for _ in range(rng.randint(1, cls.MAX_EXTENSION))), 0
+        if kind == cls.MUTATION_FIELD:
+            return kind, rng.getrandbits(8), rng.choice(cls.BOUNDARY_VALUES)
+
+        return cls.MUTATION_NONE, 0, 0
+
+
+    def mutate(self, data, mutation):
+        """
+        Applies a single mutation to the given data.
+
+        data: The packet or response to be mutated.
+        mutation: A (kind, a, b) mutation, as found in our schedules.
+
+        returns: The mutated data; or the original data, if the mutation doesn't apply.
+        """
+        kind, a, b = mutation
+        length = len(data)
+
+        if kind == self.MUTATION_EXTEND:
+            return bytes(data) + a
+
+        if not length:
+            return data
+
+        if kind == self.MUTATION_BIT_FLIP:
+            data = bytearray(data)
+            data[a % length] ^= b
+        elif kind == self.MUTATION_BYTE:
+            data = bytearray(data)
+            data[a % length] = b
+        elif kind == self.MUTATION_TRUNCATE:
+            data = data[:a % length]
+        elif kind == self.MUTATION_FIELD:
+            fields = self.DESCRIPTOR_FIELDS.get(data[1]) if length > 1 else None
+
+            if fields is None:
+                return data
+
+            offset, size = fields[a % len(fields)]
+            if offset + size > length:
+                return data
+
+            data = bytearray(data)
+            data[offset:offset + size] = (b & ((1 << (size * 8)) - 1)).to_bytes(size, 'little')
+
+        return data
+
+
+    def replay(self, data, stream, index):
+        """
+        Reproduces the mutation that packet index of the given stream ('data' or
+        'control') received, on the given data.
+        """
+        schedule = self.control_schedule if stream == 'control' else self.data_schedule
+        return self.mutate(data, schedule[index & self.schedule_mask])
+
+
+    def _log_mutation(self, stream, index, address, kind):
+        self.mutated += 1
+
+        if self.log_file:
+            self.log_file.write("{} {} {:02x} {}\n".format(stream, index, address, self.MUTATION_NAMES[kind]))
+
+        statistics = self.device.statistics
+        if statistics:
+            statistics.record_event(address, 'fuzz_mutation')
+
+
+    def filter_control_in(self, req, data, stalled):
+        if stalled or req is None or data is None:
+            return req, data, stalled
+
+        index = self.control_index
+        self.control_index = index + 1
+
+        mutation = self.control_schedule[index & self.schedule_mask]
+        if mutation[0]:
+            data = self.mutate(data, mutation)
+            self._log_mutation('control', index, 0x80, mutation[0])
+
+        return req, data, stalled
+
+
+    def filter_in(self, ep_num, data):
+        # Packets on endpoints we're not fuzzing don't advance our schedule, so it
+        # depends only on the traffic we fuzz.
+        if data is None or (self.endpoints is not None and ep_num not in self.endpoints):
+            return ep_num, data
+
+        index = self.data_index
+        self.data_index = index + 1
+
+        mutation = self.data_schedule[index & self.schedule_mask]
+        if mutation[0]:
+            data = self.mutate(data, mutation)
+            self._log_mutation('data', index, ep_num | 0x80, mutation[0])
+
+        return ep_num, data
+
+
+    @property
+    def mutations_per_second(self):
+        """ The average rate at which we've mutated packets since we were created. """
+        elapsed = time.monotonic() - self.started
+        return self.mutated / elapsed if elapsed else 0.0
+
+
+    def service(self):
+        """ Prints a periodic report of our mutation rate, when one's due. """
+        now = time.monotonic()
+        if now - self.last_report < self.report_interval:
+            return
+
+        recent = (self.mutated - self.last_report_mutated) / (now - self.last_report)
+        print("-- fuzzer (seed {}): {} packets mutated, {:.1f}/s ({:.1f}/s overall); at data {}, control {} --".format(
+            self.seed, self.mutated, recent, self.mutations_per_second, self.data_index, self.control_index),
+            file=sys.stderr)
+
+        self.last_report = now
+        self.last_report_mutated = self.mutated
@@ -0,0 +1,62 @@
+#
+# USBProxy recording filters
+#
+
+from ..USBProxy import USBProxyFilter
+from ..USBSession import USBSessionWriter
+
+
+class USBProxyRecordingFilter(USBProxyFilter):
+    """
+    Filter that records a proxy session to a session file, which can later be
+    replayed without the original device by a USBReplayDevice. Add this filter
+    after any filters that modify traffic, so it records what the host saw.
+    """
+
+    def __init__(self, filename):
+        """
+        Sets up a new recording filter.
+
+        filename: The session file to write.
+        """
+        self.session = USBSessionWriter(filename)
+
+
+    def close(self):
+        """ Finishes the recording, writing the session's index. """
+        self.session.close()
+
+
+    def filter_control_in(self, req, data, stalled):
+        if req is not None:
+            self.session.record_control_in(req.raw(), data, stalled)
+
+        return req, data, stalled
+
+
+    def filter_control_out(self, req, data):
+        if req is not None:
+            self.session.record_control_out(req.raw(), data)
+
+        return req, data
+
+
+    def handle_out_request_stall(self, req, data, stalled):
+        if stalled:
+            self.session.mark_control_out_stalled()
+
+        return req, data, stalled
+
+
+    def filter_in(self, ep_num, data):
+        if data is not None:
+            self.session.record_packet(self.session.KIND_IN, ep_num, data)
+
+        return ep_num, data
+
+
+    def filter_out(self, ep_num, data):
+        if data is not None:
+            self.session.record_packet(self.session.KIND_OUT, ep_num, data)
+
+        return ep_num, data
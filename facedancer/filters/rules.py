@@ -0,0 +1,303 @@
+#
+# USBProxy rule-based filters
+#
+
+import json
+
+from ..USBProxy import USBProxyFilter
+
+
+class USBProxyRuleFilter(USBProxyFilter):
+    """
+    Filter that modifies proxied traffic according to a list of declarative rules,
+    rather than hand-written code. Rules are usually loaded from a JSON file:
+
+        [
+            {"endpoint": 1, "direction": "in", "xor": {"offset": 3, "value": "ff"}},
+            {"endpoint": 1, "direction": "in",
+             "match": {"offset": 0, "value": "0000", "mask": "ff0f"},
+             "set": [{"offset": 4, "value": "80"}]},
+            {"endpoint": 2, "direction": "out", "drop": true},
+            {"remap": {"from": 2, "to": 1}, "direction": "in"},
+            {"control": {"request_type": 161, "request": 1}, "stall": true}
+        ]
+
+    Endpoint rules apply to data packets on the given endpoint number, in the
+    given direction. They can have:
+        match: A pattern, or list of patterns, that the packet must match for the
+            rule to apply. Each has an offset, a hex value, and optionally a hex
+            mask of the bits to compare.
+        set: One or more {offset, value} patches that overwrite the packet's bytes.
+        xor: One or more {offset, value} patches that are XOR'd into the packet.
+        drop: If true, the packet is discarded: IN packets are NAK'd, and OUT
+            packets are never sent to the proxied device.
+
+    Remap rules redirect one of the host's endpoints to a different endpoint on
+    the proxied device.
+
+    Control rules apply to control requests whose SETUP fields (request_type,
+    request, value, index) match those given. They can drop the request, stall it
+    (IN requests only), or have their match/set/xor applied to the request's data.
+
+    Rules are applied in order, and every matching rule applies; a rule that drops
+    or stalls a packet ends processing. Rules are compiled into byte-slice matchers
+    and patchers when the filter is created, so little work is done per packet.
+    """
+
+    DIRECTIONS = ('in', 'out')
+    CONTROL_FIELDS = ('request_type', 'request', 'value', 'index')
+
+
+    def __init__(self, rules):
+        """
+        Sets up a new rule filter.
+
+        rules: A list of rules, as described above.
+        """
+
+        # Compiled rules for data packets, by (direction, endpoint number); and for
+        # control requests, by direction. Each compiled rule is a tuple of
+        # (matchers, patchers, drop, stall).
+        self.endpoint_rules = {}
+        self.control_rules = {direction: [] for direction in self.DIRECTIONS}
+
+        # Endpoint remapping, from the host's endpoint number to the device's.
+        self.remaps = {direction: {} for direction in self.DIRECTIONS}
+
+        for number, rule in enumerate(rules):
+            try:
+                self._compile_rule(rule)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError("invalid rule {} ({}): {}".format(number, rule, e))
+
+        # Only see traffic on the endpoints we have rules for.
+        self.endpoints = set(ep_num for _, ep_num in self.endpoint_rules)
+        for remaps in self.remaps.values():
+            self.endpoints.update(remaps)
+
+
+    @classmethod
+    def load(cls, filename):
+        """ Creates a rule filter from a JSON file containing a list of rules. """
+        with open(filename) as f:
+            return cls(json.load(f))
+
+
+    @staticmethod
+    def _parse_bytes(value):
+        """ Parses a pattern value, given as a hex string or a list of byte values. """
+        if isinstance(value, str):
+            return bytes.fromhex(value)
+        return bytes(value)
+
+
+    @classmethod
+    def _as_list(cls, value):
+        return value if isinstance(value, list) else [value]
+
+
+    def _compile_matcher(self, pattern):
+        """
+        Compiles a match pattern into an (offset, end, value, mask) tuple; mask is
+        None for exact comparisons, or an integer for masked ones.
+        """
+        offset = int(pattern['offset'])
+        value = self._parse_bytes(pattern['value'])
+
+        if 'mask' not in pattern:
+            return offset, offset + len(value), value, None
+
+        mask = self._parse_bytes(pattern['mask'])
+        if len(mask) != len(value):
+            raise ValueError("mask and value must be the same length")
+
+        mask = int.from_bytes(mask, 'big')
+        return offset, offset + len(value), int.from_bytes(value, 'big') & mask, mask
+
+
+    def _compile_patchers(self, rule):
+        """
+        Compiles a rule's set and xor patches into (offset, end, value, xor) tuples,
+        with value as bytes for set patches and as an integer for xor patches.
+        """
+        patchers = []
+
+        for patch in self._as_list(rule.get('set', [])):
+            offset = int(patch['offset'])
+            value = self._parse_bytes(patch['value'])
+            patchers.append((offset, offset + len(value), value, False))
+
+        for patch in self._as_list(rule.get('xor', [])):
+            offset = int(patch['offset'])
+            value = self._parse_bytes(patch['value'])
+            patchers.append((offset, offset + len(value), int.from_bytes(value, 'big'), True))
+
+        return patchers
+
+
+    def _compile_rule(self, rule):
+        direction = rule.get('direction', 'in').lower()
+        if direction not in self.DIRECTIONS:
+            raise ValueError("direction must be 'in' or 'out'")
+
+        if 'remap' in rule:
+            self.remaps[direction][int(rule['remap']['from'])] = int(rule['remap']['to'])
+            return
+
+        matchers = [self._compile_matcher(pattern) for pattern in self._as_list(rule.get('match', []))]
+        compiled = (matchers, self._compile_patchers(rule), bool(rule.get('drop')), bool(rule.get('stall')))
+
+        if 'control' in rule:
+            unknown = set(rule['control']) - set(self.CONTROL_FIELDS)
+            if unknown:
+                raise ValueError("unknown control fields {}".format(", ".join(unknown)))
+
+            # Control requests carry their direction in their request type.
+            request_type = rule['control'].get('request_type')
+            if request_type is not None:
+                direction = 'in' if int(request_type) & 0x80 else 'out'
+
+            if compiled[3] and direction == 'out':
+                raise ValueError("OUT control requests can't be stalled by filters; use drop")
+
+            fields = tuple((field, int(value)) for field, value in rule['control'].items())
+            self.control_rules[direction].append((fields,) + compiled)
+            return
+
+        if compiled[3]:
+            raise ValueError("only control requests can be stalled")
+
+        key = (direction, int(rule['endpoint']))
+        self.endpoint_rules.setdefault(key, []).append(compiled)
+
+
+    def handles(self, hook_name):
+        """ Only handle the hooks for which we have rules. """
+        if hook_name in ('filter_control_in_setup', 'filter_control_in'):
+            return bool(self.control_rules['in'])
+        if hook_name == 'filter_control_out':
+            return bool(self.control_rules['out'])
+        if hook_name == 'filter_in_token':
+            return bool(self.remaps['in'])
+        if hook_name == 'filter_in':
+            return any(direction == 'in' for direction, _ in self.endpoint_rules)
+        if hook_name == 'filter_out':
+            return bool(self.remaps['out']) or any(direction == 'out' for direction, _ in self.endpoint_rules)
+
+        return False
+
+
+    @staticmethod
+    def _matches(matchers, data):
+        for offset, end, value, mask in matchers:
+            if mask is None:
+                if bytes(data[offset:end]) != value:
+                    return False
+            elif end > len(data) or int.from_bytes(data[offset:end], 'big') & mask != value:
+                return False
+
+        return True
+
+
+    def _apply(self, rules, data):
+        """
+        Applies a list of compiled rules to a packet's data.
+
+        returns: A tuple of (data, drop, stall); data is a modified copy if any
+            patches were applied.
+        """
+        copied = False
+
+        for matchers, patchers, drop, stall in rules:
+            if matchers and not self._matches(matchers, data):
+                continue
+
+            if drop or stall:
+                return data, drop, stall
+
+            for offset, end, value, xor in patchers:
+                if end > len(data):
+                    continue
+
+                if not copied:
+                    data = bytearray(data)
+                    copied = True
+
+                if xor:
+                    data[offset:end] = (int.from_bytes(data[offset:end], 'big') ^ value).to_bytes(end - offset, 'big')
+                else:
+                    data[offset:end] = value
+
+        return data, False, False
+
+
+    def _matching_control_rules(self, direction, req):
+        """ Returns the compiled rules that apply to the given control request. """
+        return [compiled for fields, *compiled in self.control_rules[direction]
+                if all(getattr(req, field) == value for field, value in fields)]
+
+
+    def filter_control_in_setup(self, req, stalled):
+        if req is None or stalled:
+            return req, stalled
+
+        for matchers, patchers, drop, stall in self._matching_control_rules('in', req):
+            if stall:
+                return req, True
+            if drop:
+                return None, stalled
+
+        return req, stalled
+
+
+    def filter_control_in(self, req, data, stalled):
+        if req is None or stalled or not data:
+            return req, data, stalled
+
+        rules = [rule for rule in self._matching_control_rules('in', req) if rule[1]]
+        if rules:
+            data, _, _ = self._apply(rules, data)
+
+        return req, data, stalled
+
+
+    def filter_control_out(self, req, data):
+        if req is None:
+            return req, data
+
+        rules = self._matching_control_rules('out', req)
+        if rules:
+            data, drop, _ = self._apply(rules, data if data else b'')
+
+            if drop:
+                return None, None
+
+        return req, data
+
+
+    def filter_in_token(self, ep_num):
+        return self.remaps['in'].get(ep_num, ep_num)
+
+
+    def filter_in(self, ep_num, data):
+        rules = self.endpoint_rules.get(('in', ep_num))
+
+        if rules and data is not None:
+            data, drop, _ = self._apply(rules, data)
+
+            if drop:
+                return ep_num, None
+
+        return ep_num, data
+
+
+    def filter_out(self, ep_num, data):
+        rules = self.endpoint_rules.get(('out', ep_num))
+
+        if rules and data is not None:
+            data, drop, _ = self._apply(rules, data)
+
+            if drop:
+                return ep_num, None
+
+        return self.remaps['out'].get(ep_num, ep_num), data
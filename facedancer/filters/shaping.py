@@ -0,0 +1,470 @@
+#
+# USBProxy traffic shaping filters, for testing hosts' sensitivity to timing
+#
+
+import json
+import time
+import heapq
+import random
+import itertools
+import collections
+
+from ..USBProxy import USBProxyFilter
+
+
+class USBProxyTokenBucket:
+    """
+    Token-bucket rate limiter. Tokens are bytes: they accumulate at a fixed rate,
+    up to the size of the bucket. The bucket can go into debt, so a packet larger
+    than the bucket is still let through, but delays the packets that follow it.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        rate: The long-term rate, in bytes per second.
+        burst: The size of the bucket, in bytes; the most that can be sent at once.
+        """
+        self.rate    = rate
+        self.burst   = burst
+        self.tokens  = burst
+        self.updated = time.monotonic()
+
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def has_tokens(self, now):
+        """ Returns true iff the bucket isn't empty, and so a packet can be sent. """
+        self._refill(now)
+        return self.tokens > 0
+
+
+    def consume(self, length, now):
+        """
+        Takes the given number of bytes from the bucket.
+
+        returns: The time at which the bucket will have recovered from any debt,
+            i.e. the earliest a following packet may be sent.
+        """
+        self._refill(now)
+        self.tokens -= length
+
+        if self.tokens >= 0:
+            return now
+
+        return now - self.tokens / self.rate
+
+
+
+class USBProxyShapingFilter(USBProxyFilter):
+    """
+    Filter that delays, rate-limits, drops and NAKs proxied traffic, to see how a
+    host's drivers cope with a slow or unreliable device. Like USBProxyRuleFilter,
+    it's configured with a list of rules, usually loaded from a JSON file:
+
+        [
+            {"endpoint": 1, "direction": "in", "rate": 65536, "burst": 4096},
+            {"endpoint": 2, "direction": "out",
+             "delay": {"distribution": "uniform", "min": 1, "max": 20}},
+            {"endpoint": 3, "direction": "in",
+             "windows": [{"action": "nak", "start": 5, "duration": 2, "period": 30}]},
+            {"control": {"request_type": 161, "request": 1},
+             "delay": {"distribution": "normal", "mean": 50, "stddev": 10}}
+        ]
+
+    Endpoint rules apply to data packets on the given endpoint number and direction;
+    control rules, to control requests whose SETUP fields (request_type, request,
+    value, index) match those given. Each rule can have:
+        rate, burst: A token-bucket rate limit, in bytes per second, with a bucket of
+            burst bytes (by default, one second's worth). Endpoints only.
+        delay: A delay to add to each packet or request, in milliseconds, drawn from
+            a distribution: "fixed" (ms), "uniform" (min, max), "normal" (mean,
+            stddev) or "exponential" (mean).
+        windows: Periods of time, in seconds since the filter was created, during
+            which traffic is dropped ("drop") or NAK'd ("nak"). Each has a start and
+            duration, and optionally a period, after which it repeats.
+
+    Shaping never blocks the proxy: traffic is held back and released from our own
+    timer queue, which is serviced by the device's scheduler. While an IN endpoint
+    is being held back, the host's IN tokens are NAK'd. OUT packets have already
+    been accepted from the host when we see them, so NAK'ing or rate-limiting an
+    OUT endpoint delays its delivery to the proxied device instead. Held control
+    requests are NAK'd, and re-submitted to the proxy once released; so filters
+    ahead of this one see them again.
+
+    Packets are released directly to the host or device, skipping any filters after
+    this one; so this filter is usually best added last. Each injected delay, drop,
+    NAK and rate limit is counted in the proxy's statistics, if it has any.
+    """
+
+    DIRECTIONS = ('in', 'out')
+    CONTROL_FIELDS = ('request_type', 'request', 'value', 'index')
+    WINDOW_ACTIONS = ('drop', 'nak')
+
+
+    def __init__(self, device, rules, seed=None):
+        """
+        Sets up a new shaping filter, and adds its timer queue to the device's scheduler.
+
+        device: The USBProxyDevice whose traffic we're shaping.
+        rules: A list of rules, as described above.
+        seed: If provided, the seed for random delays, for reproducible runs.
+        """
+        self.device = device
+        self.random = random.Random(seed)
+        self.started = time.monotonic()
+
+        # Compiled rules for data packets, by (direction, endpoint number); and for
+        # control requests, as (fields, rule) tuples. Each compiled rule is a tuple of
+        # (token bucket, delay function, windows).
+        self.endpoint_rules = {}
+        self.control_rules = []
+
+        for number, rule in enumerate(rules):
+            try:
+                self._compile_rule(rule)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError("invalid shaping rule {} ({}): {}".format(number, rule, e))
+
+        # Only see traffic on the endpoints we have rules for.
+        self.endpoints = set(ep_num for _, ep_num in self.endpoint_rules)
+
+        # Our timer queue, as a heap of (deadline, sequence number, callback, args).
+        self.timers = []
+        self.timer_sequence = itertools.count()
+
+        # Traffic we're holding back: the IN packet waiting to go to the host on
+        # each endpoint, the OUT packets waiting to go to the device, and control
+        # requests we've released, which we should let through.
+        self.held_in = {}
+        self.held_out = collections.defaultdict(collections.deque)
+        self.released_requests = []
+
+        device.scheduler.add_task(self.service)
+
+
+    @classmethod
+    def load(cls, device, filename, seed=None):
+        """ Creates a shaping filter from a JSON file containing a list of rules. """
+        with open(filename) as f:
+            return cls(device, json.load(f), seed)
+
+
+    def _compile_delay(self, delay):
+        """ Compiles a delay specification into a function returning a delay in seconds. """
+        distribution = delay.get('distribution', 'fixed')
+        uniform, gauss, expovariate = self.random.uniform, self.random.gauss, self.random.expovariate
+
+        if distribution == 'fixed':
+            fixed = float(delay['ms']) / 1000
+            return lambda: fixed
+        if distribution == 'uniform':
+            low, high = float(delay['min']) / 1000, float(delay['max']) / 1000
+            return lambda: uniform(low, high)
+        if distribution == 'normal':
+            mean, stddev = float(delay['mean']) / 1000, float(delay['stddev']) / 1000
+            return lambda: max(0.0, gauss(mean, stddev))
+        if distribution == 'exponential':
+            rate = 1000 / float(delay['mean'])
+            return lambda: expovariate(rate)
+
+        raise ValueError("unknown delay distribution '{}'".format(distribution))
+
+
+    def _compile_window(self, window):
+        """ Compiles a window into an (action, start, duration, period) tuple. """
+        action = window['action'].lower()
+        if action not in self.WINDOW_ACTIONS:
+            raise ValueError("window action must be 'drop' or 'nak'")
+
+        period = window.get('period')
+        return action, float(window['start']), float(window['duration']), float(period) if period else None
+
+
+    def _compile_rule(self, rule):
+        bucket = None
+        if 'rate' in rule:
+            rate = float(rule['rate'])
+            bucket = USBProxyTokenBucket(rate, float(rule.get('burst', rate)))
+
+        delay = self._compile_delay(rule['delay']) if 'delay' in rule else None
+        windows = [self._compile_window(window) for window in rule.get('windows', [])]
+
+        if 'control' in rule:
+            unknown = set(rule['control']) - set(self.CONTROL_FIELDS)
+            if unknown:
+                raise ValueError("unknown control fields {}".format(", ".join(unknown)))
+            if bucket:
+                raise ValueError("only endpoints can be rate limited")
+
+            fields = tuple((field, int(value)) for field, value in rule['control'].items())
+            self.control_rules.append((fields, (None, delay, windows)))
+            return
+
+        direction = rule.get('direction', 'in').lower()
+        if direction not in self.DIRECTIONS:
+            raise ValueError("direction must be 'in' or 'out'")
+
+        key = (direction, int(rule['endpoint']))
+        if key in self.endpoint_rules:
+            raise ValueError("endpoint {} {} already has a rule".format(key[1], direction.upper()))
+
+        self.endpoint_rules[key] = (bucket, delay, windows)
+
+
+    def handles(self, hook_name):
+        """ Only handle the hooks for which we have rules. """
+        if hook_name == 'filter_control_in_setup':
+            return bool(self.control_rules)
+        if hook_name == 'filter_control_out':
+            return bool(self.control_rules)
+        if hook_name in ('filter_in_token', 'filter_in'):
+            return any(direction == 'in' for direction, _ in self.endpoint_rules)
+        if hook_name == 'filter_out':
+            return any(direction == 'out' for direction, _ in self.endpoint_rules)
+
+        return False
+
+
+    def schedule(self, delay, callback, *args):
+        """ Arranges for callback(*args) to be called after delay seconds. """
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_sequence), callback, args))
+
+
+    def service(self):
+        """ Runs any timers that have expired. Called by the device's scheduler. """
+        timers = self.timers
+
+        if not timers:
+            return
+
+        now = time.monotonic()
+        while timers and timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(timers)
+            callback(*args)
+
+
+    def _record_event(self, address, event):
+        statistics = self.device.statistics
+        if statistics:
+            statistics.record_event(address, event)
+
+
+    def _active_window(self, windows, now):
+        """
+        Returns an (action, end time) tuple for the window that's currently active,
+        or None if none are.
+        """
+        elapsed = now - self.started
+
+        for action, start, duration, period in windows:
+            if elapsed < start:
+                continue
+
+            offset = elapsed - start
+            if period:
+                offset %= period
+
+            if offset < duration:
+                return action, now + (duration - offset)
+
+        return None
+
+
+    #
+    # Control requests.
+    #
+
+    def _matching_control_rule(self, req):
+        for fields, rule in self.control_rules:
+            if all(getattr(req, field) == value for field, value in fields):
+                return rule
+
+        return None
+
+
+    def _shape_control_request(self, req, address):
+        """
+        Applies our control rules to a request.
+
+        returns: True iff the request should be passed through now.
+        """
+
+        # Requests we've released have already been shaped.
+        for index, released in enumerate(self.released_requests):
+            if released is req:
+                del self.released_requests[index]
+                return True
+
+        rule = self._matching_control_rule(req)
+        if rule is None:
+            return True
+
+        _, delay, windows = rule
+        now = time.monotonic()
+
+        release_at = now
+        window = self._active_window(windows, now)
+
+        if window is not None:
+            action, window_end = window
+            self._record_event(address, 'shaping_' + action)
+
+            if action == 'drop':
+                return False
+
+            release_at = window_end
+
+        if delay:
+            release_at += delay()
+            self._record_event(address, 'shaping_delay')
+
+        if release_at <= now:
+            return True
+
+        self.schedule(release_at - now, self._release_control_request, req)
+        return False
+
+
+    def _release_control_request(self, req):
+        self.released_requests.append(req)
+        self.device.handle_request(req)
+
+
+    def filter_control_in_setup(self, req, stalled):
+        if req is None or stalled:
+            return req, stalled
+
+        if not self._shape_control_request(req, 0x80):
+            return None, stalled
+
+        return req, stalled
+
+
+    def filter_control_out(self, req, data):
+        if req is None:
+            return req, data
+
+        if not self._shape_control_request(req, 0x00):
+            return None, None
+
+        return req, data
+
+
+    #
+    # IN endpoints.
+    #
+
+    def filter_in_token(self, ep_num):
+        rule = self.endpoint_rules.get(('in', ep_num))
+
+        if rule is None:
+            return ep_num
+
+        # While we're holding a packet back, the host has to wait for it.
+        if ep_num in self.held_in:
+            return None
+
+        bucket, _, windows = rule
+        now = time.monotonic()
+
+        window = self._active_window(windows, now) if windows else None
+        if window is not None and window[0] == 'nak':
+            self._record_event(ep_num | 0x80, 'shaping_nak')
+            return None
+
+        if bucket and not bucket.has_tokens(now):
+            self._record_event(ep_num | 0x80, 'shaping_rate_limit')
+            return None
+
+        return ep_num
+
+
+    def filter_in(self, ep_num, data):
+        rule = self.endpoint_rules.get(('in', ep_num))
+
+        if rule is None or data is None:
+            return ep_num, data
+
+        bucket, delay, windows = rule
+        now = time.monotonic()
+
+        window = self._active_window(windows, now) if windows else None
+        if window is not None and window[0] == 'drop':
+            self._record_event(ep_num | 0x80, 'shaping_drop')
+            return ep_num, None
+
+        if bucket:
+            bucket.consume(len(data), now)
+
+        if delay:
+            self.held_in[ep_num] = data
+            self.schedule(delay(), self._release_in, ep_num)
+            self._record_event(ep_num | 0x80, 'shaping_delay')
+            return ep_num, None
+
+        return ep_num, data
+
+
+    def _release_in(self, ep_num):
+        data = self.held_in.pop(ep_num)
+        endpoint = self.device.endpoints.get(ep_num)
+
+        # If the device's been reconfigured while we held the packet, it's stale.
+        if endpoint is not None:
+            endpoint.send_packet(data)
+
+
+    #
+    # OUT endpoints.
+    #
+
+    def filter_out(self, ep_num, data):
+        rule = self.endpoint_rules.get(('out', ep_num))
+
+        if rule is None or data is None:
+            return ep_num, data
+
+        bucket, delay, windows = rule
+        now = time.monotonic()
+
+        release_at = now
+        window = self._active_window(windows, now) if windows else None
+
+        if window is not None:
+            action, window_end = window
+            self._record_event(ep_num, 'shaping_' + action)
+
+            if action == 'drop':
+                return ep_num, None
+
+            release_at = window_end
+
+        if bucket:
+            allowed_at = bucket.consume(len(data), now)
+            if allowed_at > release_at:
+                release_at = allowed_at
+                self._record_event(ep_num, 'shaping_rate_limit')
+
+        if delay:
+            release_at += delay()
+            self._record_event(ep_num, 'shaping_delay')
+
+        # Packets must reach the device in order; so once we're holding any back,
+        # everything after them has to wait its turn, too.
+        held = self.held_out[ep_num]
+        if held:
+            release_at = max(release_at, held[-1][0])
+        elif release_at <= now:
+            return ep_num, data
+
+        held.append((release_at, bytes(data)))
+        self.schedule(release_at - now, self._release_out, ep_num)
+        return ep_num, None
+
+
+    def _release_out(self, ep_num):
+        _, data = self.held_out[ep_num].popleft()
+        self.device.send_to_device(ep_num, data)
@@ -2,6 +2,8 @@
 # Standard filters for USBProxy that should (almost) always be used
 #
 
+import weakref
+
 from ..USBProxy import USBProxyFilter
 
 from ..USB import *
@@ -22,11 +24,54 @@ class USBProxySetupFilters(USBProxyFilter):
 
     DESCRIPTOR_CONFIRGUATION = 0x02
 
+    # Parsed configurations, kept across proxy sessions; see _parse_configuration.
+    # Maps each proxied device to a dictionary, which maps raw configuration
+    # descriptors to (configuration, endpoint map) tuples.
+    parsed_configurations = weakref.WeakKeyDictionary()
+
+    # The most parsed configurations to keep, e.g. while a fuzzer generates new ones.
+    PARSED_CONFIGURATION_LIMIT = 64
+
     def __init__(self, device, verbose=0):
         self.device = device
         self.configurations = {}
         self.verbose = verbose
 
+
+    @staticmethod
+    def _build_endpoint_map(configuration):
+        """ Returns a dictionary mapping endpoint numbers to the configuration's endpoints. """
+        return {endpoint.number: endpoint for interface in configuration.interfaces
+                for endpoint in interface.endpoints}
+
+
+    def _parse_configuration(self, data):
+        """
+        Returns a (configuration, endpoint map) tuple for the given configuration
+        descriptor. The host reads the same descriptors several times each time it
+        enumerates the device, so parsed configurations are cached by their raw
+        bytes and reused, including across proxy sessions.
+
+        Each proxied device has its own cache: a configuration's endpoints route
+        their packets through the device they're bound to, and hold per-device
+        state, so two devices-- even identical ones-- never share them.
+        """
+        key = bytes(data)
+        cache = self.parsed_configurations.setdefault(self.device, {})
+
+        parsed = cache.get(key)
+
+        if parsed is None:
+            configuration = USBDescribable.from_binary_descriptor(data)
+            parsed = (configuration, self._build_endpoint_map(configuration))
+
+            if len(cache) >= self.PARSED_CONFIGURATION_LIMIT:
+                del cache[next(iter(cache))]
+
+            cache[key] = parsed
+
+        return parsed
+
     def filter_control_in(self, req, data, stalled):
 
         if stalled:
@@ -45,8 +90,8 @@ class USBProxySetupFilters(USBProxyFilter):
             # to the configuration. We'll need this to set up the endpoint
             # hardware on the facedancer device.
             if descriptor_type == self.DESCRIPTOR_CONFIRGUATION and req.length >= 32:
-                configuration = USBDescribable.from_binary_descriptor(data)
-                self.configurations[configuration.configuration_index] = configuration
+                configuration, endpoints = self._parse_configuration(data)
+                self.configurations[configuration.configuration_index] = (configuration, endpoints)
 
                 if self.verbose > 1:
                     print("-- Storing configuration {} --".format(configuration))
@@ -72,12 +117,12 @@ class USBProxySetupFilters(USBProxyFilter):
 
             # If we have a known configuration for this index, apply it.
             if configuration_index in self.configurations:
-                configuration = self.configurations[configuration_index]
+                configuration, endpoints = self.configurations[configuration_index]
 
                 if self.verbose > 0:
                     print("-- Applying configuration {} --".format(configuration))
 
-                self.device.configured(configuration)
+                self.device.configured(configuration, endpoints)
 
             # Otherwise, the host has applied a configruation without ever reading
             # its descriptor. This is mighty strange behavior!
@@ -0,0 +1,229 @@
+#
+# USBProxy tap filters, which observe traffic outside of the proxy's hot path
+#
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import multiprocessing
+
+from ..USBProxy import USBProxyFilter
+from ..USBDevice import USBDeviceRequest
+
+
+def _dispatch_record(tap, record):
+    """ Passes a single tapped record to the relevant hook of a tap. """
+    hook_name, args = record
+
+    try:
+        getattr(tap, hook_name)(*args)
+    except Exception:
+        traceback.print_exc()
+
+
+def _run_tap_process(tap, connection):
+    """ Main loop for taps that run in their own process. """
+    while True:
+        records = connection.recv()
+
+        if records is None:
+            return
+
+        for record in records:
+            _dispatch_record(tap, record)
+
+
+
+class USBProxyTapFilter(USBProxyFilter):
+    """
+    Filter that passes copies of proxied traffic to an observer ("tap") without
+    letting it affect the proxy. The tap can be any USBProxyFilter, such as
+    USBProxyPrettyPrintFilter; its hooks are called from a separate thread (or
+    process), and their return values are ignored, so it can never modify or
+    delay traffic.
+
+    Records are handed over through a bounded deque, whose appends and pops are
+    atomic, so the proxy never waits on a lock. If the tap falls behind and the
+    queue fills, new records are dropped and counted, rather than blocking.
+    """
+
+    # How long the tap's thread sleeps when it has nothing to do, in seconds.
+    POLL_INTERVAL = 0.001
+
+    # How often dropped records are reported, in seconds.
+    DROP_REPORT_INTERVAL = 1.0
+
+    # The largest batch of records sent to a tap process at once.
+    PROCESS_BATCH_SIZE = 256
+
+    def __init__(self, tap, queue_size=65536, use_process=False):
+        """
+        Sets up a new tap filter, and starts the tap's thread or process.
+
+        tap: The USBProxyFilter to be run outside of the hot path.
+        queue_size: The maximum number of records to hold while the tap catches up.
+        use_process: If true, the tap runs in its own process, so its work doesn't
+            compete with the proxy for the interpreter. The tap must be picklable.
+        """
+        self.tap = tap
+        self.queue_size = queue_size
+
+        self.records = collections.deque()
+        self.stopping = False
+
+        self.dropped = 0
+        self.dropped_reported = 0
+        self.last_drop_report = time.monotonic()
+
+        self.process = None
+
+        if use_process:
+            receiver, self.connection = multiprocessing.Pipe(duplex=False)
+            self.process = multiprocessing.Process(target=_run_tap_process, args=(tap, receiver), daemon=True)
+            self.process.start()
+
+            target = self._relay_to_process
+        else:
+            target = self._run
+
+        self.thread = threading.Thread(target=target, daemon=True,
+            name="USBProxy tap {}".format(type(tap).__name__))
+        self.thread.start()
+
+
+    def close(self):
+        """ Stops the tap, once it's processed the records already queued. """
+        self.stopping = True
+        self.thread.join()
+
+        if self.process:
+            self.process.join()
+
+        self._report_drops(force=True)
+
+
+    def handles(self, hook_name):
+        return self.tap.handles(hook_name)
+
+
+    def handles_endpoint(self, ep_num):
+        return self.tap.handles_endpoint(ep_num)
+
+
+    def _queue(self, hook_name, *args):
+        """ Queues a record for the tap, or drops it if the tap's fallen behind. """
+        if len(self.records) >= self.queue_size:
+            self.dropped += 1
+        else:
+            self.records.append((hook_name, args))
+
+
+    @staticmethod
+    def _copy_request(req):
+        return USBDeviceRequest(req.raw() + bytes(req.data)) if req is not None else None
+
+
+    @staticmethod
+    def _copy_data(data):
+        return bytes(data) if data is not None else None
+
+
+    def filter_control_in_setup(self, req, stalled):
+        self._queue('filter_control_in_setup', self._copy_request(req), stalled)
+        return req, stalled
+
+
+    def filter_control_in(self, req, data, stalled):
+        self._queue('filter_control_in', self._copy_request(req), self._copy_data(data), stalled)
+        return req, data, stalled
+
+
+    def filter_control_out(self, req, data):
+        self._queue('filter_control_out', self._copy_request(req), self._copy_data(data))
+        return req, data
+
+
+    def handle_out_request_stall(self, req, data, stalled):
+        self._queue('handle_out_request_stall', self._copy_request(req), self._copy_data(data), stalled)
+        return req, data, stalled
+
+
+    def filter_in_token(self, ep_num):
+        self._queue('filter_in_token', ep_num)
+        return ep_num
+
+
+    def filter_in(self, ep_num, data):
+        self._queue('filter_in', ep_num, self._copy_data(data))
+        return ep_num, data
+
+
+    def filter_out(self, ep_num, data):
+        self._queue('filter_out', ep_num, self._copy_data(data))
+        return ep_num, data
+
+
+    def handle_out_stall(self, ep_num, data, stalled):
+        self._queue('handle_out_stall', ep_num, self._copy_data(data), stalled)
+        return ep_num, data, stalled
+
+
+    def _report_drops(self, force=False):
+        """ Reports any records dropped since our last report. """
+        now = time.monotonic()
+
+        if not force and now - self.last_drop_report < self.DROP_REPORT_INTERVAL:
+            return
+
+        self.last_drop_report = now
+        dropped = self.dropped
+
+        if dropped != self.dropped_reported:
+            print("-- tap {} fell behind; dropped {} records ({} total) --".format(
+                type(self.tap).__name__, dropped - self.dropped_reported, dropped), file=sys.stderr)
+            self.dropped_reported = dropped
+
+
+    def _run(self):
+        """ Runs the tap's hooks on each queued record, in our own thread. """
+        records = self.records
+
+        while True:
+            try:
+                record = records.popleft()
+            except IndexError:
+                if self.stopping:
+                    return
+
+                self._report_drops()
+                time.sleep(self.POLL_INTERVAL)
+                continue
+
+            _dispatch_record(self.tap, record)
+
+
+    def _relay_to_process(self):
+        """ Forwards batches of queued records to the tap's process. """
+        records = self.records
+
+        while True:
+            batch = []
+
+            try:
+                while len(batch) < self.PROCESS_BATCH_SIZE:
+                    batch.append(records.popleft())
+            except IndexError:
+                pass
+
+            if batch:
+                self.connection.send(batch)
+                continue
+
+            if self.stopping:
+                self.connection.send(None)
+                return
+
+            self._report_drops()
+            time.sleep(self.POLL_INTERVAL)